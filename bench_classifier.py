@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Microbenchmark for the crash classifier, run over the clang outputs
+# recorded in the database.
+
+import argparse as argp
+import itertools
+import time
+import sys
+from collections import Counter
+
+from triage_db import TriageDb
+from run_clang import classify_output
+
+
+def bench(outputs, repeat):
+    'Return the best time of classifying all outputs, in seconds.'
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for output in outputs:
+            classify_output(output, 0)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argp.ArgumentParser(
+        description='Benchmark the crash classifier on recorded outputs.')
+    parser.add_argument('--limit', metavar='N', type=int, default=None,
+                        help='Use at most N outputs.')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help='Take the best of N passes.')
+    args = parser.parse_args()
+
+    db = TriageDb()
+    outputs = list(itertools.islice(db.iterateOutputs(), args.limit))
+    if not outputs:
+        print('No outputs in the database.', file=sys.stderr)
+        sys.exit(1)
+    size = sum(len(x) for x in outputs)
+
+    elapsed = bench(outputs, args.repeat)
+    print('{n} outputs, {mb:.1f} MB: {t:.3f} s per pass, {rate:.1f} MB/s, '
+          '{per:.1f} us per output'.format(
+              n=len(outputs), mb=size/1e6, t=elapsed, rate=size/1e6/elapsed,
+              per=elapsed/len(outputs)*1e6))
+
+    reasons = Counter(getattr(classify_output(x, 0), 'reason', 'OK')
+                      for x in outputs)
+    print('{} distinct reasons; most common:'.format(len(reasons)))
+    for reason, n in reasons.most_common(10):
+        print('  {:6d}  {}'.format(n, reason))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+-- The first bad svn revision for a failure reason. If builds between
+-- good_revision and bad_revision failed, exact is FALSE and the
+-- revision range could not be narrowed down to a single commit.
+CREATE TABLE bisections (
+    result BIGINT PRIMARY KEY REFERENCES result_strings(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    test_run BIGINT NOT NULL REFERENCES test_runs(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    case_id BIGINT NOT NULL REFERENCES cases(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    good_revision INTEGER NOT NULL,
+    bad_revision INTEGER NOT NULL,
+    bad_project TEXT,
+    exact BOOLEAN NOT NULL);
+
+-- Failure reasons waiting to be bisected: case_id, the smallest case
+-- which changed from OK to result between the finished test runs
+-- old_run and new_run. Filled when a test run finishes, emptied by
+-- TriageDb.addBisection().
+CREATE TABLE bisect_queue (
+    result BIGINT PRIMARY KEY REFERENCES result_strings(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    old_run BIGINT NOT NULL REFERENCES test_runs(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    new_run BIGINT NOT NULL REFERENCES test_runs(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    case_id BIGINT NOT NULL REFERENCES cases(id)
+        ON UPDATE CASCADE ON DELETE CASCADE);
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Bisects failures which appeared in a test run to the first bad svn
+# revision. This is done once per failure reason, using the
+# smallest case that changed from OK to the failure.
+
+import os
+import sys
+import time
+import shutil
+import subprocess as subp
+
+from triage_db import TriageDb
+from repository import svn_commits_between, checkout, build
+from run_clang import test_input
+
+from config import PROJECTS, BISECT_PROJECTS, BISECT_BUILD
+from config import BISECT_CACHE_DIR, BISECT_CACHE_MAX_BUILDS
+from config import TRIAGE_EXTRA_CLANG_PARAMS
+
+
+class BuildCache(object):
+    '''A cache of clang builds keyed by the revisions of the projects.
+    Each build is a directory containing bin/clang and lib/clang (the
+    resource directory with the builtin headers).'''
+
+    def __init__(self, path=BISECT_CACHE_DIR,
+                 max_builds=BISECT_CACHE_MAX_BUILDS):
+        self.path = path
+        self.max_builds = max_builds
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __key(self, state):
+        return '-'.join('{}{}'.format(proj, state[proj][0])
+                        for proj in sorted(state))
+
+    def __evict(self):
+        builds = [os.path.join(self.path, x) for x in os.listdir(self.path)]
+        builds.sort(key=os.path.getmtime)
+        for d in builds[:max(0, len(builds) - self.max_builds)]:
+            shutil.rmtree(d)
+
+    def get(self, state):
+        '''Get the path to a clang binary for state, a {project:
+        (svn_revision, commit_id)} dict, building it if necessary.
+        Returns None if the build fails.'''
+
+        build_dir = os.path.join(self.path, self.__key(state))
+        binary = os.path.join(build_dir, 'bin', 'clang')
+        if os.path.exists(binary):
+            # mark as recently used
+            os.utime(build_dir)
+            return binary
+
+        for proj, (rev, commit_id) in state.items():
+            print('Checking out {} r{}...'.format(proj, rev),
+                  file=sys.stderr)
+            checkout(BISECT_PROJECTS[proj], commit_id,
+                     fetch_from=PROJECTS[proj])
+        if not build(BISECT_BUILD, ['clang']):
+            return None
+
+        tmp_dir = build_dir + '.new'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir, 'bin'))
+        shutil.copy2(os.path.join(BISECT_BUILD, 'bin', 'clang'),
+                     os.path.join(tmp_dir, 'bin', 'clang'))
+        shutil.copytree(os.path.join(BISECT_BUILD, 'lib', 'clang'),
+                        os.path.join(tmp_dir, 'lib', 'clang'))
+        os.rename(tmp_dir, build_dir)
+        self.__evict()
+        return binary
+
+
+def revision_states(old_versions, new_versions):
+    '''Compute the sequence of source states between two test runs. Returns
+    (changes, state_func), where changes is a list of (svn_revision,
+    project) sorted by revision and state_func(k) returns the state after
+    applying the first k changes as a {project: (svn_revision,
+    commit_id)} dict. state_func(0) is the old and state_func(len(changes))
+    the new version.'''
+
+    bases = {}
+    changes = []
+    for proj, path in PROJECTS.items():
+        base, commits = svn_commits_between(
+            path, old_versions[proj], new_versions[proj])
+        assert base, 'No commit for {} r{}'.format(proj, old_versions[proj])
+        bases[proj] = (old_versions[proj], base)
+        changes += [(rev, proj, commit_id) for rev, commit_id in commits]
+    changes.sort()
+
+    def state_func(k):
+        state = dict(bases)
+        for rev, proj, commit_id in changes[:k]:
+            state[proj] = (rev, commit_id)
+        return state
+
+    return [(rev, proj) for rev, proj, commit_id in changes], state_func
+
+
+class DeadlinePassed(Exception):
+    'Raised by bisect_one() when its deadline passes.'
+    pass
+
+
+def bisect_one(work, cache, deadline=None):
+    '''Find the first revision where work.contents fails with
+    work.reason. Returns (good_revision, bad_revision, bad_project,
+    exact). Raises DeadlinePassed if time.time() passes deadline before
+    a build; the builds done so far are cached for the next attempt.'''
+
+    changes, state = revision_states(work.old_versions, work.new_versions)
+    assert changes, 'No commits between {} and {}'.format(
+        work.old_versions, work.new_versions)
+
+    def is_bad(binary):
+        crash = test_input(work.contents, TRIAGE_EXTRA_CLANG_PARAMS,
+                           binary=binary)[0]
+        return bool(crash) and crash.reason == work.reason
+
+    # State lo is known to be good and hi to be bad.
+    lo, hi = 0, len(changes)
+    unbuildable = set()
+    while True:
+        # Try the state closest to the middle which has not failed to
+        # build.
+        mid = (lo + hi) // 2
+        candidates = [k for k in range(lo+1, hi) if not k in unbuildable]
+        if not candidates:
+            break
+        k = min(candidates, key=lambda x: abs(x - mid))
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlinePassed()
+        binary = cache.get(state(k))
+        if not binary:
+            unbuildable.add(k)
+            continue
+        if is_bad(binary):
+            hi = k
+        else:
+            lo = k
+        print('Bisecting: {} revisions left.'.format(hi - lo - 1),
+              file=sys.stderr)
+    exact = hi - lo == 1
+
+    if lo:
+        good_rev = changes[lo-1][0]
+    else:
+        good_rev = max(work.old_versions.values())
+    bad_rev, bad_proj = changes[hi-1]
+    return good_rev, bad_rev, bad_proj, exact
+
+
+def bisect_new_failures(db, deadline=None):
+    '''Bisect the failure reasons in the bisect queue, or as many as can
+    be until time.time() passes deadline. A bisection that fails, for
+    example because a checkout fails, is left in the queue to be retried
+    later. Returns True if some bisection was finished or ran out of
+    time, False if there was nothing to do but failing bisections.'''
+
+    work = db.getBisectWork()
+    if not work:
+        return False
+    cache = BuildCache()
+    progress = False
+    for w in work:
+        print('Bisecting "{}" using case {}...'.format(w.reason, w.sha),
+              file=sys.stderr)
+        try:
+            good_rev, bad_rev, bad_proj, exact = bisect_one(w, cache,
+                                                            deadline)
+        except DeadlinePassed:
+            print('Out of time, bisecting later.', file=sys.stderr)
+            return True
+        except (subp.CalledProcessError, OSError, AssertionError) as e:
+            print('Bisection failed, retrying later: ' + repr(e),
+                  file=sys.stderr)
+            continue
+        print('First bad revision: {} r{}{}'.format(
+            bad_proj, bad_rev, '' if exact else
+            ' (inexact, last good r{})'.format(good_rev)), file=sys.stderr)
+        db.addBisection(w, good_rev, bad_rev, bad_proj, exact)
+        progress = True
+    return progress
+
+
+def main():
+    bisect_new_failures(TriageDb())
+
+
+if __name__ == '__main__':
+    main()
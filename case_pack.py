@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# A local, content-addressed pack of the cases for test runs. Cases are
+# immutable and identified by their sha1, so they are fetched from the
+# database only once. The pack is
+#
+#    cases.pack   uncompressed case contents, appended to by sync()
+#    cases.idx    a header and (sha1, offset, length) records sorted
+#                 by sha1; replaced atomically by sync()
+#
+# Readers mmap both, so workers can pass slices of the data to clang
+# without copying and several daemons on a host share the page cache.
+# The data file is only appended to, so a reader's mmap stays valid
+# while the pack is synced.
+
+import os
+import sys
+import mmap
+import fcntl
+import struct
+import heapq
+import binascii
+import argparse as argp
+from contextlib import contextmanager
+
+from triage_db import TriageDb
+
+from config import CASE_PACK_DIR
+
+DATA_NAME = 'cases.pack'
+INDEX_NAME = 'cases.idx'
+LOCK_NAME = 'cases.lock'
+
+MAGIC = b'CTPK'
+VERSION = 1
+# magic, version, number of records
+HEADER = struct.Struct('<4sIQ')
+# sha1 (binary), offset in the data file, length
+RECORD = struct.Struct('<20sQI')
+
+
+@contextmanager
+def pack_lock(path, exclusive):
+    'Hold the lock of the pack in path.'
+
+    with open(os.path.join(path, LOCK_NAME), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_index(path):
+    '''Read the index of the pack in path. Returns a list of (sha1,
+    offset, length) records sorted by sha1, where sha1 is binary.'''
+
+    try:
+        with open(os.path.join(path, INDEX_NAME), 'rb') as f:
+            index = f.read()
+    except FileNotFoundError:
+        return []
+    magic, version, count = HEADER.unpack_from(index)
+    assert magic == MAGIC and version == VERSION, \
+        'Not a case pack index: ' + path
+    return list(RECORD.iter_unpack(index[HEADER.size:]))[:count]
+
+
+def write_index(path, records, count):
+    '''Atomically replace the index of the pack in path with count
+    records from the iterable records.'''
+
+    fname = os.path.join(path, INDEX_NAME)
+    with open(fname + '.new', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, count))
+        f.write(b''.join(RECORD.pack(*x) for x in records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fname + '.new', fname)
+
+
+def sync(db, shas, path=CASE_PACK_DIR):
+    '''Add the cases in the set of sha1s shas which are not in the pack
+    in path to it from the database. Returns the number of cases
+    added.'''
+
+    os.makedirs(path, exist_ok=True)
+    with pack_lock(path, exclusive=True):
+        records = read_index(path)
+        have = set(binascii.hexlify(x[0]).decode('ascii') for x in records)
+        missing = sorted(shas - have)
+        new = []
+        with open(os.path.join(path, DATA_NAME), 'ab') as f:
+            if not missing:
+                if not os.path.exists(os.path.join(path, INDEX_NAME)):
+                    write_index(path, [], 0)
+                return 0
+            offset = f.seek(0, os.SEEK_END)
+            for i, (sha, contents) in enumerate(db.getCases(missing)):
+                f.write(contents)
+                new.append((binascii.unhexlify(sha), offset, len(contents)))
+                offset += len(contents)
+                if i % 1000 == 0:
+                    print('\rAdding cases to the pack: {}/{}'.format(
+                        i, len(missing)), end='', file=sys.stderr)
+            f.flush()
+            os.fsync(f.fileno())
+        print('\rAdding cases to the pack: {0}/{0}'.format(len(missing)),
+              file=sys.stderr)
+        # The data must be on disk before the index refers to it.
+        write_index(path, heapq.merge(records, sorted(new)),
+                    len(records) + len(new))
+        return len(new)
+
+
+class CasePack(object):
+    '''A read-only view of the pack in path. get() returns memoryviews of
+    the mmapped data.'''
+
+    def __init__(self, path=CASE_PACK_DIR):
+        self.path = path
+        self.data = None
+        with pack_lock(path, exclusive=False):
+            with open(os.path.join(path, INDEX_NAME), 'rb') as f:
+                self.index = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            with open(os.path.join(path, DATA_NAME), 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    self.data = memoryview(mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, version, self.count = HEADER.unpack_from(self.index)
+        assert magic == MAGIC and version == VERSION, \
+            'Not a case pack index: ' + path
+
+    def __len__(self):
+        return self.count
+
+    def __record(self, i):
+        return RECORD.unpack_from(self.index, HEADER.size + i * RECORD.size)
+
+    def records(self):
+        'Iterate through (sha1, offset, length), sha1 in hex.'
+        for i in range(self.count):
+            sha, offset, length = self.__record(i)
+            yield binascii.hexlify(sha).decode('ascii'), offset, length
+
+    def slice(self, offset, length):
+        'Returns the data at offset as a memoryview.'
+        if not length:
+            # an empty data file cannot be mmapped
+            return memoryview(b'')
+        return self.data[offset:offset+length]
+
+    def get(self, sha):
+        'Returns the contents of the case sha as a memoryview, or None.'
+        key = binascii.unhexlify(sha)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        found, offset, length = self.__record(lo)
+        if found != key:
+            return None
+        return self.slice(offset, length)
+
+
+def main():
+    parser = argp.ArgumentParser(
+        description='Bring the local case pack up to date.')
+    parser.add_argument('--path', default=CASE_PACK_DIR,
+                        help='The directory of the pack.')
+    args = parser.parse_args()
+
+    db = TriageDb()
+    n = sync(db, db.getCaseShas(), args.path)
+    print('Added {} cases.'.format(n), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,8 @@ CREATE TABLE cases (
 CREATE TABLE case_contents (
     case_id BIGINT PRIMARY KEY REFERENCES cases (id)
         ON UPDATE CASCADE ON DELETE CASCADE,
-    z_contents BYTEA NOT NULL);
+    z_contents BYTEA NOT NULL,
+    codec SMALLINT NOT NULL DEFAULT 1 REFERENCES codecs(id));
 
 -- Establish a 1:1 relationship between cases and case_contents
 ALTER TABLE cases ADD CONSTRAINT cases_id_forward_fkey
@@ -24,10 +25,18 @@ ALTER TABLE case_contents ADD CONSTRAINT case_contents_case_id_forward_fkey
     FOREIGN KEY (case_id) REFERENCES case_sizes (case_id)
         ON UPDATE CASCADE ON DELETE CASCADE DEFERRABLE;
 
+-- Bulk imports COPY cases here and insert the new ones to the case tables
+-- from here (see TriageDb.addCases()).
+CREATE UNLOGGED TABLE case_staging (
+    sha1 TEXT NOT NULL,
+    z_contents BYTEA NOT NULL,
+    size INTEGER NOT NULL,
+    codec SMALLINT NOT NULL);
+
 -- Inserts into and deletes from the three 1:1 case tables can be done
 -- via case_view
 CREATE VIEW case_view AS
-    SELECT id, sha1, z_contents, size
+    SELECT id, sha1, z_contents, size, codec
     FROM cases, case_contents, case_sizes
     WHERE cases.id = case_contents.case_id AND cases.id = case_sizes.case_id;
 
@@ -38,8 +47,8 @@ BEGIN
     SET CONSTRAINTS cases_id_forward_fkey,
         case_contents_case_id_forward_fkey DEFERRED;
     INSERT INTO cases (sha1) VALUES (NEW.sha1) RETURNING cases.id INTO id;
-    INSERT INTO case_contents (case_id, z_contents)
-        VALUES (id, NEW.z_contents);
+    INSERT INTO case_contents (case_id, z_contents, codec)
+        VALUES (id, NEW.z_contents, NEW.codec);
     INSERT INTO case_sizes (case_id, size) VALUES (id, NEW.size);
     SET CONSTRAINTS cases_id_forward_fkey,
         case_contents_case_id_forward_fkey IMMEDIATE;
@@ -0,0 +1,30 @@
+#!/usr/bin/python3 -S
+
+# CReduce property script which asks the property server of the running
+# reduction (see property_server.py) to do the check. Falls back to
+# check_creduce_property.py if there is no server. Keep this minimal;
+# it is run for every CReduce step.
+
+import os
+import sys
+import socket
+
+SOCKET_NAME = 'property.sock'
+
+
+def main():
+    try:
+        path = os.path.join(os.environ['CLANG_TRIAGE_TMP'], SOCKET_NAME)
+        with socket.socket(socket.AF_UNIX) as s:
+            s.connect(path)
+            s.sendall(os.getcwd().encode('utf-8') + b'\n')
+            reply = s.makefile('rb').readline()
+    except (KeyError, OSError):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'check_creduce_property.py')
+        os.execv(script, [script])
+    sys.exit(0 if reply.strip() == b'0' else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Check remove_nonprintables() against the old byte-by-byte algorithm on
+# random inputs. Each non-printable byte gets a random set of accepted
+# replacements, and the predicate holds when every byte is replaced by
+# one it accepts. Then both algorithms must give the same result.
+
+import argparse as argp
+import random
+import sys
+
+from run_creduce import remove_nonprintables, PRINTABLE
+
+REPLACEMENTS = [b'', b' ', b'_']
+
+
+def remove_nonprintables_per_byte(contents, pred):
+    'The old algorithm: try the replacements for one byte at a time.'
+
+    reduced = b''
+    for i in range(len(contents)):
+        if not contents[i] in PRINTABLE:
+            tail = contents[i+1:]
+            for replacement in REPLACEMENTS:
+                if pred(reduced + replacement + tail):
+                    reduced += replacement
+                    break
+            else:
+                reduced += contents[i:i+1]
+        else:
+            reduced += contents[i:i+1]
+    return reduced
+
+
+def random_case(rnd, count):
+    '''Returns (contents, pred) for a random case with count
+    non-printable bytes, each between two distinct printable markers so
+    that pred() can tell what it was replaced by.'''
+
+    def marker(k):
+        return '<{}>'.format(k).encode('ascii')
+
+    pieces = [marker(0)]
+    accepts = []
+    for k in range(count):
+        byte = bytes([rnd.choice([0, 1, 2, 127, 200])])
+        pieces += [byte, marker(k+1)]
+        accepts.append([x for x in REPLACEMENTS if rnd.random() < 0.5] +
+                       [byte])
+
+    def pred(data):
+        for k, options in enumerate(accepts):
+            start = data.index(marker(k)) + len(marker(k))
+            if data[start:data.index(marker(k+1), start)] not in options:
+                return False
+        return True
+
+    return b''.join(pieces), pred
+
+
+def main():
+    parser = argp.ArgumentParser(
+        description='Compare remove_nonprintables() to the old algorithm.')
+    parser.add_argument('--cases', metavar='N', type=int, default=1000,
+                        help='Check N random cases.')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+                        help='Seed of the random number generator.')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    checked = 0
+    while checked < args.cases:
+        contents, pred = random_case(rnd, rnd.randint(1, 40))
+        old = remove_nonprintables_per_byte(contents, pred)
+        new = remove_nonprintables(contents, pred)
+        if old != new:
+            print('Mismatch for {!r}: {!r} != {!r}'.format(
+                contents, new, old), file=sys.stderr)
+            sys.exit(1)
+        checked += 1
+    print('{} cases OK.'.format(checked), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
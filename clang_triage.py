@@ -1,24 +1,45 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import time
 import multiprocessing as mp
 import argparse as argp
 import shutil
+import queue
+import signal
+import itertools
 
-from triage_db import TriageDb, ReduceResult
+from triage_db import TriageDb, ReduceResult, CODEC_NONE, BLOB_TABLES
 from repository import update_and_build, get_versions, build
-from run_clang import test_input, test_input_reduce
+from repository import seconds_until_update
+from run_clang import test_input, test_input_reduce, clang_digest
+from run_clang import reduce_verdict_cache, case_timeout
 from run_creduce import reduce_one
 from dumb_reduce import dumb_reduce
 from triage_report import refresh_report
+from bisect_regression import bisect_new_failures
+from symbolize import symbolize_pending
+from case_pack import CasePack, sync as sync_case_pack
 
 from config import TRIAGE_EXTRA_CLANG_PARAMS, BZIP2_COMMAND
-from config import LLVM_SYMBOLIZER_MISSING_IS_FATAL
+from config import LLVM_SYMBOLIZER_MISSING_IS_FATAL, BISECT_ENABLED
+from config import BISECT_TIME_LIMIT
+from config import REDUCE_CORES, REDUCE_CORES_PER_JOB, REDUCE_LEASE_TIME
+from config import RAW_LLVM_SYMBOLIZER_PATH, LLVM_SYMBOLIZER
+from config import TEST_CHUNK_SIZE, TEST_PENDING_CHUNKS, CASE_PACK_DIR
 
 
 REDUCES_SINCE_REPORT = 0
 
+# {kind of blob: (codec id, last key)} of the recompression done in idle
+# time; a None key means that all blobs of the kind use the codec.
+RECOMPRESSED = {}
+
+# {id: Codec} and the CasePack, set in test workers by init_test_worker()
+WORKER_CODECS = None
+WORKER_PACK = None
+
 
 def maybe_refresh_report(unconditional=False):
     '''Refresh the XHTML report if either unconditional is True or new
@@ -31,39 +52,149 @@ def maybe_refresh_report(unconditional=False):
         REDUCES_SINCE_REPORT = 0
 
 
-def reduce_worker_one_iter(db, versions):
-    'Fetch reduce work and process it. Returns True if there was work.'
-
-    global REDUCES_SINCE_REPORT
+def reduce_case(work):
+    '''Reduce a (sha, contents) pair. To be run in the reduce pool.
+    Returns (sha, ReduceResult, reduced contents, original size).'''
 
-    work = db.getReduceWork()
-    if not work:
-        maybe_refresh_report()
-        return False
     sha, contents = work
-    print('Running creduce for ' + sha + '... ', file=sys.stderr, end='')
-    sys.stderr.flush()
     crash = test_input_reduce(contents)[0]
     assert test_input(contents, [])[0] == crash
     if not crash:
-        print('Input does not crash.', file=sys.stderr)
-        db.addReduced(versions, sha, ReduceResult.no_crash)
-        REDUCES_SINCE_REPORT += 1
-        return True
+        return sha, ReduceResult.no_crash, None, len(contents)
     reduced = reduce_one(contents, crash)
     if not reduced is None:
-        print('reduced {} -> {} bytes.'.format(len(contents), len(reduced)),
-              file=sys.stderr)
-        db.addReduced(versions, sha, ReduceResult.ok, reduced)
+        return sha, ReduceResult.ok, reduced, len(contents)
+    # creduce failed, run dumb reduce that does not fail
+    before = reduce_verdict_cache().local_stats()
+    reduced = dumb_reduce(contents, jobs=REDUCE_CORES_PER_JOB)
+    print('Dumb reducer: ' + reduce_verdict_cache().stats_str(before),
+          file=sys.stderr)
+    return sha, ReduceResult.dumb, reduced, len(contents)
+
+
+def add_reduced(db, versions, sha, result, reduced, size):
+    'Record the result of reduce_case().'
+
+    global REDUCES_SINCE_REPORT
+
+    if result == ReduceResult.no_crash:
+        print('{}: Input does not crash.'.format(sha), file=sys.stderr)
     else:
-        # creduce failed, run dumb reduce that does not fail
-        print('Running dumb reducer...', file=sys.stderr)
-        reduced = dumb_reduce(contents)
-        print('reduced {} -> {} bytes.'.format(len(contents), len(reduced)),
-              file=sys.stderr)
-        db.addReduced(versions, sha, ReduceResult.dumb, reduced)
-        REDUCES_SINCE_REPORT += 1
-    return True
+        print('{}: {} reduced {} -> {} bytes.'.format(
+            sha, 'creduce' if result == ReduceResult.ok else 'dumb reducer',
+            size, len(reduced)), file=sys.stderr)
+    db.addReduced(versions, sha, result, reduced)
+    REDUCES_SINCE_REPORT += 1
+
+
+def init_reduce_worker():
+    '''Initialize a reduce worker. The pool terminates its workers with
+    SIGTERM; exit cleanly then, so that creduce is killed and its
+    temporary directory removed.'''
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+
+def run_reduce_pool(db, versions, jobs, deadline=None):
+    '''Keep up to jobs reductions running in parallel until the reduce
+    queue is empty or, if given, time.time() passes deadline; the
+    reductions running at the deadline are let finish. Each result is
+    recorded as soon as it is ready. A reduction still running past its
+    lease (for example because its worker was killed) is abandoned and
+    its case released. Returns True if there was work.'''
+
+    any_work = False
+    done = queue.Queue()
+    # {sha: lease expiry} of the reductions running
+    running = {}
+
+    def failed(sha, e):
+        # The case is handed out again when its lease expires.
+        print('Reduction of {} failed: {!r}'.format(sha, e), file=sys.stderr)
+        done.put((sha, None))
+
+    with mp.Pool(jobs, initializer=init_reduce_worker) as pool:
+        while True:
+            while len(running) < jobs and (deadline is None or
+                                           time.time() < deadline):
+                work = db.getReduceWork()
+                if not work:
+                    break
+                sha = work[0]
+                print('Reducing {} ({} running)...'.format(
+                    sha, len(running) + 1), file=sys.stderr)
+                running[sha] = time.time() + REDUCE_LEASE_TIME
+                pool.apply_async(
+                    reduce_case, (work, ),
+                    callback=lambda res: done.put((res[0], res)),
+                    error_callback=lambda e, sha=sha: failed(sha, e))
+                any_work = True
+            if not running:
+                break
+            try:
+                sha, res = done.get(timeout=1)
+            except queue.Empty:
+                now = time.time()
+                for sha in [x for x in running if running[x] < now]:
+                    print('Abandoning the reduction of {}, its lease '
+                          'expired.'.format(sha), file=sys.stderr)
+                    db.releaseReduceWork([sha])
+                    del running[sha]
+                continue
+            if running.pop(sha, None) is None:
+                # abandoned, and the case may have been handed out again
+                continue
+            if res:
+                add_reduced(db, versions, *res)
+
+    if not any_work:
+        maybe_refresh_report()
+    return any_work
+
+
+def reduce_jobs():
+    'Number of parallel reductions in the core budget.'
+
+    return max(1, REDUCE_CORES // REDUCE_CORES_PER_JOB)
+
+
+def recompress_blobs(db, deadline):
+    '''Recompress the blobs not compressed with the current codecs until
+    time.time() passes deadline, continuing where the last call left
+    off. Returns True if there was work.'''
+
+    # pick up codecs trained since, so as not to recompress back
+    db.reloadCodecs()
+    any_work = False
+    for kind in sorted(BLOB_TABLES):
+        codec_id = db.codec(kind).id
+        done_id, start = RECOMPRESSED.get(kind, (None, None))
+        if done_id == codec_id and start is None:
+            continue
+        if done_id != codec_id:
+            start = None
+        num, before, after, last = db.recompressBlobs(
+            kind, start=start, deadline=deadline)
+        RECOMPRESSED[kind] = codec_id, last
+        if num:
+            print('Recompressed {} {} blobs: {:.1f} MB -> {:.1f} MB'.format(
+                num, kind, before/1e6, after/1e6), file=sys.stderr)
+            any_work = True
+        if last is not None:
+            return True
+    return any_work
+
+
+def idle_work(db, versions):
+    '''Do work while waiting to update: bisect new failures, reduce and
+    recompress blobs, until the time to update. Returns True if there
+    was work.'''
+
+    deadline = time.time() + seconds_until_update()
+    if BISECT_ENABLED and bisect_new_failures(db, deadline):
+        return True
+    if run_reduce_pool(db, versions, reduce_jobs(), deadline):
+        return True
+    return recompress_blobs(db, deadline)
 
 
 def update_and_check_if_should_run(db):
@@ -71,7 +202,7 @@ def update_and_check_if_should_run(db):
     already been tested.'''
 
     versions = get_versions()
-    idle_func = lambda: reduce_worker_one_iter(db, versions)
+    idle_func = lambda: idle_work(db, versions)
     if not update_and_build(idle_func):
         print('Update or build failed. Skipping test.', file=sys.stderr)
         return False
@@ -90,10 +221,72 @@ def update_and_check_if_should_run(db):
     return True
 
 
-def triage_test_func(sha_data):
-    'A test function to be run by the worker threads.'
-    return (sha_data[0],
-            test_input(sha_data[1], TRIAGE_EXTRA_CLANG_PARAMS))
+def triage_test_func(case):
+    '''A test function to be run by the worker threads. case is (sha,
+    data, timeout). Returns (sha, (crash, output), runtime).'''
+    sha, data, timeout = case
+    start = time.monotonic()
+    result = test_input(data, TRIAGE_EXTRA_CLANG_PARAMS,
+                        [os.path.abspath(RAW_LLVM_SYMBOLIZER_PATH)],
+                        timeout=timeout)
+    return sha, result, time.monotonic() - start
+
+
+def init_test_worker(codecs, pack_path=None):
+    '''Initialize a test worker with the {id: Codec} dict of codecs and
+    the case pack in pack_path, if any.'''
+    global WORKER_CODECS, WORKER_PACK
+    WORKER_CODECS = codecs
+    if pack_path:
+        WORKER_PACK = CasePack(pack_path)
+
+
+def triage_test_chunk(chunk):
+    '''Run triage_test_func() on a chunk of compressed cases in a test
+    worker. chunk is a list of (sha, codec id, compressed data,
+    timeout). Returns a list of (sha, (crash, output), runtime).'''
+    return [triage_test_func((sha, WORKER_CODECS[codec].decompress(blob),
+                              timeout))
+            for sha, codec, blob, timeout in chunk]
+
+
+def triage_pack_chunk(chunk):
+    '''Like triage_test_chunk(), but for cases in the case pack, which
+    are passed to clang straight from the mmapped pack. chunk is a list
+    of (sha, offset, length, timeout).'''
+    return [triage_test_func((sha, WORKER_PACK.slice(offset, length),
+                              timeout))
+            for sha, offset, length, timeout in chunk]
+
+
+def bounded_imap_unordered(pool, func, iterable, max_pending):
+    '''Like pool.imap_unordered(func, iterable), but take at most
+    max_pending items from iterable ahead of the results consumed. The
+    tasks are submitted from the consuming thread, so nothing blocks
+    the pool from being terminated if the consumer stops.'''
+
+    results = queue.Queue()
+    items = iter(iterable)
+    exhausted = False
+    pending = 0
+    while True:
+        while not exhausted and pending < max_pending:
+            try:
+                x = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            pool.apply_async(
+                func, (x, ), callback=lambda r: results.put((True, r)),
+                error_callback=lambda e: results.put((False, e)))
+            pending += 1
+        if not pending:
+            return
+        ok, result = results.get()
+        pending -= 1
+        if not ok:
+            raise result
+        yield result
 
 
 def test_iter(start_from_current=False):
@@ -107,7 +300,13 @@ def test_iter(start_from_current=False):
             start_from_current = False
 
     if not start_from_current:
-        if not update_and_check_if_should_run(db):
+        # Resume an interrupted test run if we still have its versions
+        # checked out.
+        resume = (db.getUnfinishedTestRunVersions() == get_versions()
+                  and build())
+        if resume:
+            print('Resuming an interrupted test run...', file=sys.stderr)
+        elif not update_and_check_if_should_run(db):
             return False
 
     versions = get_versions()
@@ -115,32 +314,86 @@ def test_iter(start_from_current=False):
     # FIXME: If we at some point support concurrent test runners, there is a
     # race between checking version and starting the test run.
     numCases = db.getNumberOfCases()
-    with db.testRun(versions) as run:
-        i = 1
+    digest = clang_digest(TRIAGE_EXTRA_CLANG_PARAMS)
+    with db.testRun(versions, digest) as run:
+        if run.copied_from:
+            print('Binary identical to the one in test run #{}, '
+                  'reusing its results.'.format(run.copied_from),
+                  file=sys.stderr)
+        if run.done:
+            print('{} cases already tested in this run, skipping them.'.format(
+                len(run.done)), file=sys.stderr)
+        runtimes = db.getCaseRuntimes()
+        codecs = db.getCodecs()
+
+        def db_cases():
+            # The cases are decompressed by the workers, unless their
+            # codec is newer than the workers'.
+            for sha, codec, blob in db.iterateCases(compressed=True):
+                if sha in run.done:
+                    continue
+                if not codec in codecs:
+                    codec, blob = CODEC_NONE, db.decompress(codec, blob)
+                yield sha, codec, blob, case_timeout(runtimes.get(sha))
+
+        if CASE_PACK_DIR:
+            shas = db.getCaseShas()
+            sync_case_pack(db, shas)
+            # In the order of the index (by sha1) rather than smallest
+            # first like iterateCases(), so that the records are streamed
+            # from the mmapped index instead of sorted in memory. Cases
+            # deleted from the database stay in the pack but are not
+            # tested.
+            cases = ((sha, offset, length, case_timeout(runtimes.get(sha)))
+                     for sha, offset, length in CasePack().records()
+                     if sha in shas and not sha in run.done)
+            chunk_func = triage_pack_chunk
+        else:
+            cases = db_cases()
+            chunk_func = triage_test_chunk
+
+        def chunks():
+            it = iter(cases)
+            while True:
+                chunk = list(itertools.islice(it, TEST_CHUNK_SIZE))
+                if not chunk:
+                    return
+                yield chunk
+
+        i = len(run.done) + 1
         numBad = 0
-        with mp.Pool() as pool:
-            for sha, (crash, output) in pool.imap_unordered(
-                    triage_test_func, db.iterateCases()):
-                if not crash:
-                    reason = 'OK'
-                    output = None
-                else:
-                    reason = crash.reason
-                    numBad += 1
-                print('\r{curr}/{max}  {nbad} bad ({prop:.1%})'.format(
-                    curr=i, max=numCases, nbad=numBad,
-                    prop=numBad/i), end='', file=sys.stderr)
-                i += 1
-
-                run.addResult(sha, reason, output)
+        jobs = os.cpu_count()
+        with mp.Pool(jobs, initializer=init_test_worker,
+                     initargs=(codecs, CASE_PACK_DIR)) as pool:
+            results = bounded_imap_unordered(
+                pool, chunk_func, chunks(), TEST_PENDING_CHUNKS * jobs)
+            for chunk in results:
+                for sha, (crash, output), runtime in chunk:
+                    if not crash:
+                        reason = 'OK'
+                        output = None
+                    else:
+                        reason = crash.reason
+                        numBad += 1
+                    print('\r{curr}/{max}  {nbad} bad ({prop:.1%})'.format(
+                        curr=i, max=numCases, nbad=numBad,
+                        prop=numBad/i), end='', file=sys.stderr)
+                    i += 1
+
+                    run.addResult(sha, reason, output, runtime)
         print(file=sys.stderr)
+        run.flush()
+        symbolize_pending(db)
+
+    if BISECT_ENABLED:
+        bisect_new_failures(db, time.time() + BISECT_TIME_LIMIT)
 
 
 def check_prereqs():
     WARN = [('psql', 'Schema creation will not work.')]
 
     if not LLVM_SYMBOLIZER_MISSING_IS_FATAL:
-        WARN.append(('llvm-symbolizer',
+        WARN.append((LLVM_SYMBOLIZER,
                      'Recorded outputs may be less useful.'))
 
     for prog, warn in WARN:
@@ -151,7 +404,7 @@ def check_prereqs():
     REQS = ['git', 'ninja', 'creduce', 'timeout', 'tar', BZIP2_COMMAND]
 
     if LLVM_SYMBOLIZER_MISSING_IS_FATAL:
-        REQS.append('llvm-symbolizer')
+        REQS.append(LLVM_SYMBOLIZER)
 
     err = False
     for prog in REQS:
@@ -180,8 +433,20 @@ def main():
         '--start-from-current', action='store_true',
         help='Run test immediately once after git pull even if this '
         'version has already been tested.')
+    parser.add_argument(
+        '--reduce-only', action='store_true',
+        help='Only reduce cases from the reduce queue; do not update, '
+        'build or test. Several of these may be run against the same '
+        'database.')
     args = parser.parse_args()
 
+    if args.reduce_only:
+        db = TriageDb()
+        while True:
+            if not run_reduce_pool(db, get_versions(), reduce_jobs()):
+                print('Reduce queue empty, sleeping...', file=sys.stderr)
+                time.sleep(60)
+
     start_from_current = args.start_from_current
 
     while True:
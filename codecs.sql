@@ -0,0 +1,12 @@
+-- Compression methods of blobs (see triage_db.Codec). Blob rows have
+-- the id of the codec they were compressed with. Codecs with a
+-- dictionary are trained on a sample of the kind ('cases', 'outputs' or
+-- 'reduced') of blobs they are for (see recompress_blobs.py).
+CREATE TABLE codecs (
+    id SMALLINT PRIMARY KEY,
+    name TEXT NOT NULL,
+    kind TEXT,
+    dictionary BYTEA,
+    created BIGINT);
+
+INSERT INTO codecs (id, name) VALUES (0, 'none'), (1, 'zlib');
@@ -32,10 +32,25 @@ REPORT_FILENAME = 'triage_report.xhtml'
 # on 8 cores (the default is derived from number of cores available).
 NINJA_PARAMS = []
 
-# seconds; will wait additional this many seconds for it to terminate
-# after SIGTERM and then kill it
+# seconds; clang (with its whole process group) is killed if it runs
+# longer than this, and the result is recorded as a hang. This is the
+# limit for cases with no recorded runtime; see CLANG_TIMEOUT_FACTOR.
 CLANG_TIMEOUT = 4
 
+# In test runs, a case which has run before without hanging gets a time
+# limit of CLANG_TIMEOUT_FACTOR times its last runtime, clamped to
+# [CLANG_TIMEOUT_MIN, CLANG_TIMEOUT_MAX] seconds. The minimum is the old
+# fixed limit, so fast cases do not turn into hangs on a loaded host.
+CLANG_TIMEOUT_FACTOR = 10
+CLANG_TIMEOUT_MIN = 4
+CLANG_TIMEOUT_MAX = 20
+
+# At most this many bytes from the start and the end of clang's output
+# are kept; anything in between is replaced by a marker. The stack dump
+# is at the end.
+CLANG_OUTPUT_HEAD_BYTES = 64 * 1024
+CLANG_OUTPUT_TAIL_BYTES = 256 * 1024
+
 # common for both triage and reduction
 CLANG_PARAMS = ['-Werror', '-ferror-limit=5', '-std=c++11',
                 '-fno-crash-diagnostics', '-xc++', '-c',
@@ -48,6 +63,27 @@ REDUCTION_EXTRA_CLANG_PARAMS = []
 # Extra clang parameters to use when triaging.
 TRIAGE_EXTRA_CLANG_PARAMS = []
 
+# Write test run results to the database in batches of this many
+# cases. An interrupted test run is resumed from the last batch.
+TEST_RUN_BATCH_SIZE = 1000
+
+# Test runs stream cases from the database this many at a time
+CASE_FETCH_SIZE = 2000
+
+# Test runs read the cases from a local pack in this directory (see
+# case_pack.py), which is brought up to date from the database at the
+# start of each run. Several clang-triage instances on a host can share
+# it. If None, the cases are streamed from the database.
+CASE_PACK_DIR = TOP + '/case_pack'
+
+# Cases are handed to the test workers in chunks of this many. At most
+# TEST_PENDING_CHUNKS chunks per worker are queued.
+TEST_CHUNK_SIZE = 16
+TEST_PENDING_CHUNKS = 4
+
+# Import cases to the database in transactions of this many cases
+IMPORT_BATCH_SIZE = 10000
+
 # A map from human-readable names to directories where to run git pull
 PROJECTS = {'llvm': LLVM_SRC, 'clang': LLVM_SRC + '/tools/clang'}
 
@@ -64,9 +100,28 @@ CLANG_BINARY = BUILD + '/bin/clang'
 # Do not do git pull more often than this (seconds)
 MIN_GIT_CHECKOUT_INTERVAL = 10*60
 
+# Cores to use for reducing cases. Several cases are reduced in
+# parallel, each using REDUCE_CORES_PER_JOB cores (creduce's --n).
+REDUCE_CORES = os.cpu_count()
+REDUCE_CORES_PER_JOB = 2
+
+# Reducers remember this many verdicts of the candidates they have
+# tested, so that revisited candidates need not be run again.
+VERDICT_CACHE_SIZE = 100000
+
+# If set, the verdict cache is also stored in an SQLite database in
+# this file and shared by all reductions. Otherwise each CReduce run
+# gets its own for its property checks.
+VERDICT_CACHE_PATH = None
+
 # Give creduce this long to complete before killing it
 CREDUCE_TIMEOUT = 2*60 + 30
 
+# A case taken from the reduce queue is handed out again if it has not
+# been reduced in this many seconds (for example because the reducer
+# died)
+REDUCE_LEASE_TIME = 6*60*60
+
 # Save miscellaneous reports in this dir (for example, outputs from
 # failed clang runs where we couldn't determine the precise reason of
 # failure)
@@ -78,20 +133,89 @@ MISC_REPORT_SAVE_DIR = 'saved'
 # will be downgraded from fatal error to a warning.
 LLVM_SYMBOLIZER_MISSING_IS_FATAL = True
 
+# Test runs do not symbolize stack dumps; new outputs are symbolized
+# after each run using this llvm-symbolizer (see symbolize.py). The
+# one next to CLANG_BINARY is used instead if it has been built.
+LLVM_SYMBOLIZER = 'llvm-symbolizer'
+
+# Symbolize outputs in batches of this many
+SYMBOLIZE_BATCH_SIZE = 1000
+
+
+# Run the clang frontend (clang -cc1) directly instead of through the
+# driver, which saves a process per test. The frontend command line is
+# taken from clang -### once per build. If the driver would run other
+# jobs than the frontend, the driver is used anyway.
+CLANG_DIRECT_CC1 = True
+
+# Extra crash signatures as (pattern, reason) pairs, where pattern is a
+# bytes regex matched against clang's output and reason the resulting
+# failure reason, or None to use the output from the match to the end
+# of the line. These take priority over the builtin signatures in
+# run_clang.BUILTIN_CRASH_RULES.
+EXTRA_CRASH_RULES = []
+
+# New failure reasons are bisected to the first bad svn revision. This
+# is done in separate checkouts and build directory so that the ones
+# above are not disturbed; see README for how to set them up. Set
+# BISECT_ENABLED to False to disable bisection.
+BISECT_ENABLED = True
+BISECT_TOP = TOP + '/bisect'
+BISECT_PROJECTS = {'llvm': BISECT_TOP + '/llvm.src',
+                   'clang': BISECT_TOP + '/llvm.src/tools/clang'}
+BISECT_BUILD = BISECT_TOP + '/clang-triage.ninja'
+
+# Clang binaries built for bisection are kept here so that they can be
+# reused by later bisections. At most BISECT_CACHE_MAX_BUILDS builds are
+# kept; least recently used ones are removed first.
+BISECT_CACHE_DIR = BISECT_TOP + '/cache'
+BISECT_CACHE_MAX_BUILDS = 50
+
+# After a test run, bisect for at most this many seconds (checked before
+# each build) before updating again. Bisections left unfinished are
+# continued after the next test run or in idle time.
+BISECT_TIME_LIMIT = 60*60
+
 
 ##### Generally you should not need to change anything below this.
 
 
 CREDUCE_PROPERTY_SCRIPT = 'check_creduce_property.py'
 
+# If True, property checks are done by a server in the reducing process
+# (see property_server.py) and CReduce runs this lightweight client
+# instead of CREDUCE_PROPERTY_SCRIPT.
+CREDUCE_PROPERTY_SERVER = True
+CREDUCE_PROPERTY_CLIENT = 'check_creduce_property_client.py'
+
 # This path is used to disable llvm-symbolizer. It should contain a
 # symlink named llvm-symbolizer pointing to /bin/false.
 DUMMY_LLVM_SYMBOLIZER_PATH = 'dummy-llvm-symbolizer'
 
+# This path is used in test runs to make clang print its stack frames
+# unsymbolized as (module+offset), so they can be symbolized later. It
+# should contain an llvm-symbolizer which answers ?? for everything.
+RAW_LLVM_SYMBOLIZER_PATH = 'raw-llvm-symbolizer'
+
+# Compress case contents, outputs and reduced cases with this codec:
+# 'none', 'zlib', or 'zlib-dict' or 'zstd-dict' to compress with a
+# dictionary trained on a sample of the database. Until
+# recompress_blobs.py has trained a dictionary for a kind of blob, they
+# are compressed with zlib. zstd-dict needs the zstandard module. Blobs
+# compressed with any codec stay readable.
+BLOB_CODEC = 'zlib-dict'
+
+# Train compression dictionaries on this many blobs
+CODEC_TRAIN_SAMPLES = 10000
+
+# Maximum size of a compression dictionary in bytes. zlib uses at most
+# 32 KiB.
+CODEC_DICT_SIZE = 32*1024
+
+# Recompress blobs in transactions of this many
+RECOMPRESS_BATCH_SIZE = 1000
+
 # Postgresql command to create schema.
 CREATE_SCHEMA_COMMAND = [
     'psql', '-v', 'ON_ERROR_STOP=1', '--quiet', '-d', DB_NAME,
     '-f', 'create_schema.sql']
-
-# timeout from GNU coreutils
-CLANG_TIMEOUT_CMD = ['timeout', '-k', str(CLANG_TIMEOUT), str(CLANG_TIMEOUT)]
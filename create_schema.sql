@@ -1,15 +1,18 @@
+\i codecs.sql
 \i case_view.sql
 \i reduce.sql
 \i test_runs.sql
+\i bisect.sql
 
 CREATE TABLE params (
     name TEXT PRIMARY KEY,
     value TEXT NOT NULL);
 
-INSERT INTO params VALUES ('schema_version', 2);
+INSERT INTO params VALUES ('schema_version', 15);
 
 CREATE VIEW last_2_runs_view AS
     SELECT id FROM test_runs
+    WHERE NOT in_progress
     ORDER BY id DESC LIMIT 2;
 
 CREATE VIEW last_run_results AS
@@ -25,3 +28,23 @@ CREATE VIEW changed_results AS
         last.result AS new, second.result AS old
     FROM last_run_results AS last, second_last_run_results AS second
     WHERE last.case_id=second.case_id AND last.result<>second.result;
+
+-- Failing cases waiting to be reduced, maintained by test runs and
+-- TriageDb.addReduced(). Lower priority is reduced first: 0 = no case
+-- with the same result has been reduced, 1 = no case in the same
+-- (result, stack fingerprint) bucket has been reduced, 2 = others.
+CREATE TABLE reduce_queue (
+    case_id BIGINT PRIMARY KEY REFERENCES cases(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    result BIGINT NOT NULL REFERENCES result_strings(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    fingerprint TEXT,
+    priority SMALLINT NOT NULL,
+    size INTEGER NOT NULL,
+    -- the case is being reduced by leased_by until lease_expires (unix
+    -- time); expired leases are handed out again
+    leased_by TEXT,
+    lease_expires BIGINT);
+CREATE INDEX reduce_queue_order ON reduce_queue(priority, size, case_id);
+CREATE INDEX reduce_queue_result ON reduce_queue(result);
+CREATE INDEX reduce_queue_fingerprint ON reduce_queue(fingerprint);
@@ -3,58 +3,238 @@
 # Standalone, this can be used a dumb reducer of crashing test cases
 # given as stdin.
 
-from run_clang import test_input
+from run_clang import test_input, reduce_verdict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
 import sys
+import itertools
 
 SANITY_CHECKS = True
 
 
-def remove_elem_iter(data, pred):
-    '''Remove one element from the data, which may be a list or a string.
-    If pred is still true for the reduced data, accept it. Repeat
-    until minimal. Yield progressively minimized results.'''
+def line_units(data):
+    'Split data to lines (including the newline) as (start, end) ranges.'
 
-    if SANITY_CHECKS:
-        assert pred(data)
-    curr = 0
-    elems_since_last = 0
-    while elems_since_last < len(data) and data:
-        n = data[:curr] + data[curr+1:]
-        if pred(n):
-            yield n
-            data = n
-            elems_since_last = 0
-        else:
-            curr += 1
-            elems_since_last += 1
-        if curr == len(data):
-            curr = 0
+    units = []
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start)
+        end = len(data) if end == -1 else end + 1
+        units.append((start, end))
+        start = end
+    return units
 
 
-def unlines(xs):
-    'Join xs (list of bytes) by a newline.'
+def byte_units(data):
+    'Split data to bytes as (start, end) ranges.'
 
-    return b'\n'.join(xs)
+    return [(i, i+1) for i in range(len(data))]
 
 
-def compose(f, g):
-    'Composed function (f . g). compose(f, g)(x) = f(g(x)).'
+def join_units(view, units):
+    '''Build a candidate from a memoryview of the data and the (start,
+    end) ranges to keep. Adjacent ranges are coalesced so that data is
+    copied only once.'''
+
+    spans = []
+    for start, end in units:
+        if spans and spans[-1][1] == start:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+    return b''.join(view[start:end] for start, end in spans)
 
-    return lambda *rest, **kw: f(g(*rest, **kw))
 
+def ddmin_iter(data, units, pred, jobs=1):
+    '''Minimize data with the ddmin algorithm: split the units (a list
+    of (start, end) ranges of data) into n chunks and try removing each
+    chunk, starting from halves and doubling n when nothing can be
+    removed. A candidate is the units without the chunk (lo, hi), and
+    is only built when it is tested. Up to jobs candidates are tested in
+    parallel. Yield progressively minimized results; the last one is
+    1-minimal: removing any single unit makes pred false.'''
 
-def remove_lines(data, pred):
+    if SANITY_CHECKS:
+        assert pred(data)
+    view = memoryview(data)
+
+    def test(chunk):
+        lo, hi = chunk
+        return pred(join_units(view, itertools.chain(
+            itertools.islice(units, lo), itertools.islice(units, hi, None))))
+
+    n = min(2, len(units))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while units:
+            bounds = [len(units) * i // n for i in range(n + 1)]
+            found = None
+            # Test in batches so that we don't run too far ahead of
+            # the first success.
+            for i in range(0, n, jobs):
+                batch = [(bounds[j], bounds[j+1])
+                         for j in range(i, min(i + jobs, n))]
+                for chunk, ok in zip(batch, executor.map(test, batch)):
+                    if ok:
+                        found = chunk
+                        break
+                if found is not None:
+                    break
+            if found is not None:
+                units = units[:found[0]] + units[found[1]:]
+                yield join_units(view, units)
+                n = min(max(n - 1, 2), len(units))
+            elif n < len(units):
+                n = min(2 * n, len(units))
+            else:
+                break
+
+
+# A lightweight C/C++ lexer. It never fails: unterminated comments and
+# literals extend to the end of the input or line, and anything else is
+# a single-byte token.
+TOKEN_RE = re.compile(rb"""
+      (?P<space> \s+ )
+    | (?P<comment> //[^\n]* | /\*.*?(?:\*/|\Z) )
+    | (?P<literal> "(?:\\.|[^"\\\n])*"? | '(?:\\.|[^'\\\n])*'? )
+    | (?P<directive> \#[^\n]* )
+    | (?P<word> \w+ )
+    | (?P<punct> . )""", re.VERBOSE | re.DOTALL)
+
+OPENERS = {b'(': b')', b'[': b']', b'{': b'}'}
+CLOSERS = {b')': b'(', b']': b'[', b'}': b'{'}
+
+
+def tokenize(data):
+    '''Return the significant tokens of data (no whitespace or comments)
+    as (start, end, kind) tuples. For punctuation, kind is the byte
+    itself.'''
+
+    tokens = []
+    for m in TOKEN_RE.finditer(data):
+        kind = m.lastgroup
+        if kind in ('space', 'comment'):
+            continue
+        if kind == 'punct':
+            kind = m.group()
+        tokens.append((m.start(), m.end(), kind))
+    return tokens
+
+
+def structure(data):
+    '''Find the structure of C/C++ code in data. Returns (decl_ends,
+    spans), where decl_ends are the end offsets of top-level
+    declarations and spans a list of (start, end) ranges of balanced
+    ()/[]/{} regions, their contents and statements. Unbalanced brackets
+    are tolerated.'''
+
+    decl_ends = []
+    spans = set()
+    # (opener, start offset, start of the enclosing statement)
+    stack = []
+    stmt = None
+    for start, end, kind in tokenize(data):
+        if stmt is None and not kind in CLOSERS:
+            stmt = start
+        if kind in OPENERS:
+            stack.append((kind, start, stmt))
+            stmt = None
+        elif kind in CLOSERS:
+            openers = [x[0] for x in stack]
+            if not CLOSERS[kind] in openers:
+                # stray closer
+                continue
+            while stack[-1][0] != CLOSERS[kind]:
+                stack.pop()
+            opener, open_start, stmt = stack.pop()
+            spans.add((open_start, end))
+            spans.add((open_start + 1, start))
+            if kind == b'}':
+                # a block ends the statement containing it
+                if stmt is not None:
+                    spans.add((stmt, end))
+                stmt = None
+                if not stack:
+                    decl_ends.append(end)
+        elif kind == b';':
+            if stack and stack[-1][0] != b'{':
+                # for (;;)
+                continue
+            if stmt is not None:
+                spans.add((stmt, end))
+            stmt = None
+            if not stack:
+                decl_ends.append(end)
+    spans = [x for x in spans if x[1] > x[0]]
+    return decl_ends, spans
+
+
+def remove_decls(data, pred, jobs=1):
+    '''Minimize by removing top-level declarations. Yield progressively
+    smaller results.'''
+
+    bounds = [0] + structure(data)[0] + [len(data)]
+    units = [(bounds[i], bounds[i+1]) for i in range(len(bounds) - 1)
+             if bounds[i+1] > bounds[i]]
+    return ddmin_iter(data, units, pred, jobs)
+
+
+def remove_spans(data, pred, jobs=1):
+    '''Minimize by removing balanced regions, their contents and
+    statements, largest first. Yield progressively smaller results.'''
+
+    def key(span):
+        return span[0] - span[1], span[0]
+
+    # The spans are tried in one pass in the order of key(). After a
+    # removal the structure is recomputed and the pass resumes from the
+    # removed span's place, so spans that were tried before it are not
+    # retried even though the removal might now let them go.
+    resume = key((0, len(data)))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            view = memoryview(data)
+            spans = sorted((x for x in structure(data)[1]
+                            if key(x) >= resume), key=key)
+            found = None
+            for i in range(0, len(spans), jobs):
+                batch = spans[i:i+jobs]
+                candidates = [join_units(view, [(0, a), (b, len(data))])
+                              for a, b in batch]
+                for span, candidate, ok in zip(
+                        batch, candidates, executor.map(pred, candidates)):
+                    if ok:
+                        found = span, candidate
+                        break
+                if found:
+                    break
+            if not found:
+                break
+            span, data = found
+            resume = key(span)
+            yield data
+
+
+def remove_structures(data, pred, jobs=1):
+    '''Minimize by removing top-level declarations, then smaller
+    structures. Yield progressively smaller results.'''
+
+    for data in remove_decls(data, pred, jobs):
+        yield data
+    for data in remove_spans(data, pred, jobs):
+        yield data
+
+
+def remove_lines(data, pred, jobs=1):
     'Minimize by removing lines. Yield progressively smaller results.'
 
-    data = data.split(b'\n')
-    return (unlines(x)
-            for x in remove_elem_iter(data, compose(pred, unlines)))
+    return ddmin_iter(data, line_units(data), pred, jobs)
 
 
-def remove_bytes(data, pred):
+def remove_bytes(data, pred, jobs=1):
     'Minimize by removing bytes. Yield progressively smaller results.'
 
-    return remove_elem_iter(data, pred)
+    return ddmin_iter(data, byte_units(data), pred, jobs)
 
 
 def verbose_pred(reason):
@@ -66,25 +246,31 @@ def verbose_pred(reason):
     return pred
 
 
-def dumb_reduce(data, verbose=False):
+def dumb_reduce(data, verbose=False, jobs=1):
     '''Return a 1-byte-minimal case for data. Removing any byte from the
-    result will make it not crash or crash in a different way.'''
+    result will make it not crash or crash in a different way. Up to jobs
+    candidates are tested in parallel.'''
 
-    crash = test_input(data)[0]
+    crash = reduce_verdict(data)
     assert crash
 
-    pred = lambda x: test_input(x)[0] == crash
+    pred = lambda x: reduce_verdict(x) == crash
     #pred = verbose_pred(crash)
 
     if verbose:
         print('Original case: {} bytes'.format(len(data)), file=sys.stderr)
 
     res = data
-    for res in remove_lines(data, pred):
+    for res in remove_structures(data, pred, jobs):
+        if verbose:
+            print('remove_structures: {} bytes'.format(len(res)),
+                  file=sys.stderr)
+    data = res
+    for res in remove_lines(data, pred, jobs):
         if verbose:
             print('remove_lines: {} bytes'.format(len(res)), file=sys.stderr)
     data = res
-    for res in remove_bytes(data, pred):
+    for res in remove_bytes(data, pred, jobs):
         if verbose:
             print('remove_bytes: {} bytes'.format(len(res)), file=sys.stderr)
 
@@ -92,7 +278,8 @@ def dumb_reduce(data, verbose=False):
 
 
 def main():
-    sys.stdout.buffer.write(dumb_reduce(sys.stdin.buffer.read(), verbose=True))
+    sys.stdout.buffer.write(dumb_reduce(sys.stdin.buffer.read(), verbose=True,
+                                        jobs=os.cpu_count()))
 
 
 if __name__ == '__main__':
@@ -6,8 +6,8 @@
 import psycopg2 as pg
 
 from config import DB_NAME
+from triage_db import load_codecs
 import json
-import zlib
 import sys
 
 
@@ -34,10 +34,12 @@ def dump_case_contents(db, fp):
     '''Dump case contents as a newline-separated series of JSON
     objects.'''
 
+    codecs = load_codecs(db)
     with db.cursor() as c:
-        c.execute('SELECT id, z_contents FROM case_view ORDER BY id')
-        for id_, z_contents in c:
-            res = {'id': id_, 'contents': zlib.decompress(z_contents)}
+        c.execute('SELECT id, codec, z_contents FROM case_view ORDER BY id')
+        for id_, codec, z_contents in c:
+            res = {'id': id_,
+                   'contents': codecs[codec].decompress(z_contents)}
             json.dump({'case': res}, fp, default=bytes_to_json)
             print(file=fp)
 
@@ -75,11 +77,12 @@ def dump_reduced_contents(db, fp):
     '''Dump reduced case contents as a newline-separated series of JSON
     objects.'''
 
+    codecs = load_codecs(db)
     with db.cursor() as c:
-        c.execute('SELECT reduced_id, contents FROM reduced_contents ' +
-                  '    ORDER BY reduced_id')
-        for id_, contents in c:
-            res = {'id': id_, 'contents': bytes(contents)}
+        c.execute('SELECT reduced_id, codec, contents ' +
+                  'FROM reduced_contents ORDER BY reduced_id')
+        for id_, codec, contents in c:
+            res = {'id': id_, 'contents': codecs[codec].decompress(contents)}
             json.dump({'reduced_case': res}, fp, default=bytes_to_json)
             print(file=fp)
 
@@ -88,11 +91,13 @@ def dump_outputs(db, fp):
     '''Dump clang outputs from failed cases as a newline-separated series
     of JSON objects.'''
 
+    codecs = load_codecs(db)
     with db.cursor() as c:
-        c.execute('SELECT case_id, output FROM outputs ' +
-                  '    ORDER BY case_id')
-        for id_, output in c:
-            res = {'id': id_, 'output': zlib.decompress(output)}
+        c.execute('SELECT o.case_id, b.codec, b.output ' +
+                  'FROM outputs AS o, output_blobs AS b ' +
+                  'WHERE b.sha1=o.output_sha1 ORDER BY o.case_id')
+        for id_, codec, output in c:
+            res = {'id': id_, 'output': codecs[codec].decompress(output)}
             json.dump({'output': res}, fp, default=bytes_to_json)
             print(file=fp)
 
@@ -113,7 +118,7 @@ def dump_results(db, fp):
 
     with db.cursor() as c:
         c.execute('SELECT id, case_id, test_run, result ' +
-                  '    FROM results ORDER BY id')
+                  '    FROM results ORDER BY test_run, case_id')
         for id_, case_id, test_run, result in c:
             res = {'id': id_, 'case_id': case_id, 'test_run': test_run,
                    'result': result}
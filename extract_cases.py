@@ -8,7 +8,7 @@ def extract_cases(path):
     'Make or update a s/h/sha tree of test cases.'
 
     db = TriageDb()
-    make_sha_tree(path, (x[1] for x in db.iterateCases()),
+    make_sha_tree(path, db.getCaseShas(), db.getCases,
                   suffix='.cpp', rm_old=False)
 
 
@@ -10,7 +10,8 @@ def extract_outputs(path):
     db = TriageDb()
     # Unlike cases and reduced cases, we wish to remove old outputs.
     # They vary a lot, and we can't just accumulate them forever.
-    make_sha_tree(path, db.iterateOutputs(), suffix='.txt', rm_old=True)
+    make_sha_tree(path, db.getOutputShas(), db.getOutputBlobs,
+                  suffix='.txt', rm_old=True)
 
 
 def main():
@@ -8,7 +8,7 @@ def extract_reduced(path):
     'Extract all reduced cases to a s/h/sha path.'
 
     db = TriageDb()
-    make_sha_tree(path, db.iterateDistinctReduced(),
+    make_sha_tree(path, db.getReducedShas(), db.getReduced,
                   suffix='.cpp', rm_old=False)
 
 
@@ -1,9 +1,132 @@
 #!/usr/bin/python3
 
 import argparse as argp
-from triage_db import TriageDb, DbNotInitialized
+from triage_db import TriageDb, DbNotInitialized, read_file
+from utils import all_files_recursive
+import multiprocessing as mp
+import threading
+import queue
+import itertools
+import hashlib
+import time
+import os
 import sys
 
+# Files are handed to the workers in chunks of this many
+CHUNK_SIZE = 256
+
+
+def import_worker(known, codec, in_queue, out_queue):
+    '''Read, hash and compress chunks of files from in_queue. Puts
+    (number of files, number of bytes, [(sha1, codec id, compressed
+    contents, size)]) for each chunk to out_queue, leaving out cases in
+    known, and None when done. Unreadable files are skipped; on any
+    other error, the exception is put to out_queue instead.'''
+
+    try:
+        import_chunks(known, codec, in_queue, out_queue)
+    except BaseException as e:
+        out_queue.put(e)
+        raise
+    out_queue.put(None)
+
+
+def import_chunks(known, codec, in_queue, out_queue):
+    'The loop of import_worker().'
+
+    while True:
+        fnames = in_queue.get()
+        if fnames is None:
+            return
+        nbytes = 0
+        cases = []
+        for fname in fnames:
+            try:
+                contents = read_file(fname)
+            except OSError as e:
+                print('\nSkipping {}: {}'.format(fname, e), file=sys.stderr)
+                continue
+            nbytes += len(contents)
+            sha = hashlib.sha1(contents).hexdigest()
+            if not sha in known:
+                cases.append((sha, codec.id, codec.compress(contents),
+                              len(contents)))
+        out_queue.put((len(fnames), nbytes, cases))
+
+
+def import_cases(db, srcdir, jobs, stop_after=None):
+    '''Import the files under srcdir as cases using jobs worker processes
+    to read, hash and compress them. Returns the number of cases
+    added.'''
+
+    # The workers get this by forking.
+    known = db.getCaseShas()
+    print('{} cases in the database.'.format(len(known)), file=sys.stderr)
+
+    ctx = mp.get_context('fork')
+    in_queue = ctx.Queue(4 * jobs)
+    out_queue = ctx.Queue(4 * jobs)
+    workers = [ctx.Process(target=import_worker,
+                           args=(known, db.codec('cases'), in_queue,
+                                 out_queue), daemon=True)
+               for i in range(jobs)]
+    for w in workers:
+        w.start()
+
+    def feed():
+        fnames = all_files_recursive(srcdir)
+        if stop_after:
+            fnames = itertools.islice(fnames, stop_after)
+        while True:
+            chunk = list(itertools.islice(fnames, CHUNK_SIZE))
+            if not chunk:
+                break
+            in_queue.put(chunk)
+        for w in workers:
+            in_queue.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    def new_cases():
+        start = time.time()
+        num_files = num_bytes = 0
+        running = jobs
+        while running:
+            try:
+                r = out_queue.get(timeout=1)
+            except queue.Empty:
+                # A worker killed by a signal cannot tell us.
+                dead = [w for w in workers if w.exitcode]
+                if dead:
+                    raise RuntimeError('Import worker died with exit code '
+                                       '{}'.format(dead[0].exitcode))
+                continue
+            if r is None:
+                running -= 1
+                continue
+            if isinstance(r, BaseException):
+                raise r
+            n, nbytes, cases = r
+            num_files += n
+            num_bytes += nbytes
+            elapsed = max(time.time() - start, 1e-3)
+            print('\r{} files, {:.1f} MB ({:.0f} files/s, {:.1f} MB/s)'.format(
+                num_files, num_bytes/1e6, num_files/elapsed,
+                num_bytes/1e6/elapsed), end='', file=sys.stderr)
+            for case in cases:
+                # duplicates within the imported files
+                if not case[0] in known:
+                    known.add(case[0])
+                    yield case
+        print(file=sys.stderr)
+
+    num_added = db.addCompressedCases(new_cases())
+    feeder.join()
+    for w in workers:
+        w.join()
+    return num_added
+
 
 def main():
     parser = argp.ArgumentParser(
@@ -14,6 +137,10 @@ def main():
                         type=int,
                         help='Stop after importing N cases. ' +
                         'This is probably only useful for testing.')
+    parser.add_argument('--jobs', '-j', metavar='N', type=int,
+                        default=os.cpu_count(),
+                        help='Read, hash and compress files in N ' +
+                        'processes.')
     args = parser.parse_args()
 
     try:
@@ -23,7 +150,8 @@ def main():
         db = TriageDb()
 
     print('Importing cases...', file=sys.stderr)
-    db.populateCases(args.srcdir, stop_after=args.stop_after)
+    n = import_cases(db, args.srcdir, args.jobs, stop_after=args.stop_after)
+    print('Imported {} new cases.'.format(n), file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,59 @@
+# A server which checks CReduce's property (whether buggy.cpp still
+# crashes with the same reason) for check_creduce_property_client.py,
+# so that each CReduce step does not need to start a Python interpreter
+# and import everything.
+
+import os
+import threading
+import socketserver
+from contextlib import contextmanager
+
+from run_clang import reduce_verdict
+
+# Name of the socket in $CLANG_TRIAGE_TMP
+SOCKET_NAME = 'property.sock'
+
+
+class PropertyRequestHandler(socketserver.StreamRequestHandler):
+    '''Reads the directory of a CReduce variant, terminated by a newline,
+    and replies b'0\\n' if buggy.cpp in it is interesting and b'1\\n'
+    otherwise, like the exit status of the property script.'''
+
+    def handle(self):
+        cwd = self.rfile.readline().decode('utf-8').rstrip('\n')
+        try:
+            with open(os.path.join(cwd, 'buggy.cpp'), 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.wfile.write(b'1\n')
+            return
+        crash = reduce_verdict(data)
+        if crash and crash.reason.strip() == self.server.reason:
+            self.wfile.write(b'0\n')
+        else:
+            self.wfile.write(b'1\n')
+
+
+class PropertyServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    'A property server for a crash reason, listening on a Unix socket.'
+
+    daemon_threads = True
+
+    def __init__(self, path, reason):
+        self.reason = reason.strip()
+        super(PropertyServer, self).__init__(path, PropertyRequestHandler)
+
+
+@contextmanager
+def property_server(tmpdir, reason):
+    'Run a PropertyServer in tmpdir in a background thread.'
+
+    server = PropertyServer(os.path.join(tmpdir, SOCKET_NAME), reason)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
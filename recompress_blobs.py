@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Trains compression dictionaries on a sample of the blobs in the
+# database and recompresses the blobs which are not compressed with the
+# current codec (see config.BLOB_CODEC). Can be run while the database is
+# in use. The daemon also recompresses blobs in its idle time, but does
+# not train dictionaries.
+
+import argparse as argp
+import sys
+
+from triage_db import TriageDb, BLOB_TABLES
+
+from config import BLOB_CODEC
+
+
+def recompress(db, kinds, train=False):
+    '''Recompress the blobs of kinds, first training a dictionary for a
+    kind if it has none or if train=True.'''
+
+    for kind in kinds:
+        needs_dict = BLOB_CODEC.endswith('-dict')
+        if needs_dict and (train or db.codec(kind).name != BLOB_CODEC):
+            print('Training a {} dictionary for {}...'.format(
+                BLOB_CODEC, kind), file=sys.stderr)
+            if not db.trainCodec(kind):
+                print('No {} to train on.'.format(kind), file=sys.stderr)
+                continue
+        num, before, after, _ = db.recompressBlobs(kind, progress=True)
+        print('Recompressed {} {} blobs with {}: {:.1f} MB -> '
+              '{:.1f} MB'.format(num, kind, db.codec(kind).name,
+                                 before/1e6, after/1e6), file=sys.stderr)
+
+
+def main():
+    parser = argp.ArgumentParser(
+        description='Recompress blobs in the database with the current ' +
+        'codec.')
+    parser.add_argument('--train', action='store_true',
+                        help='Train new dictionaries even if there are ' +
+                        'ones already.')
+    parser.add_argument('--kind', action='append',
+                        choices=sorted(BLOB_TABLES),
+                        help='Only recompress this kind of blobs. May be ' +
+                        'given several times.')
+    args = parser.parse_args()
+
+    recompress(TriageDb(), args.kind or sorted(BLOB_TABLES), args.train)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,20 +10,28 @@ CREATE TABLE reduced_cases (
 CREATE UNIQUE INDEX reduced_cases_original_versions_unique
 ON reduced_cases (original, clang_version, llvm_version);
 
+-- sha1 and size are those of the uncompressed contents.
 CREATE TABLE reduced_contents (
     reduced_id BIGINT NOT NULL
         REFERENCES reduced_cases(id) ON UPDATE CASCADE ON DELETE CASCADE,
-    contents BYTEA NOT NULL);
+    contents BYTEA NOT NULL,
+    codec SMALLINT NOT NULL DEFAULT 0 REFERENCES codecs(id),
+    sha1 TEXT NOT NULL,
+    size INTEGER NOT NULL);
+CREATE INDEX reduced_contents_reduced_id ON reduced_contents(reduced_id);
+CREATE INDEX reduced_contents_sha1 ON reduced_contents(sha1);
 
 CREATE VIEW unreduced_cases_view AS
-    SELECT sha1, z_contents
+    SELECT sha1, z_contents, id, codec
     FROM case_view AS cv
     WHERE NOT EXISTS (
         SELECT * FROM reduced_cases AS red
         WHERE red.original = cv.id);
 
 CREATE VIEW sha_reduced_view AS
-    SELECT sha1, contents
+    SELECT cases.sha1, contents, codec,
+        reduced_contents.sha1 AS reduced_sha1,
+        reduced_contents.size AS reduced_size
     FROM cases, reduced_cases, reduced_contents
     WHERE cases.id = reduced_cases.original
         AND reduced_cases.id = reduced_contents.reduced_id;
@@ -34,10 +34,7 @@ class CommitInfo(object):
             if line.startswith('git-svn-id: '):
                 self.svn_id = line.split(' ', 1)[1]
 
-        self.svn_revision = None
-        if self.svn_id:
-            url, uuid = self.svn_id.split(' ')
-            self.svn_revision = int(url.split('@')[-1])
+        self.svn_revision = svn_revision_from_body(self.body)
 
     def __str__(self):
         return 'CommitInfo(commit_id={commit_id}, short="{short}")'.format(
@@ -63,6 +60,13 @@ def git_pull(path):
 LAST_UPDATED_TIME = 0
 
 
+def seconds_until_update():
+    'Returns the number of seconds until we may git pull again.'
+
+    elapsed = time.time() - LAST_UPDATED_TIME
+    return MIN_GIT_CHECKOUT_INTERVAL - elapsed
+
+
 def update_all(versions, idle_func=const(False)):
     '''Update repositories if MIN_GIT_CHECKOUT_INTERVAL has passed. If
     not, call idle_func until it has. If idle_func returns False, just
@@ -71,8 +75,7 @@ def update_all(versions, idle_func=const(False)):
     global LAST_UPDATED_TIME
     # run reduce or sleep until we're allowed to update again
     while True:
-        elapsed = time.time() - LAST_UPDATED_TIME
-        left = MIN_GIT_CHECKOUT_INTERVAL - elapsed
+        left = seconds_until_update()
         if left <= 0:
             break
         print('Still {:.1f} seconds to wait before git pull.'.format(
@@ -97,17 +100,75 @@ def get_versions():
     return out
 
 
-def build():
+def build(build_dir=BUILD, targets=[]):
     'Build LLVM/Clang. Returns True on success, False on failure.'
 
     try:
-        subp.check_call(['ninja'] + NINJA_PARAMS, cwd=BUILD)
+        subp.check_call(['ninja'] + NINJA_PARAMS + targets, cwd=build_dir)
     except subp.CalledProcessError:
         print('Ninja build failed.', file=sys.stderr)
         return False
     return True
 
 
+def svn_revision_from_body(body):
+    'Parse the svn revision from a git-svn commit message. May return None.'
+
+    for line in body.splitlines():
+        if line.startswith('git-svn-id: '):
+            url, uuid = line.split(' ', 1)[1].split(' ')
+            return int(url.split('@')[-1])
+
+
+def iterate_svn_commits(path, ref='HEAD'):
+    '''Iterate (svn_revision, commit_id) pairs of commits reachable from
+    ref, newest first. Commits without svn revision are skipped.'''
+
+    CMD = ['git', 'log', '-z', '--format=%H%n%B', ref]
+    with subp.Popen(CMD, stdout=subp.PIPE, cwd=path) as p:
+        buf = b''
+        try:
+            for chunk in iter(lambda: p.stdout.read(1 << 16), b''):
+                buf += chunk
+                *records, buf = buf.split(b'\0')
+                for record in records:
+                    commit_id, body = record.decode(
+                        'utf-8', 'replace').split('\n', 1)
+                    rev = svn_revision_from_body(body)
+                    if rev:
+                        yield rev, commit_id
+        finally:
+            # We are typically not interested in the whole history.
+            p.kill()
+
+
+def svn_commits_between(path, old_rev, new_rev, ref='HEAD'):
+    '''Returns (base_commit, [(svn_revision, commit_id)]), where
+    base_commit is the newest commit with revision <= old_rev and the
+    list contains the commits with old_rev < revision <= new_rev, oldest
+    first. base_commit is None if not found.'''
+
+    commits = []
+    base = None
+    for rev, commit_id in iterate_svn_commits(path, ref):
+        if rev <= old_rev:
+            base = commit_id
+            break
+        if rev <= new_rev:
+            commits.append((rev, commit_id))
+    return base, commits[::-1]
+
+
+def checkout(path, commit_id, fetch_from=None):
+    '''Check out a commit (detached) in a repository, optionally first
+    fetching from another repository.'''
+
+    if fetch_from:
+        subp.check_call(['git', 'fetch', '-q', fetch_from], cwd=path)
+    subp.check_call(['git', 'checkout', '-q', '--detach', commit_id],
+                    cwd=path)
+
+
 def update_and_build(idle_func=const(False)):
     '''Update and build LLVM/Clang. Returns True on success, False on
     failure.'''
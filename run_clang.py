@@ -5,11 +5,22 @@ import copy
 from collections import namedtuple
 import functools
 import re
+import hashlib
+import signal
+import shlex
+import select
+import selectors
 
 from config import MISC_REPORT_SAVE_DIR, CLANG_BINARY
-from config import CLANG_PARAMS, CLANG_TIMEOUT_CMD, PROJECTS
+from config import CLANG_PARAMS, PROJECTS
+from config import CLANG_TIMEOUT, CLANG_TIMEOUT_FACTOR
+from config import CLANG_TIMEOUT_MIN, CLANG_TIMEOUT_MAX
 from config import REDUCTION_EXTRA_CLANG_PARAMS
 from config import DUMMY_LLVM_SYMBOLIZER_PATH, SOURCE_URLS
+from config import EXTRA_CRASH_RULES, VERDICT_CACHE_PATH
+from config import CLANG_DIRECT_CC1
+from config import CLANG_OUTPUT_HEAD_BYTES, CLANG_OUTPUT_TAIL_BYTES
+from verdict_cache import VerdictCache
 
 
 def save_misc_report(prefix, data):
@@ -17,7 +28,7 @@ def save_misc_report(prefix, data):
 
     t = int(time.time())
     if not os.path.isdir(MISC_REPORT_SAVE_DIR):
-        os.path.mkdir(MISC_REPORT_SAVE_DIR)
+        os.mkdir(MISC_REPORT_SAVE_DIR)
     for i in range(-1, 1000):
         fname = os.path.join(MISC_REPORT_SAVE_DIR, '{}-{}'.format(
             prefix, t))
@@ -93,92 +104,443 @@ def path_to_source_url(path):
     return SOURCE_URLS[proj].format(path=fname, lineno=line)
 
 
-class Crash(namedtuple('Crash', ['reason', 'srcloc'])):
+class Crash(namedtuple('Crash', ['reason', 'srcloc', 'signal'])):
     'Information about a crash.'
 
     __slots__ = ()
 
-    def __new__(cls, reason, srcloc=None):
-        return super(Crash, cls).__new__(cls, reason=reason, srcloc=srcloc)
+    def __new__(cls, reason, srcloc=None, signal=None):
+        return super(Crash, cls).__new__(cls, reason=reason, srcloc=srcloc,
+                                         signal=signal)
 
     def url(self):
         '''Returns an URL to the location of the failing part in code in a
         source browser. May return None.'''
 
-        if not srcloc:
+        if not self.srcloc:
             return None
         return path_to_source_url(self.srcloc)
 
 
+class CrashRule(namedtuple('CrashRule', ['pattern', 'reason',
+                                         'save_report', 'signal'])):
+    '''A crash signature. pattern is a bytes regex (without named
+    groups) and reason the resulting crash reason or None to use the
+    output from the match to the end of the line. If signal is given,
+    the rule also matches when clang was killed by that signal; reason
+    must then be given.'''
+
+    __slots__ = ()
+
+    def __new__(cls, pattern, reason=None, save_report=False, signal=None):
+        assert signal is None or reason is not None, pattern
+        return super(CrashRule, cls).__new__(
+            cls, pattern=pattern, reason=reason, save_report=save_report,
+            signal=signal)
+
+
+# In order of priority: if several rules match, the first one wins.
+# The driver reports the signal which killed the frontend in its output;
+# when running the frontend directly, we only see the signal.
+BUILTIN_CRASH_RULES = [
+    CrashRule(rb'Segmentation fault', 'SEGV', signal=signal.SIGSEGV),
+    CrashRule(rb'Illegal instruction', 'Illegal instruction',
+              signal=signal.SIGILL),
+    CrashRule(rb'Assertion '),
+    CrashRule(rb'UNREACHABLE '),
+    CrashRule(rb'terminate called after throwing an instance'),
+    # The output contains a stack dump, but we couldn't determine a
+    # more precise reason for the crash. Save a miscellaneous report.
+    CrashRule(rb'Stack dump:', 'Stack dump found', save_report=True)
+]
+
+
 # This assumes that the paths do not have spaces or colons. The output
 # is not really foolproofly machine parseable.
 SRCPOS_RE = re.compile(rb' (?P<path>/[^ :]+):(?P<lineno>\d+)(:(?P<col>\d+))?')
 
-def find_crash_location(output):
-    'Find path:srcloc to the crash. May return None.'
-
-    # Right now only works for assertion failures and UNREACHABLE.
+def find_srcloc(line):
+    'Find path:lineno[:col] in a line of output. May return None.'
+
+    m = SRCPOS_RE.search(line)
+    if m:
+        path = m.group('path') + b':' + m.group('lineno')
+        if m.group('col'):
+            path += b':' + m.group('col')
+        return path.decode('utf-8', 'replace')
+
+
+class CrashClassifier(object):
+    '''Classifies clang outputs by a table of CrashRules. All the rules
+    are compiled into a single regex, so the output is scanned only
+    once. The patterns must not match across lines.'''
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.regex = re.compile(b'|'.join(
+            b'(?P<r%d>%s)' % (i, rule.pattern)
+            for i, rule in enumerate(rules)))
+        # {signal: index of the first rule matching it}
+        self.signal_rules = {}
+        for i, rule in reversed(list(enumerate(rules))):
+            if rule.signal:
+                self.signal_rules[rule.signal] = i
+
+    def scanner(self):
+        'Get a CrashScanner to classify an output incrementally.'
+        return CrashScanner(self)
+
+    def classify(self, output, retval):
+        '''Returns (crash, rule) for the output and return value of a
+        clang run. crash is None if there was no crash; rule is the
+        matching CrashRule or None.'''
+
+        scanner = self.scanner()
+        scanner.feed(output)
+        return scanner.finish(retval)
+
+
+class CrashScanner(object):
+    '''Classifies an output fed to it in chunks, as it is read. Only
+    complete lines are scanned, except that a line longer than MAX_LINE
+    is scanned in pieces.'''
+
+    MAX_LINE = 1 << 16
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+        # {rule index: (matched text to the end of line, line)} of the
+        # first match of each rule
+        self.first = {}
+        self.partial = b''
+        self.done = False
+
+    def __scan(self, text):
+        for m in self.classifier.regex.finditer(text):
+            i = int(m.lastgroup[1:])
+            if not i in self.first:
+                line_start = text.rfind(b'\n', 0, m.start()) + 1
+                line_end = text.find(b'\n', m.start())
+                if line_end == -1:
+                    line_end = len(text)
+                self.first[i] = (text[m.start():line_end],
+                                 text[line_start:line_end])
+                if i == 0:
+                    # cannot get any better
+                    self.done = True
+                    return
+
+    def feed(self, chunk):
+        'Scan the next chunk of the output.'
+
+        if self.done:
+            return
+        data = self.partial + chunk
+        end = data.rfind(b'\n') + 1
+        if not end and len(data) > self.MAX_LINE:
+            end = len(data)
+        self.partial = data[end:]
+        self.__scan(data[:end])
+
+    def finish(self, retval):
+        '''Classify the output fed so far given the return value of
+        clang. Returns (crash, rule) like CrashClassifier.classify().'''
+
+        if not self.done:
+            self.__scan(self.partial)
+        self.partial = b''
+
+        signal = None
+        if retval < 0:
+            signal = -retval
+        elif retval > 128:
+            signal = retval - 128
+
+        first = dict(self.first)
+        if signal in self.classifier.signal_rules:
+            first.setdefault(self.classifier.signal_rules[signal], None)
+
+        if first:
+            i = min(first)
+            rule = self.classifier.rules[i]
+            if first[i] is None:
+                # matched only by the signal
+                return Crash(rule.reason, signal=signal), rule
+            match, line = first[i]
+            reason = rule.reason
+            if reason is None:
+                reason = match.decode('utf-8', 'replace')
+            return Crash(reason, find_srcloc(line), signal), rule
+
+        if signal:
+            return Crash('Killed by signal %d' % signal, signal=signal), None
+        return None, None
+
+
+class OutputCapture(object):
+    '''Collects an output, keeping at most head_bytes from its start and
+    tail_bytes from its end. If something was left out in between,
+    output() has a truncation marker there.'''
+
+    def __init__(self, head_bytes=CLANG_OUTPUT_HEAD_BYTES,
+                 tail_bytes=CLANG_OUTPUT_TAIL_BYTES):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def feed(self, chunk):
+        'Add the next chunk of the output.'
+
+        self.total += len(chunk)
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk and self.tail_bytes:
+            self.tail += chunk
+            # trim only once in a while to avoid quadratic copying
+            if len(self.tail) > 2 * self.tail_bytes:
+                del self.tail[:-self.tail_bytes]
+
+    def output(self):
+        'Returns the captured output.'
+
+        tail = self.tail[-self.tail_bytes:] if self.tail_bytes else b''
+        omitted = self.total - len(self.head) - len(tail)
+        if omitted:
+            return bytes(self.head + TRUNCATION_MARKER.format(
+                omitted).encode('ascii') + tail)
+        return bytes(self.head + tail)
+
+
+CLASSIFIER = CrashClassifier(
+    [CrashRule(*x) for x in EXTRA_CRASH_RULES] + BUILTIN_CRASH_RULES)
+
+
+def classify_output(output, retval):
+    '''Inspect the output and retval and return a Crash object
+    describing the crash, if any, or None if no crash. Has no side
+    effects.'''
 
-    for line in output.splitlines():
-        if line.find(b'Assertion ') or line.find('UNREACHABLE '):
-            m = SRCPOS_RE.search(line)
-            if m:
-                path = m.group('path')
-                if m.group('lineno'):
-                    path += b':' + m.group('lineno')
-                    if m.group('col'):
-                        path += b':' + m.group('col')
-                return path
+    return CLASSIFIER.classify(output, retval)[0]
 
 
-def check_for_clang_crash(output, retval):
+def check_for_clang_crash(output, retval, scanner=None):
     '''Inspect the output and retval and return a Crash object
-    describing the crash, if any, or None if no crash.'''
-
-    loc = find_crash_location(output)
+    describing the crash, if any, or None if no crash. If scanner is
+    given, it has already been fed the output.'''
 
-    reason = None
-    # timeout -> return value 124 (per timeout manual)
-    if output.find(b'Segmentation fault') != -1:
-        reason = 'SEGV'
-    elif output.find(b'Illegal instruction') != -1:
-        reason = 'Illegal instruction'
+    if scanner:
+        crash, rule = scanner.finish(retval)
     else:
-        a = output.find(b'Assertion ')
-        if a == -1:
-            a = output.find(b'UNREACHABLE ')
-        if a == -1:
-            a = output.find(b'terminate called after throwing an instance')
-        if a != -1:
-            reason = output[a:].split(b'\n', 1)[0].decode('utf-8')
-
-    if not reason:
-        if output.find(b'Stack dump:') != -1:
-            # The output contains a stack dump, but we couldn't determine
-            # a more precise reason for the crash. Save a miscellaneous
-            # report and continue.
-            save_misc_report('stack-dump', output)
-            reason = 'Stack dump found'
+        crash, rule = CLASSIFIER.classify(output, retval)
+    if rule and rule.save_report:
+        save_misc_report('stack-dump', output)
+    return crash
+
+
+# A frame in a stack dump, either "#N 0xADDR function location" (newer
+# LLVM) or "N  module 0xADDR function + offset" (older LLVM).
+STACK_FRAME_RE = re.compile(
+    rb'^\s*(?:#\d+\s+0x[0-9a-fA-F]+|\d+\s+\S+\s+0x[0-9a-fA-F]+)\s+(.*)$',
+    re.MULTILINE)
+
+# Frames of the crash handling machinery, skipped in fingerprints
+SKIP_FRAME_RE = re.compile(
+    rb'PrintStackTrace|SignalHandler|RunSignalHandlers|CrashRecovery|'
+    rb'^(?:__)?(?:raise|abort|gsignal|killpg|restore_rt|assert_fail|'
+    rb'assert_fail_base)$|llvm_unreachable_internal|^_start$|'
+    rb'^__libc_start_main')
+
+# Number of frames in a fingerprint
+FINGERPRINT_FRAMES = 5
+
+
+def stack_frames(output):
+    '''Return the normalized function names of the frames in the stack
+    dump in output: addresses, offsets, source locations and parameter
+    lists are removed. Unsymbolized frames in clang are returned as None;
+    unsymbolized frames in other modules (system libraries) are
+    omitted.'''
+
+    clang_module = os.path.basename(CLANG_BINARY).encode('utf-8')
+    frames = []
+    for m in STACK_FRAME_RE.finditer(output):
+        func = m.group(1).strip()
+        if func.startswith(b'(') and b'+0x' in func:
+            # (/path/to/module+0xoffset)
+            module = os.path.basename(func[1:].rsplit(b'+0x', 1)[0])
+            if module.startswith(clang_module):
+                frames.append(None)
+            continue
+        func = func.replace(b'(anonymous namespace)', b'{anon}')
+        func = func.split(b' + ', 1)[0].split(b'(', 1)[0].split(b' ', 1)[0]
+        frames.append(func)
+    return frames
+
+
+def stack_fingerprint(output):
+    '''Return a fingerprint of the topmost frames of the stack dump in
+    output, excluding the crash handling frames. Crashes with equal
+    fingerprints most likely have the same cause. Returns None if there is
+    no stack dump or it is not symbolized.'''
+
+    frames = [x for x in stack_frames(output)
+              if x is None or not SKIP_FRAME_RE.search(x)]
+    frames = frames[:FINGERPRINT_FRAMES]
+    if not frames or None in frames:
+        return None
+    return hashlib.sha1(b'\n'.join(frames)).hexdigest()
+
+
+def clang_digest(extra_params=[]):
+    '''Return a digest of the clang binary and the parameters it is run
+    with. Test results only depend on the input and this digest.'''
+
+    h = hashlib.sha1()
+    with open(CLANG_BINARY, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update('\0'.join(CLANG_PARAMS + extra_params).encode('utf-8'))
+    if CLANG_DIRECT_CC1:
+        h.update(b'\0-cc1')
+    return h.hexdigest()
+
+
+# {(binary_identity, params): -cc1 command line or None}
+CC1_COMMANDS = {}
+
+
+def cc1_command(binary, params):
+    '''Return the command line of the frontend (clang -cc1) the driver
+    would run for params, or None if the driver would run something
+    else too or it cannot be determined. This is cached per build.'''
+
+    try:
+        key = (binary_identity(binary), tuple(params))
+    except OSError:
+        return None
+    if not key in CC1_COMMANDS:
+        try:
+            out = subp.check_output([binary, '-###'] + params,
+                                    stdin=subp.DEVNULL, stderr=subp.STDOUT,
+                                    cwd='/')
+        except (OSError, subp.CalledProcessError):
+            out = b''
+        # The jobs are printed one per line with all the arguments
+        # quoted.
+        jobs = [shlex.split(line) for line in
+                out.decode('utf-8', 'replace').splitlines()
+                if line.startswith(' "')]
+        if len(jobs) == 1 and jobs[0][1:2] == ['-cc1']:
+            CC1_COMMANDS[key] = jobs[0]
         else:
-            if retval > 128:
-                reason = 'Killed by signal %d' % (retval-128)
+            CC1_COMMANDS[key] = None
+    return CC1_COMMANDS[key]
+
 
-    if reason:
-        return Crash(reason, loc)
+# The reason recorded for inputs on which clang runs out of time
+HANG_REASON = 'Hang'
 
+# Put in place of the omitted part of a truncated output
+TRUNCATION_MARKER = '\n[clang-triage: {} bytes of output omitted]\n'
 
-def test_input(data, extra_params=[], extra_path=[]):
-    'Test the input and return (crash_object, output).'
 
-    CMD = CLANG_TIMEOUT_CMD + [CLANG_BINARY] + CLANG_PARAMS + extra_params
+def case_timeout(runtime):
+    '''Return the time limit in seconds for a case which last ran in
+    runtime seconds. runtime is None for cases with no recorded
+    runtime.'''
+
+    if runtime is None:
+        return CLANG_TIMEOUT
+    return min(max(runtime * CLANG_TIMEOUT_FACTOR, CLANG_TIMEOUT_MIN),
+               CLANG_TIMEOUT_MAX)
+
+
+def communicate_streaming(p, data, timeout, consumers):
+    '''Like p.communicate(data, timeout), but pass each chunk of output
+    to the functions in consumers instead of collecting it. If p does
+    not finish in time, its process group is killed. Returns False on
+    timeout, otherwise True.'''
+
+    deadline = time.monotonic() + timeout
+    finished = True
+    view = memoryview(data)
+    pos = 0
+    with selectors.DefaultSelector() as sel:
+        if data:
+            sel.register(p.stdin, selectors.EVENT_WRITE)
+        else:
+            p.stdin.close()
+        sel.register(p.stdout, selectors.EVENT_READ)
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if finished and remaining <= 0:
+                os.killpg(p.pid, signal.SIGKILL)
+                finished = False
+            for key, events in sel.select(remaining if finished else None):
+                if key.fileobj is p.stdin:
+                    try:
+                        pos += os.write(key.fd,
+                                        view[pos:pos + select.PIPE_BUF])
+                    except BrokenPipeError:
+                        pos = len(data)
+                    if pos >= len(data):
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                else:
+                    chunk = os.read(key.fd, 1 << 16)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        continue
+                    for consume in consumers:
+                        consume(chunk)
+    if finished:
+        try:
+            p.wait(max(deadline - time.monotonic(), 0))
+        except subp.TimeoutExpired:
+            finished = False
+    if not finished:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+    return finished
+
+
+def test_input(data, extra_params=[], extra_path=[], binary=CLANG_BINARY,
+               timeout=CLANG_TIMEOUT):
+    '''Test the input and return (crash_object, output). If clang does
+    not finish in timeout seconds, it is killed and the crash is a
+    hang. If CLANG_DIRECT_CC1 is set, the frontend is run directly
+    without the driver.'''
+
+    CMD = None
+    if CLANG_DIRECT_CC1:
+        CMD = cc1_command(binary, CLANG_PARAMS + extra_params)
+    if not CMD:
+        CMD = [binary] + CLANG_PARAMS + extra_params
     env = copy.copy(os.environ)
     path = os.pathsep.join(extra_path + env['PATH'].split(os.pathsep))
     env['PATH'] = path
+    # In a new session, so that llvm-symbolizer and anything else clang
+    # starts can be killed with it.
     with subp.Popen(CMD, stdin=subp.PIPE, stdout=subp.PIPE,
-                    stderr=subp.STDOUT, cwd='/', env=env) as p:
-        stdout = p.communicate(data)[0]
-        retval = p.returncode
-        return check_for_clang_crash(stdout, retval), stdout
+                    stderr=subp.STDOUT, cwd='/', env=env,
+                    start_new_session=True) as p:
+        capture = OutputCapture()
+        scanner = CLASSIFIER.scanner()
+        try:
+            hung = not communicate_streaming(
+                p, data, timeout, [capture.feed, scanner.feed])
+        except BaseException:
+            # do not wait for clang if interrupted
+            os.killpg(p.pid, signal.SIGKILL)
+            raise
+        output = capture.output()
+        if hung:
+            return Crash(HANG_REASON), output
+        return check_for_clang_crash(output, p.returncode, scanner), output
 
 
 def test_input_reduce(data):
@@ -188,3 +550,39 @@ def test_input_reduce(data):
     return test_input(
         data, extra_params=REDUCTION_EXTRA_CLANG_PARAMS,
         extra_path=[os.path.abspath(DUMMY_LLVM_SYMBOLIZER_PATH)])
+
+
+def binary_identity(binary=CLANG_BINARY):
+    '''Return a string which changes whenever the binary is rebuilt.
+    This is cheaper than hashing it.'''
+
+    st = os.stat(binary)
+    return '{}:{}:{}:{}'.format(binary, st.st_ino, st.st_size,
+                                st.st_mtime_ns)
+
+
+REDUCE_VERDICTS = None
+
+
+def reduce_verdict_cache():
+    '''Get the verdict cache of test_input_reduce(). It is persisted in
+    $CLANG_TRIAGE_VERDICT_CACHE or VERDICT_CACHE_PATH if set.'''
+
+    global REDUCE_VERDICTS
+
+    if REDUCE_VERDICTS is None:
+        path = os.environ.get('CLANG_TRIAGE_VERDICT_CACHE',
+                              VERDICT_CACHE_PATH)
+        REDUCE_VERDICTS = VerdictCache(path=path)
+    return REDUCE_VERDICTS
+
+
+def reduce_verdict(data):
+    '''Return test_input_reduce(data)[0], memoized. Use this for
+    predicates of reducers.'''
+
+    context = '\0'.join([binary_identity()] + CLANG_PARAMS +
+                         REDUCTION_EXTRA_CLANG_PARAMS +
+                         (['-cc1'] if CLANG_DIRECT_CC1 else []))
+    return reduce_verdict_cache().lookup(
+        data, context, lambda x: test_input_reduce(x)[0])
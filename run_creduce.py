@@ -4,21 +4,46 @@ import os
 import tempfile
 import sys
 import string
+import signal
 import subprocess as subp
 
-from run_clang import test_input, test_input_reduce
+from run_clang import test_input, reduce_verdict, reduce_verdict_cache
+from property_server import property_server
+from verdict_cache import VerdictCache
 from utils import env_with_tmpdir
 from config import CREDUCE_PROPERTY_SCRIPT, CREDUCE_TIMEOUT
+from config import REDUCE_CORES_PER_JOB, VERDICT_CACHE_PATH
+from config import CREDUCE_PROPERTY_SERVER, CREDUCE_PROPERTY_CLIENT
+
+
+def call_creduce(prop_script, creduce_dir, env):
+    '''Run creduce on buggy.cpp in creduce_dir. If interrupted, creduce
+    and everything it started are killed.'''
+
+    # creduce is buggy, so execute with a timeout
+    CMD = ['timeout', str(CREDUCE_TIMEOUT),
+           'creduce', '--n', str(REDUCE_CORES_PER_JOB),
+           prop_script, 'buggy.cpp']
+    # In a new session, so that its whole process group can be killed.
+    with subp.Popen(CMD, env=env, cwd=creduce_dir,
+                    stdout=subp.DEVNULL, stderr=subp.DEVNULL,
+                    start_new_session=True) as p:
+        try:
+            retval = p.wait()
+        except BaseException:
+            os.killpg(p.pid, signal.SIGKILL)
+            raise
+    if retval:
+        raise subp.CalledProcessError(retval, CMD)
 
 
 def run_creduce(data, crash):
     'Run CReduce for the data.'
 
     assert crash, 'Cannot run_creduce() on a non-crashing input.'
-    assert (os.path.isfile(CREDUCE_PROPERTY_SCRIPT) and
-            os.access(CREDUCE_PROPERTY_SCRIPT, os.X_OK)), (
-        'No %s in cwd %s (or not executable).' % (
-            CREDUCE_PROPERTY_SCRIPT, os.getcwd()))
+    for script in [CREDUCE_PROPERTY_SCRIPT, CREDUCE_PROPERTY_CLIENT]:
+        assert (os.path.isfile(script) and os.access(script, os.X_OK)), (
+            'No %s in cwd %s (or not executable).' % (script, os.getcwd()))
     with tempfile.TemporaryDirectory(prefix='clang_triage') as creduce_dir:
         # creduce may leave files, so point TMPDIR below our creduce
         # temp dir
@@ -26,7 +51,10 @@ def run_creduce(data, crash):
         os.mkdir(env_tmpdir)
         reason_fname = os.path.join(creduce_dir, 'crash_reason.dat')
         cpp_fname = os.path.join(creduce_dir, 'buggy.cpp')
-        prop_script = os.path.abspath(CREDUCE_PROPERTY_SCRIPT)
+        if CREDUCE_PROPERTY_SERVER:
+            prop_script = os.path.abspath(CREDUCE_PROPERTY_CLIENT)
+        else:
+            prop_script = os.path.abspath(CREDUCE_PROPERTY_SCRIPT)
         with open(reason_fname, 'w') as f:
             f.write(crash.reason)
         with open(cpp_fname, 'wb') as f:
@@ -34,19 +62,27 @@ def run_creduce(data, crash):
 
         env = env_with_tmpdir(env_tmpdir)
         env['CLANG_TRIAGE_TMP'] = creduce_dir
+        verdicts_fname = VERDICT_CACHE_PATH
+        if not verdicts_fname:
+            verdicts_fname = os.path.join(creduce_dir, 'verdicts.sqlite')
+            env['CLANG_TRIAGE_VERDICT_CACHE'] = verdicts_fname
         try:
-            # creduce is buggy, so execute with a timeout
-            subp.check_call(['timeout', str(CREDUCE_TIMEOUT),
-                             'creduce', prop_script, 'buggy.cpp'],
-                            env=env, cwd=creduce_dir,
-                            stdout=subp.DEVNULL, stderr=subp.DEVNULL)
+            if CREDUCE_PROPERTY_SERVER:
+                before = reduce_verdict_cache().local_stats()
+                with property_server(creduce_dir, crash.reason):
+                    call_creduce(prop_script, creduce_dir, env)
+                stats = reduce_verdict_cache().stats_str(before)
+            else:
+                call_creduce(prop_script, creduce_dir, env)
+                stats = VerdictCache(path=verdicts_fname).stats_str()
+            print('CReduce: ' + stats, file=sys.stderr)
         except subp.CalledProcessError as e:
             print('CReduce failed with exit code ' + str(e.returncode),
                   file=sys.stderr)
             return None
         with open(cpp_fname, 'rb') as f:
             reduced = f.read()
-    reduced_crash, output = test_input_reduce(reduced)
+    reduced_crash = reduce_verdict(reduced)
     if crash != reduced_crash:
         print('CReduced case produces different result: {} != {}'.format(
             reduced_crash, crash), file=sys.stderr)
@@ -57,28 +93,60 @@ def run_creduce(data, crash):
 PRINTABLE = string.printable.encode('ascii')
 
 
+def remove_nonprintables(contents, pred):
+    '''Minimize contents wrt non-printable characters: remove each of
+    them, or failing that replace it by a space or an underscore, if
+    pred() still holds for the result. Groups of non-printables are
+    replaced at once, starting from all of them; a group that fails is
+    split in halves, down to single bytes. A group which only accepted a
+    space or an underscore is split and its halves retried with the
+    replacements preferred to that one, so each byte ends up with the
+    same replacement as when trying them byte by byte.'''
+
+    positions = [i for i in range(len(contents))
+                 if not contents[i] in PRINTABLE]
+    # printable segments between the non-printables
+    bounds = [-1] + positions + [len(contents)]
+    segments = [contents[bounds[k]+1:bounds[k+1]]
+                for k in range(len(bounds) - 1)]
+    # accepted replacements by index in positions
+    chosen = {}
+
+    def build(trial):
+        pieces = [segments[0]]
+        for k, pos in enumerate(positions):
+            if k in trial:
+                pieces.append(trial[k])
+            else:
+                pieces.append(chosen.get(k, contents[pos:pos+1]))
+            pieces.append(segments[k+1])
+        return b''.join(pieces)
+
+    def try_group(group, replacements):
+        for i, replacement in enumerate(replacements):
+            trial = dict.fromkeys(group, replacement)
+            if pred(build(trial)):
+                chosen.update(trial)
+                # only better replacements are left to try
+                replacements = replacements[:i]
+                break
+        if len(group) > 1 and replacements:
+            half = len(group) // 2
+            try_group(group[:half], replacements)
+            try_group(group[half:], replacements)
+
+    if positions:
+        try_group(range(len(positions)), [b'', b' ', b'_'])
+    return build({})
+
+
 def try_remove_nonprintables(contents, crash):
-    'Minimize the case wrt non-printable characters.'
+    '''Minimize the case wrt non-printable characters, keeping it
+    crashing the same way.'''
 
-    reduced = b''
-    for i in range(len(contents)):
-        if not contents[i] in PRINTABLE:
-            if i != len(contents)-1:
-                tail = contents[i+1:]
-            else:
-                tail = b''
-            for replacement in [b'', b' ', b'_']:
-                r, out = test_input_reduce(reduced + replacement + tail)
-                if r == crash:
-                    reduced += replacement
-                    break
-            else:
-                # failed to remove
-                reduced += contents[i:i+1]
-        else:
-            reduced += contents[i:i+1]
-    assert (test_input_reduce(contents)[0] ==
-            test_input_reduce(reduced)[0])
+    reduced = remove_nonprintables(
+        contents, lambda x: reduce_verdict(x) == crash)
+    assert reduce_verdict(contents) == reduce_verdict(reduced)
     return reduced
 
 
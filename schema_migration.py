@@ -1,6 +1,8 @@
 # FIXME write a schema migration test.
 
 import sys
+import zlib
+import hashlib
 
 
 def migrate_schema_v1_v2(db):
@@ -36,6 +38,485 @@ def migrate_schema_v1_v2(db):
                           updates)
 
 
+def migrate_schema_v2_v3(db):
+    # changes from 2 to 3:
+    #   * test_runs.in_progress for runs whose results are being streamed
+    #   * last_2_runs_view only considers finished runs
+    with db.cursor() as c:
+        print('Migrating schema v2..v3...', file=sys.stderr)
+        c.execute('ALTER TABLE test_runs ADD COLUMN '
+                  '    in_progress BOOLEAN NOT NULL DEFAULT FALSE')
+        c.execute('CREATE OR REPLACE VIEW last_2_runs_view AS '
+                  '    SELECT id FROM test_runs '
+                  '    WHERE NOT in_progress '
+                  '    ORDER BY id DESC LIMIT 2')
+        c.execute("UPDATE params SET value='3' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v3_v4(db):
+    # changes from 3 to 4:
+    #   * test_runs.clang_digest for reusing results of identical binaries
+    with db.cursor() as c:
+        print('Migrating schema v3..v4...', file=sys.stderr)
+        c.execute('ALTER TABLE test_runs ADD COLUMN clang_digest TEXT')
+        c.execute('CREATE INDEX test_runs_clang_digest '
+                  '    ON test_runs(clang_digest)')
+        c.execute("UPDATE params SET value='4' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v4_v5(db):
+    # changes from 4 to 5:
+    #   * CREATE TABLE bisections
+    with db.cursor() as c:
+        print('Migrating schema v4..v5...', file=sys.stderr)
+        c.execute('CREATE TABLE bisections ( '
+                  '    result BIGINT PRIMARY KEY '
+                  '        REFERENCES result_strings(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    test_run BIGINT NOT NULL REFERENCES test_runs(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    case_id BIGINT NOT NULL REFERENCES cases(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    good_revision INTEGER NOT NULL, '
+                  '    bad_revision INTEGER NOT NULL, '
+                  '    bad_project TEXT, '
+                  '    exact BOOLEAN NOT NULL)')
+        c.execute("UPDATE params SET value='5' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v5_v6(db):
+    # changes from 5 to 6:
+    #   * CREATE TABLE case_fingerprints (filled by the next test run)
+    #   * unreduced_cases_view also has the case id
+    with db.cursor() as c:
+        print('Migrating schema v5..v6...', file=sys.stderr)
+        c.execute('CREATE TABLE case_fingerprints ( '
+                  '    case_id BIGINT PRIMARY KEY REFERENCES cases(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    fingerprint TEXT NOT NULL)')
+        c.execute('CREATE INDEX case_fingerprints_fingerprint '
+                  '    ON case_fingerprints(fingerprint)')
+        c.execute('CREATE OR REPLACE VIEW unreduced_cases_view AS '
+                  '    SELECT sha1, z_contents, id '
+                  '    FROM case_view AS cv '
+                  '    WHERE NOT EXISTS ( '
+                  '        SELECT * FROM reduced_cases AS red '
+                  '        WHERE red.original = cv.id)')
+        c.execute("UPDATE params SET value='6' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v6_v7(db):
+    # changes from 6 to 7:
+    #   * CREATE TABLE reduce_queue, filled with the unreduced failing
+    #     cases of the last run
+    with db.cursor() as c:
+        print('Migrating schema v6..v7...', file=sys.stderr)
+        c.execute('CREATE TABLE reduce_queue ( '
+                  '    case_id BIGINT PRIMARY KEY REFERENCES cases(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    result BIGINT NOT NULL REFERENCES result_strings(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    fingerprint TEXT, '
+                  '    priority SMALLINT NOT NULL, '
+                  '    size INTEGER NOT NULL, '
+                  '    leased_by TEXT, '
+                  '    lease_expires BIGINT)')
+        c.execute('CREATE INDEX reduce_queue_order '
+                  '    ON reduce_queue(priority, size, case_id)')
+        c.execute('CREATE INDEX reduce_queue_result ON reduce_queue(result)')
+        c.execute('CREATE INDEX reduce_queue_fingerprint '
+                  '    ON reduce_queue(fingerprint)')
+        c.execute("INSERT INTO reduce_queue (case_id, result, "
+                  "    fingerprint, priority, size) "
+                  "SELECT r.case_id, r.result, f.fingerprint, 2, s.size "
+                  "FROM last_run_results AS r "
+                  "    JOIN case_sizes AS s ON s.case_id=r.case_id "
+                  "    LEFT JOIN case_fingerprints AS f "
+                  "        ON f.case_id=r.case_id "
+                  "WHERE r.result<>(SELECT id FROM result_strings "
+                  "                 WHERE str='OK') "
+                  "    AND NOT EXISTS (SELECT 1 FROM reduced_cases AS rc "
+                  "                    WHERE rc.original=r.case_id)")
+        c.execute("UPDATE reduce_queue AS q SET priority=0 "
+                  "WHERE NOT EXISTS ( "
+                  "    SELECT 1 FROM reduced_cases AS rc "
+                  "        JOIN last_run_results AS r "
+                  "            ON r.case_id=rc.original "
+                  "    WHERE r.result=q.result)")
+        c.execute("UPDATE params SET value='7' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v7_v8(db):
+    # changes from 7 to 8:
+    #   * CREATE TABLE case_runtimes
+    with db.cursor() as c:
+        print('Migrating schema v7..v8...', file=sys.stderr)
+        c.execute('CREATE TABLE case_runtimes ( '
+                  '    case_id BIGINT PRIMARY KEY REFERENCES cases(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    runtime REAL NOT NULL)')
+        c.execute("UPDATE params SET value='8' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v8_v9(db):
+    # changes from 8 to 9:
+    #   * ALTER TABLE outputs ADD COLUMN result, symbolized. Existing
+    #     outputs were symbolized when recorded.
+    #   * CREATE TABLE symbol_cache
+    with db.cursor() as c:
+        print('Migrating schema v8..v9...', file=sys.stderr)
+        c.execute('ALTER TABLE outputs ADD COLUMN result BIGINT '
+                  '    REFERENCES result_strings(id) '
+                  '    ON UPDATE CASCADE ON DELETE CASCADE')
+        c.execute('UPDATE outputs SET result=r.result '
+                  'FROM last_run_results AS r '
+                  'WHERE r.case_id=outputs.case_id')
+        c.execute('ALTER TABLE outputs ADD COLUMN symbolized BOOLEAN '
+                  '    NOT NULL DEFAULT TRUE')
+        c.execute('ALTER TABLE outputs ALTER COLUMN symbolized '
+                  '    SET DEFAULT FALSE')
+        c.execute('CREATE INDEX outputs_unsymbolized ON outputs(case_id) '
+                  '    WHERE NOT symbolized')
+        c.execute('CREATE TABLE symbol_cache ( '
+                  '    build_id TEXT NOT NULL, '
+                  '    module_offset BIGINT NOT NULL, '
+                  '    frames TEXT NOT NULL, '
+                  '    PRIMARY KEY (build_id, module_offset))')
+        c.execute("UPDATE params SET value='9' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v9_v10(db):
+    # changes from 9 to 10:
+    #   * CREATE UNLOGGED TABLE case_staging
+    with db.cursor() as c:
+        print('Migrating schema v9..v10...', file=sys.stderr)
+        c.execute('CREATE UNLOGGED TABLE case_staging ( '
+                  '    sha1 TEXT NOT NULL, '
+                  '    z_contents BYTEA NOT NULL, '
+                  '    size INTEGER NOT NULL)')
+        c.execute("UPDATE params SET value='10' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v10_v11(db):
+    # changes from 10 to 11:
+    #   * results is replaced by result_changes, which only has a row
+    #     when the result of a case changes, and a view with the same
+    #     name and columns
+    #   * CREATE TABLE run_progress for the cases tested in in-progress
+    #     runs
+    with db.cursor() as c:
+        print('Migrating schema v10..v11...', file=sys.stderr)
+        c.execute('CREATE TABLE result_changes ( '
+                  '    id BIGSERIAL PRIMARY KEY, '
+                  '    case_id BIGINT NOT NULL, '
+                  '    first_run BIGINT NOT NULL, '
+                  '    end_run BIGINT, '
+                  '    result BIGINT NOT NULL, '
+                  '    FOREIGN KEY(case_id) REFERENCES case_contents(case_id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    FOREIGN KEY(result) REFERENCES result_strings(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE)')
+        c.execute('CREATE TABLE run_progress ( '
+                  '    test_run BIGINT REFERENCES test_runs(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    case_id BIGINT REFERENCES cases(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    PRIMARY KEY (test_run, case_id))')
+        c.execute('INSERT INTO run_progress '
+                  'SELECT r.test_run, r.case_id '
+                  'FROM results AS r, test_runs AS t '
+                  'WHERE t.id=r.test_run AND t.in_progress')
+        # Rows where the result differs from the case's previous one
+        # start an interval, which ends where the next one starts.
+        c.execute('INSERT INTO result_changes '
+                  '    (case_id, first_run, end_run, result) '
+                  'SELECT case_id, test_run, '
+                  '    LEAD(test_run) OVER ('
+                  '        PARTITION BY case_id ORDER BY test_run), '
+                  '    result '
+                  'FROM (SELECT case_id, test_run, result, '
+                  '          LAG(result) OVER ('
+                  '              PARTITION BY case_id ORDER BY test_run) '
+                  '              AS prev '
+                  '      FROM results) AS x '
+                  'WHERE prev IS NULL OR prev<>result')
+        c.execute('CREATE INDEX result_changes_case_id '
+                  '    ON result_changes(case_id)')
+        c.execute('CREATE UNIQUE INDEX result_changes_current '
+                  '    ON result_changes(case_id) WHERE end_run IS NULL')
+        c.execute('CREATE INDEX result_changes_first_run '
+                  '    ON result_changes(first_run)')
+        c.execute('CREATE INDEX result_changes_end_run '
+                  '    ON result_changes(end_run)')
+        c.execute('CREATE INDEX result_changes_result '
+                  '    ON result_changes(result)')
+
+        # The views depend on the results table, so recreate them.
+        c.execute('DROP VIEW changed_results, second_last_run_results, '
+                  '    last_run_results, results_view')
+        c.execute('DROP TABLE results')
+        c.execute('CREATE VIEW results AS '
+                  '    SELECT rc.id, rc.case_id, r.id AS test_run, '
+                  '        rc.result '
+                  '    FROM result_changes AS rc, test_runs AS r '
+                  '    WHERE r.id >= rc.first_run '
+                  '        AND (rc.end_run IS NULL OR r.id < rc.end_run) '
+                  '        AND (NOT r.in_progress OR EXISTS ( '
+                  '            SELECT 1 FROM run_progress AS p '
+                  '            WHERE p.test_run=r.id '
+                  '                AND p.case_id=rc.case_id))')
+        c.execute('CREATE VIEW results_view AS '
+                  '    SELECT test_run, cases.id, sha1, str '
+                  '    FROM result_strings AS res, results, cases '
+                  '    WHERE results.case_id = cases.id '
+                  '        AND results.result = res.id')
+        c.execute('CREATE VIEW last_run_results AS '
+                  '    SELECT * FROM results '
+                  '    WHERE test_run=(SELECT MAX(id) FROM last_2_runs_view)')
+        c.execute('CREATE VIEW second_last_run_results AS '
+                  '    SELECT * FROM results '
+                  '    WHERE test_run=(SELECT MIN(id) FROM last_2_runs_view)')
+        c.execute('CREATE VIEW changed_results AS '
+                  '    SELECT last.id AS id1, second.id AS id2, '
+                  '        last.case_id, last.result AS new, '
+                  '        second.result AS old '
+                  '    FROM last_run_results AS last, '
+                  '        second_last_run_results AS second '
+                  '    WHERE last.case_id=second.case_id '
+                  '        AND last.result<>second.result')
+        c.execute("UPDATE params SET value='11' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v11_v12(db):
+    # changes from 11 to 12:
+    #   * CREATE TABLE output_blobs for the distinct outputs, keyed by
+    #     the sha1 of the uncompressed output
+    #   * outputs.output is replaced by output_sha1 referring to the blob
+    #   * sha_output_view has output_sha1 instead of output
+    with db.cursor() as c:
+        print('Migrating schema v11..v12...', file=sys.stderr)
+        c.execute('CREATE TABLE output_blobs ( '
+                  '    sha1 TEXT PRIMARY KEY, '
+                  '    output BYTEA NOT NULL)')
+        c.execute('ALTER TABLE outputs ADD COLUMN output_sha1 TEXT')
+    last_id = -1
+    while True:
+        with db.cursor() as c:
+            c.execute('SELECT case_id, output FROM outputs '
+                      'WHERE case_id>%s ORDER BY case_id LIMIT 1000',
+                      (last_id, ))
+            rows = c.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            shas = [(hashlib.sha1(zlib.decompress(x[1])).hexdigest(), x[0],
+                     x[1]) for x in rows]
+            c.executemany('INSERT INTO output_blobs VALUES (%s, %s) '
+                          'ON CONFLICT (sha1) DO NOTHING',
+                          [(x[0], x[2]) for x in shas])
+            c.executemany('UPDATE outputs SET output_sha1=%s '
+                          'WHERE case_id=%s', [x[:2] for x in shas])
+    with db.cursor() as c:
+        c.execute('DROP VIEW sha_output_view')
+        c.execute('DROP INDEX outputs_unsymbolized')
+        c.execute('ALTER TABLE outputs DROP COLUMN output')
+        c.execute('ALTER TABLE outputs ALTER COLUMN output_sha1 SET NOT NULL')
+        c.execute('ALTER TABLE outputs ADD FOREIGN KEY (output_sha1) '
+                  '    REFERENCES output_blobs(sha1)')
+        c.execute('CREATE INDEX outputs_output_sha1 ON outputs(output_sha1)')
+        c.execute('CREATE INDEX outputs_unsymbolized ON outputs(output_sha1) '
+                  '    WHERE NOT symbolized')
+        c.execute('CREATE VIEW sha_output_view AS '
+                  '    SELECT sha1, output_sha1 '
+                  '    FROM cases, outputs '
+                  '    WHERE cases.id = outputs.case_id')
+        c.execute("UPDATE params SET value='12' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v12_v13(db):
+    # changes from 12 to 13:
+    #   * CREATE TABLE codecs
+    #   * case_contents, case_staging, output_blobs and reduced_contents
+    #     have the codec of each blob. Existing blobs are zlib
+    #     compressed, except reduced contents which are not compressed.
+    #   * case_view, unreduced_cases_view and sha_reduced_view have the
+    #     codec
+    with db.cursor() as c:
+        print('Migrating schema v12..v13...', file=sys.stderr)
+        c.execute('CREATE TABLE codecs ( '
+                  '    id SMALLINT PRIMARY KEY, '
+                  '    name TEXT NOT NULL, '
+                  '    kind TEXT, '
+                  '    dictionary BYTEA, '
+                  '    created BIGINT)')
+        c.execute("INSERT INTO codecs (id, name) "
+                  "VALUES (0, 'none'), (1, 'zlib')")
+        for table, default in [('case_contents', 1), ('output_blobs', 1),
+                               ('reduced_contents', 0)]:
+            c.execute('ALTER TABLE {} ADD COLUMN codec SMALLINT '
+                      '    NOT NULL DEFAULT {} '
+                      '    REFERENCES codecs(id)'.format(table, default))
+        c.execute('ALTER TABLE case_staging ADD COLUMN codec SMALLINT '
+                  '    NOT NULL DEFAULT 1')
+        c.execute('ALTER TABLE case_staging ALTER COLUMN codec DROP DEFAULT')
+        c.execute('CREATE OR REPLACE VIEW case_view AS '
+                  '    SELECT id, sha1, z_contents, size, codec '
+                  '    FROM cases, case_contents, case_sizes '
+                  '    WHERE cases.id = case_contents.case_id '
+                  '        AND cases.id = case_sizes.case_id')
+        c.execute('CREATE OR REPLACE FUNCTION '
+                  '    case_view_insert_trigger_func() '
+                  'RETURNS trigger AS $$ '
+                  'DECLARE '
+                  '  id BIGINT; '
+                  'BEGIN '
+                  '    SET CONSTRAINTS cases_id_forward_fkey, '
+                  '        case_contents_case_id_forward_fkey DEFERRED; '
+                  '    INSERT INTO cases (sha1) VALUES (NEW.sha1) '
+                  '        RETURNING cases.id INTO id; '
+                  '    INSERT INTO case_contents (case_id, z_contents, codec) '
+                  '        VALUES (id, NEW.z_contents, NEW.codec); '
+                  '    INSERT INTO case_sizes (case_id, size) '
+                  '        VALUES (id, NEW.size); '
+                  '    SET CONSTRAINTS cases_id_forward_fkey, '
+                  '        case_contents_case_id_forward_fkey IMMEDIATE; '
+                  '    RETURN NEW; '
+                  'END; $$ LANGUAGE PLPGSQL')
+        c.execute('CREATE OR REPLACE VIEW unreduced_cases_view AS '
+                  '    SELECT sha1, z_contents, id, codec '
+                  '    FROM case_view AS cv '
+                  '    WHERE NOT EXISTS ( '
+                  '        SELECT * FROM reduced_cases AS red '
+                  '        WHERE red.original = cv.id)')
+        c.execute('CREATE OR REPLACE VIEW sha_reduced_view AS '
+                  '    SELECT sha1, contents, codec '
+                  '    FROM cases, reduced_cases, reduced_contents '
+                  '    WHERE cases.id = reduced_cases.original '
+                  '        AND reduced_cases.id = reduced_contents.reduced_id')
+        c.execute("UPDATE params SET value='13' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v13_v14(db):
+    # changes from 13 to 14:
+    #   * reduced_contents has the sha1 and size of the contents
+    #   * reduced_contents is indexed by reduced_id
+    #   * output_blobs has the size of the output
+    #   * sha_reduced_view has reduced_sha1 and reduced_size
+    # The columns are filled in key order in transactions of 1000 rows,
+    # so an interrupted migration continues where it left off. The keys
+    # need not be unique: each batch starts from the last key seen, not
+    # after it, and the rows already filled in are skipped by size.
+    from triage_db import load_codecs
+    codecs = load_codecs(db)
+    with db.cursor() as c:
+        print('Migrating schema v13..v14...', file=sys.stderr)
+        c.execute('ALTER TABLE reduced_contents '
+                  '    ADD COLUMN IF NOT EXISTS sha1 TEXT, '
+                  '    ADD COLUMN IF NOT EXISTS size INTEGER')
+        c.execute('ALTER TABLE output_blobs '
+                  '    ADD COLUMN IF NOT EXISTS size INTEGER')
+        c.execute('CREATE INDEX IF NOT EXISTS reduced_contents_reduced_id '
+                  '    ON reduced_contents(reduced_id)')
+    db.commit()
+    # (table, key, smallest key, blob column, columns to set)
+    for table, key, last, column, digest in [
+            ('reduced_contents', 'reduced_id', 0, 'contents',
+             'sha1=%s, size=%s'),
+            ('output_blobs', 'sha1', '', 'output', 'size=%s')]:
+        while True:
+            with db.cursor() as c:
+                c.execute('SELECT {0}, codec, {1} FROM {2} '
+                          'WHERE {0}>=%s AND size IS NULL '
+                          'ORDER BY {0} LIMIT 1000'.format(
+                              key, column, table), (last, ))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                updates = []
+                for last, codec, blob in rows:
+                    data = codecs[codec].decompress(blob)
+                    if table == 'reduced_contents':
+                        updates.append((hashlib.sha1(data).hexdigest(),
+                                        len(data), last))
+                    else:
+                        updates.append((len(data), last))
+                c.executemany('UPDATE {} SET {} WHERE {}=%s'.format(
+                    table, digest, key), updates)
+            db.commit()
+    with db.cursor() as c:
+        c.execute('ALTER TABLE reduced_contents '
+                  '    ALTER COLUMN sha1 SET NOT NULL, '
+                  '    ALTER COLUMN size SET NOT NULL')
+        c.execute('ALTER TABLE output_blobs ALTER COLUMN size SET NOT NULL')
+        c.execute('CREATE INDEX reduced_contents_sha1 '
+                  '    ON reduced_contents(sha1)')
+        c.execute('CREATE OR REPLACE VIEW sha_reduced_view AS '
+                  '    SELECT cases.sha1, contents, codec, '
+                  '        reduced_contents.sha1 AS reduced_sha1, '
+                  '        reduced_contents.size AS reduced_size '
+                  '    FROM cases, reduced_cases, reduced_contents '
+                  '    WHERE cases.id = reduced_cases.original '
+                  '        AND reduced_cases.id = reduced_contents.reduced_id')
+        c.execute("UPDATE params SET value='14' "
+                  "WHERE name='schema_version'")
+
+
+def migrate_schema_v14_v15(db):
+    # changes from 14 to 15:
+    #   * CREATE TABLE bisect_queue, with the new failure reasons of the
+    #     last test run which have not been bisected
+    with db.cursor() as c:
+        print('Migrating schema v14..v15...', file=sys.stderr)
+        c.execute('CREATE TABLE bisect_queue ( '
+                  '    result BIGINT PRIMARY KEY '
+                  '        REFERENCES result_strings(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    old_run BIGINT NOT NULL REFERENCES test_runs(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    new_run BIGINT NOT NULL REFERENCES test_runs(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE, '
+                  '    case_id BIGINT NOT NULL REFERENCES cases(id) '
+                  '        ON UPDATE CASCADE ON DELETE CASCADE)')
+        c.execute('INSERT INTO bisect_queue '
+                  '    (result, old_run, new_run, case_id) '
+                  'SELECT DISTINCT ON (ch.new) ch.new, '
+                  '    (SELECT MIN(id) FROM last_2_runs_view), '
+                  '    (SELECT MAX(id) FROM last_2_runs_view), ch.case_id '
+                  'FROM changed_results AS ch, case_view AS cv '
+                  'WHERE cv.id=ch.case_id AND ch.old=('
+                  "        SELECT id FROM result_strings WHERE str='OK') "
+                  '    AND NOT EXISTS ('
+                  '        SELECT 1 FROM bisections AS b '
+                  '        WHERE b.result=ch.new) '
+                  'ORDER BY ch.new, cv.size, cv.sha1')
+        c.execute("UPDATE params SET value='15' "
+                  "WHERE name='schema_version'")
+
+
 MIGRATE_FROM = {
-    1: migrate_schema_v1_v2
+    1: migrate_schema_v1_v2,
+    2: migrate_schema_v2_v3,
+    3: migrate_schema_v3_v4,
+    4: migrate_schema_v4_v5,
+    5: migrate_schema_v5_v6,
+    6: migrate_schema_v6_v7,
+    7: migrate_schema_v7_v8,
+    8: migrate_schema_v8_v9,
+    9: migrate_schema_v9_v10,
+    10: migrate_schema_v10_v11,
+    11: migrate_schema_v11_v12,
+    12: migrate_schema_v12_v13,
+    13: migrate_schema_v13_v14,
+    14: migrate_schema_v14_v15
 }
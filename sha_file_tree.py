@@ -1,5 +1,4 @@
 import os
-from hashlib import sha1
 
 from utils import all_files_recursive
 
@@ -44,25 +43,33 @@ def rm_files_not_in(path, new_files):
         os.remove(os.path.join(path, fname))
 
 
-def make_sha_tree(path, contentses, suffix='', rm_old=False):
-    '''Make or update a two-level sha tree rooted on path. Remove old
-    files if rm_old=True.'''
+def make_sha_tree(path, shas, fetch, suffix='', rm_old=False,
+                  batch_size=1000):
+    '''Make or update a two-level sha tree rooted on path with files
+    named by the sha1s in shas. fetch(list of sha1s) is called to get
+    (sha1, contents) pairs, batch_size at a time, only for the files
+    which do not exist yet. Remove old files if rm_old=True.'''
 
     if not os.path.isdir(path):
         make_empty_sha_tree(path)
 
-    if rm_old:
-        NEW_FILES = []
-
-    for contents in contentses:
-        sha = sha1(contents).hexdigest()
+    NEW_FILES = []
+    missing = []
+    for sha in shas:
         rel_fname = os.path.join(sha[0], sha[1], sha) + suffix
-        if rm_old:
+        if os.path.exists(os.path.join(path, rel_fname)):
             NEW_FILES.append(rel_fname)
-        fname = os.path.join(path, rel_fname)
-        if not os.path.exists(fname):
-            with open(fname, 'wb') as f:
+        else:
+            missing.append(sha)
+
+    # Only files which were written are recorded; fetch() may not return
+    # a sha which has disappeared since shas was computed.
+    for i in range(0, len(missing), batch_size):
+        for sha, contents in fetch(missing[i:i+batch_size]):
+            rel_fname = os.path.join(sha[0], sha[1], sha) + suffix
+            with open(os.path.join(path, rel_fname), 'wb') as f:
                 f.write(contents)
+            NEW_FILES.append(rel_fname)
 
     if rm_old:
         rm_files_not_in(path, NEW_FILES)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# Deferred symbolization of clang outputs. Test runs use a dummy
+# llvm-symbolizer, so stack dumps contain frames like
+#
+#    #3 0x00000000019e0b2c (/path/to/clang+0x19e0b2c)
+#
+# This module replaces them with function names and source locations
+# like clang would have printed. Symbolized frames are cached in the
+# database by the build id of the module and the offset, so a frame
+# shared by many crashes is only symbolized once per binary.
+
+import os
+import re
+import sys
+import struct
+import hashlib
+import subprocess as subp
+
+from triage_db import TriageDb
+from run_clang import binary_identity
+
+from config import CLANG_BINARY, LLVM_SYMBOLIZER, SYMBOLIZE_BATCH_SIZE
+
+
+# An unsymbolized frame; groups are indentation, frame number, address,
+# module and offset in module
+RAW_FRAME_RE = re.compile(
+    rb'^([ \t]*)#(\d+) (0x[0-9a-fA-F]+) \((.+)\+(0x[0-9a-fA-F]+)\)$',
+    re.MULTILINE)
+
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+
+# {path: (binary_identity, build id)}
+MODULE_IDS = {}
+
+
+def elf_build_id(path):
+    '''Return the GNU build id of an ELF file as a hex string, or None
+    if it has none.'''
+
+    with open(path, 'rb') as f:
+        ident = f.read(16)
+        if ident[:4] != b'\x7fELF':
+            return None
+        order = '<' if ident[5] == 1 else '>'
+        if ident[4] == 2:
+            f.seek(0x20)
+            phoff, = struct.unpack(order + 'Q', f.read(8))
+            f.seek(0x36)
+            phdr_fmt = order + 'IIQQQQ'
+        else:
+            f.seek(0x1c)
+            phoff, = struct.unpack(order + 'I', f.read(4))
+            f.seek(0x2a)
+            phdr_fmt = order + 'IIIIII'
+        phentsize, phnum = struct.unpack(order + 'HH', f.read(4))
+        for i in range(phnum):
+            f.seek(phoff + i * phentsize)
+            fields = struct.unpack(phdr_fmt,
+                                   f.read(struct.calcsize(phdr_fmt)))
+            if ident[4] == 2:
+                p_type, p_offset, p_filesz = fields[0], fields[2], fields[5]
+            else:
+                p_type, p_offset, p_filesz = fields[0], fields[1], fields[4]
+            if p_type != PT_NOTE:
+                continue
+            f.seek(p_offset)
+            notes = f.read(p_filesz)
+            pos = 0
+            while pos + 12 <= len(notes):
+                namesz, descsz, ntype = struct.unpack(
+                    order + 'III', notes[pos:pos+12])
+                name_start = pos + 12
+                desc_start = name_start + (namesz + 3) // 4 * 4
+                if ntype == NT_GNU_BUILD_ID and \
+                        notes[name_start:name_start+namesz] == b'GNU\0':
+                    return notes[desc_start:desc_start+descsz].hex()
+                pos = desc_start + (descsz + 3) // 4 * 4
+    return None
+
+
+def module_id(path):
+    '''Return an identifier of the contents of the module at path: its
+    build id, or a digest of the file if it has none. Returns None if
+    the module does not exist.'''
+
+    try:
+        identity = binary_identity(path)
+    except OSError:
+        return None
+    cached = MODULE_IDS.get(path)
+    if cached and cached[0] == identity:
+        return cached[1]
+    build_id = elf_build_id(path)
+    if not build_id:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        build_id = 'sha1:' + h.hexdigest()
+    MODULE_IDS[path] = (identity, build_id)
+    return build_id
+
+
+def symbolizer_path():
+    'Find llvm-symbolizer, preferring the one built with clang.'
+
+    built = os.path.join(os.path.dirname(CLANG_BINARY), 'llvm-symbolizer')
+    if os.access(built, os.X_OK):
+        return built
+    return LLVM_SYMBOLIZER
+
+
+def run_symbolizer(module, offsets):
+    '''Symbolize offsets in module. Returns a list of symbolized frames
+    for each offset, in the same order. A symbolized frame is a list of
+    lines, more than one if there are inlined functions, each "function
+    file:line:column" or just the function if the location is unknown.
+    Unknown frames are None.'''
+
+    cmd = [symbolizer_path(), '--functions=linkage', '--inlining',
+           '--demangle', '--obj=' + module]
+    data = ''.join('0x{:x}\n'.format(x) for x in offsets).encode('ascii')
+    out = subp.check_output(cmd, input=data, stderr=subp.DEVNULL)
+    # The result for each address is pairs of function and location
+    # lines terminated by an empty line.
+    blocks = out.decode('utf-8', 'replace').split('\n\n')
+    assert len(blocks) >= len(offsets), (module, len(blocks), len(offsets))
+
+    frames = []
+    for block in blocks[:len(offsets)]:
+        lines = block.strip('\n').split('\n')
+        frame = []
+        for func, loc in zip(lines[::2], lines[1::2]):
+            if loc.startswith('??'):
+                if func != '??':
+                    frame.append(func)
+                continue
+            frame.append('{} {}'.format(func, loc))
+        frames.append(frame or None)
+    return frames
+
+
+class Symbolizer(object):
+    'Symbolizes outputs, using the frame cache in the database.'
+
+    def __init__(self, db):
+        self.db = db
+
+    def __resolve(self, keys):
+        '''Resolve a set of (module, offset). Returns ({(module, offset):
+        lines or None}, set of modules the symbolizer failed on).'''
+
+        ids = {}
+        for module in set(x[0] for x in keys):
+            ids[module] = module_id(module.decode('utf-8', 'replace'))
+        cache_keys = set((ids[m], off) for m, off in keys if ids[m])
+        cached = self.db.getSymbols(cache_keys)
+
+        missing = {}
+        for module, offset in keys:
+            key = (ids[module], offset)
+            if ids[module] and not key in cached:
+                missing.setdefault(module, set()).add(offset)
+        new = {}
+        failed = set()
+        for module, offsets in missing.items():
+            offsets = sorted(offsets)
+            try:
+                frames = run_symbolizer(module.decode('utf-8', 'replace'),
+                                        offsets)
+            except (OSError, subp.CalledProcessError) as e:
+                print('Failed to symbolize {}: {}'.format(module, e),
+                      file=sys.stderr)
+                failed.add(module)
+                continue
+            for offset, frame in zip(offsets, frames):
+                new[(ids[module], offset)] = frame
+        self.db.addSymbols(new)
+        cached.update(new)
+
+        return dict((key, cached.get((ids[key[0]], key[1])))
+                    for key in keys), failed
+
+    def symbolize(self, outputs):
+        '''Symbolize a list of outputs. Returns the symbolized outputs,
+        with None for those which have frames in a module the symbolizer
+        failed on.'''
+
+        keys = set()
+        for output in outputs:
+            for m in RAW_FRAME_RE.finditer(output):
+                keys.add((m.group(4), int(m.group(5), 16)))
+        if not keys:
+            return outputs
+        frames, failed = self.__resolve(keys)
+
+        def symbolize_one(output):
+            if any(m.group(4) in failed
+                   for m in RAW_FRAME_RE.finditer(output)):
+                return None
+            # Like LLVM, number inlined frames as separate frames.
+            frame_no = 0
+            result = []
+            pos = 0
+            for m in RAW_FRAME_RE.finditer(output):
+                if int(m.group(2)) == 0:
+                    frame_no = 0
+                result.append(output[pos:m.start()])
+                pos = m.end()
+                lines = frames[(m.group(4), int(m.group(5), 16))]
+                if not lines:
+                    # keep it unsymbolized
+                    lines = ['({}+{})'.format(
+                        m.group(4).decode('utf-8', 'replace'),
+                        m.group(5).decode('ascii'))]
+                for i, line in enumerate(lines):
+                    if i:
+                        result.append(b'\n')
+                    result.append(m.group(1))
+                    result.append('#{} {} {}'.format(
+                        frame_no, m.group(3).decode('ascii'),
+                        line).encode('utf-8'))
+                    frame_no += 1
+            result.append(output[pos:])
+            return b''.join(result)
+
+        return [symbolize_one(x) for x in outputs]
+
+
+def symbolize_pending(db, batch_size=SYMBOLIZE_BATCH_SIZE):
+    '''Symbolize all outputs which have not been symbolized yet. This
+    needs the binaries which produced them. Each distinct output is
+    symbolized once however many cases share it. Outputs are left
+    unsymbolized if the symbolizer fails on them.'''
+
+    pending = db.getUnsymbolizedOutputs()
+    if not pending:
+        return
+    symbolizer = Symbolizer(db)
+    num_failed = 0
+    for i in range(0, len(pending), batch_size):
+        print('\rSymbolizing outputs: {}/{}'.format(i, len(pending)),
+              end='', file=sys.stderr)
+        shas, outputs = zip(*db.getOutputBlobs(pending[i:i+batch_size]))
+        outputs = symbolizer.symbolize(list(outputs))
+        done = [x for x in zip(shas, outputs) if not x[1] is None]
+        num_failed += len(shas) - len(done)
+        db.setSymbolizedOutputs(done)
+    print('\rSymbolizing outputs: {0}/{0}'.format(len(pending)),
+          file=sys.stderr)
+    if num_failed:
+        print('Left {} outputs unsymbolized.'.format(num_failed),
+              file=sys.stderr)
+
+
+def main():
+    symbolize_pending(TriageDb())
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,14 @@ CREATE TABLE test_runs (
     start_time BIGINT NOT NULL,
     end_time BIGINT NOT NULL,
     clang_version INTEGER NOT NULL,
-    llvm_version INTEGER NOT NULL);
+    llvm_version INTEGER NOT NULL,
+    -- results are being added; end_time is the time of the last batch
+    in_progress BOOLEAN NOT NULL DEFAULT FALSE,
+    -- see run_clang.clang_digest(); runs with equal digests have
+    -- equal results
+    clang_digest TEXT);
 CREATE INDEX test_runs_start_time ON test_runs(start_time);
+CREATE INDEX test_runs_clang_digest ON test_runs(clang_digest);
 CREATE UNIQUE INDEX test_runs_versions
     ON test_runs(clang_version, llvm_version);
 
@@ -14,26 +20,68 @@ CREATE TABLE result_strings (
 
 INSERT INTO result_strings (str) VALUES ('OK');
 
-CREATE TABLE results (
+-- Results are stored as intervals of test runs: the case had the result
+-- in the runs first_run <= id < end_run, or in all runs since first_run
+-- if end_run is NULL. A row is only added when the result of a case
+-- changes.
+CREATE TABLE result_changes (
     id BIGSERIAL PRIMARY KEY,
     case_id BIGINT NOT NULL,
-    test_run BIGINT NOT NULL,
+    first_run BIGINT NOT NULL,
+    end_run BIGINT,
     result BIGINT NOT NULL,
     FOREIGN KEY(case_id) REFERENCES case_contents(case_id)
         ON UPDATE CASCADE ON DELETE CASCADE,
-    FOREIGN KEY(test_run) REFERENCES test_runs(id)
-        ON UPDATE CASCADE ON DELETE CASCADE,
     FOREIGN KEY(result) REFERENCES result_strings(id)
         ON UPDATE CASCADE ON DELETE CASCADE);
-CREATE INDEX results_case_id ON results(case_id);
-CREATE INDEX results_test_run ON results(test_run);
-CREATE INDEX results_result ON results(result);
-CREATE UNIQUE INDEX results_case_id_test_run ON results(case_id, test_run);
+CREATE INDEX result_changes_case_id ON result_changes(case_id);
+CREATE UNIQUE INDEX result_changes_current
+    ON result_changes(case_id) WHERE end_run IS NULL;
+CREATE INDEX result_changes_first_run ON result_changes(first_run);
+CREATE INDEX result_changes_end_run ON result_changes(end_run);
+CREATE INDEX result_changes_result ON result_changes(result);
+
+-- The cases tested so far in an in-progress test run. Rows are deleted
+-- when the run finishes.
+CREATE TABLE run_progress (
+    test_run BIGINT REFERENCES test_runs(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    case_id BIGINT REFERENCES cases(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    PRIMARY KEY (test_run, case_id));
+
+-- One row per case per test run, like results were once stored. id is
+-- that of the row in result_changes.
+CREATE VIEW results AS
+    SELECT rc.id, rc.case_id, r.id AS test_run, rc.result
+    FROM result_changes AS rc, test_runs AS r
+    WHERE r.id >= rc.first_run
+        AND (rc.end_run IS NULL OR r.id < rc.end_run)
+        AND (NOT r.in_progress OR EXISTS (
+            SELECT 1 FROM run_progress AS p
+            WHERE p.test_run=r.id AND p.case_id=rc.case_id));
+
+-- Distinct clang outputs, compressed with codec. sha1 and size are
+-- those of the uncompressed output. Blobs no case refers to are deleted
+-- when a test run finishes.
+CREATE TABLE output_blobs (
+   sha1 TEXT PRIMARY KEY,
+   output BYTEA NOT NULL,
+   codec SMALLINT NOT NULL DEFAULT 1 REFERENCES codecs(id),
+   size INTEGER NOT NULL);
 
+-- result is the result the output was recorded for. Outputs are
+-- recorded unsymbolized and symbolized later (see symbolize.py).
 CREATE TABLE outputs (
    case_id BIGINT UNIQUE REFERENCES cases(id)
        ON UPDATE CASCADE ON DELETE CASCADE,
-   output BYTEA NOT NULL);
+   output_sha1 TEXT NOT NULL REFERENCES output_blobs(sha1),
+   result BIGINT REFERENCES result_strings(id)
+       ON UPDATE CASCADE ON DELETE CASCADE,
+   symbolized BOOLEAN NOT NULL DEFAULT FALSE);
+CREATE INDEX outputs_output_sha1 ON outputs(output_sha1);
+CREATE INDEX outputs_unsymbolized ON outputs(output_sha1)
+    WHERE NOT symbolized;
 
 CREATE VIEW results_view AS
     SELECT test_run, cases.id, sha1, str
@@ -42,6 +90,31 @@ CREATE VIEW results_view AS
         AND results.result = res.id;
 
 CREATE VIEW sha_output_view AS
-    SELECT sha1, output
+    SELECT sha1, output_sha1
     FROM cases, outputs
     WHERE cases.id = outputs.case_id;
+
+-- See run_clang.stack_fingerprint(). Updated when outputs are
+-- symbolized.
+CREATE TABLE case_fingerprints (
+    case_id BIGINT PRIMARY KEY REFERENCES cases(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    fingerprint TEXT NOT NULL);
+CREATE INDEX case_fingerprints_fingerprint
+    ON case_fingerprints(fingerprint);
+
+-- The runtime in seconds of the latest test of each case which did not
+-- hang. Used to set per-case time limits (see run_clang.case_timeout()).
+CREATE TABLE case_runtimes (
+    case_id BIGINT PRIMARY KEY REFERENCES cases(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    runtime REAL NOT NULL);
+
+-- Symbolized stack frames by the build id of the module (or a digest of
+-- it if it has none) and the offset in it. frames is the frame's lines
+-- (several if there are inlined functions), empty if unknown.
+CREATE TABLE symbol_cache (
+    build_id TEXT NOT NULL,
+    module_offset BIGINT NOT NULL,
+    frames TEXT NOT NULL,
+    PRIMARY KEY (build_id, module_offset));
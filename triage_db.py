@@ -1,19 +1,34 @@
 import psycopg2 as pg
+import psycopg2.extensions as pgext
 import os
 import time
 import zlib
 import hashlib
 import itertools
+from collections import namedtuple
 import subprocess as subp
 from enum import Enum
 import sys
+import socket
+import io
+import binascii
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from utils import all_files_recursive
-from config import DB_NAME, CREATE_SCHEMA_COMMAND
+from run_clang import stack_fingerprint, HANG_REASON
+from config import DB_NAME, CREATE_SCHEMA_COMMAND, TEST_RUN_BATCH_SIZE
+from config import REDUCE_LEASE_TIME, IMPORT_BATCH_SIZE
+from config import BLOB_CODEC, CODEC_TRAIN_SAMPLES, CODEC_DICT_SIZE
+from config import RECOMPRESS_BATCH_SIZE, CASE_FETCH_SIZE
 import schema_migration
 
 
-SCHEMA_VERSION = 2
+SCHEMA_VERSION = 15
 
 
 class ReduceResult(Enum):
@@ -25,6 +40,132 @@ class ReduceResult(Enum):
     dumb = 3      # Creduce failed, reduced with dumb reducer
 
 
+# A failure reason to bisect, with the smallest case which changed from
+# OK to it between two test runs (see bisect_queue in bisect.sql).
+BisectWork = namedtuple('BisectWork', [
+    'result_id', 'reason', 'sha', 'contents', 'run_id',
+    'old_versions', 'new_versions'])
+
+
+def copy_row(fields):
+    '''Format a row for COPY ... FROM STDIN in the text format. fields
+    may be str, bytes (for BYTEA columns), int or None.'''
+
+    out = []
+    for x in fields:
+        if x is None:
+            out.append(b'\\N')
+        elif isinstance(x, bytes):
+            # hex format, with the backslash escaped for COPY
+            out.append(b'\\\\x' + binascii.hexlify(x))
+        else:
+            out.append(str(x).replace('\\', '\\\\').replace(
+                '\t', '\\t').replace('\n', '\\n').replace(
+                    '\r', '\\r').encode('utf-8'))
+    return b'\t'.join(out) + b'\n'
+
+
+# The ids of the codecs which always exist (see codecs.sql)
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+
+# {kind of blob: (table, blob column, indexed key column)}
+BLOB_TABLES = {
+    'cases': ('case_contents', 'z_contents', 'case_id'),
+    'outputs': ('output_blobs', 'output', 'sha1'),
+    'reduced': ('reduced_contents', 'contents', 'reduced_id')}
+
+
+class Codec(object):
+    '''A compression method for blobs: 'none', 'zlib', or 'zlib-dict' or
+    'zstd-dict', which use a preset dictionary trained on a sample of
+    the blobs (see train_dictionary()). zstd-dict needs the zstandard
+    module. Codecs can be pickled to send them to worker processes.'''
+
+    def __init__(self, id_, name, dictionary=None):
+        self.id = id_
+        self.name = name
+        self.dictionary = dictionary and bytes(dictionary)
+        self.zstd = None
+
+    def __getstate__(self):
+        # zstandard's (de)compressors cannot be pickled.
+        state = self.__dict__.copy()
+        state['zstd'] = None
+        return state
+
+    def __zstd(self):
+        if self.zstd is None:
+            if zstandard is None:
+                raise RuntimeError(
+                    'The zstd-dict codec needs the zstandard module.')
+            d = zstandard.ZstdCompressionDict(self.dictionary)
+            self.zstd = (zstandard.ZstdCompressor(level=9, dict_data=d),
+                         zstandard.ZstdDecompressor(dict_data=d))
+        return self.zstd
+
+    def compress(self, data):
+        'Compress data.'
+        if self.name == 'none':
+            return bytes(data)
+        elif self.name == 'zlib':
+            return zlib.compress(data)
+        elif self.name == 'zlib-dict':
+            c = zlib.compressobj(9, zdict=self.dictionary)
+            return c.compress(data) + c.flush()
+        elif self.name == 'zstd-dict':
+            return self.__zstd()[0].compress(data)
+        raise ValueError('Unknown codec: ' + self.name)
+
+    def decompress(self, blob):
+        'Decompress a blob compressed by this codec.'
+        if self.name == 'none':
+            return bytes(blob)
+        elif self.name == 'zlib':
+            return zlib.decompress(blob)
+        elif self.name == 'zlib-dict':
+            d = zlib.decompressobj(zdict=self.dictionary)
+            return d.decompress(blob) + d.flush()
+        elif self.name == 'zstd-dict':
+            return self.__zstd()[1].decompress(blob)
+        raise ValueError('Unknown codec: ' + self.name)
+
+
+def train_dictionary(name, samples, size=CODEC_DICT_SIZE):
+    '''Build a dictionary of at most size bytes for the codec name from
+    a list of sample blobs.'''
+
+    if name == 'zstd-dict':
+        if zstandard is None:
+            raise RuntimeError(
+                'The zstd-dict codec needs the zstandard module.')
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    assert name == 'zlib-dict', name
+    # zlib can only refer back 32 KiB, and nearer matches are cheaper.
+    # Take the lines which would save the most, most useful last.
+    size = min(size, 32768)
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(x for x in sample.split(b'\n') if len(x) > 2))
+    lines = []
+    total = 0
+    for line, n in sorted(counts.items(),
+                          key=lambda x: x[1] * len(x[0]), reverse=True):
+        if n < 2 or total + len(line) + 1 > size:
+            continue
+        lines.append(line + b'\n')
+        total += len(line) + 1
+    return b''.join(reversed(lines))
+
+
+def load_codecs(conn):
+    'Returns a {id: Codec} dict of the codecs in the database.'
+
+    with conn.cursor() as c:
+        c.execute('SELECT id, name, dictionary FROM codecs')
+        return dict((x[0], Codec(*x)) for x in c)
+
+
 def read_file(path):
     'Read an entire file as binary.'
 
@@ -50,6 +191,7 @@ class TriageDb(object):
                     self.OK_ID = c.fetchone()[0]
                 except pg.ProgrammingError:
                     raise DbNotInitialized()
+        self._clearResultIds()
         with self.conn:
             version = self.__get_schema_version()
         if version > SCHEMA_VERSION:
@@ -63,6 +205,7 @@ class TriageDb(object):
             with self.conn:
                 newver = self.__get_schema_version()
                 assert newver == SCHEMA_VERSION, newver
+        self._loadCodecs()
 
     def __get_schema_version(self):
         with self.conn.cursor() as c:
@@ -76,7 +219,135 @@ class TriageDb(object):
 
     def __migrate_schema(self, version):
         assert version < SCHEMA_VERSION
-        schema_migration.MIGRATE_FROM[version](self.conn)
+        while version < SCHEMA_VERSION:
+            schema_migration.MIGRATE_FROM[version](self.conn)
+            newver = self.__get_schema_version()
+            assert newver > version, newver
+            version = newver
+
+    def _loadCodecs(self):
+        '''(Re)load the codecs and choose the ones to compress new blobs
+        with: the newest BLOB_CODEC codec trained for the kind of blob,
+        or zlib if there is none. Can be called inside or outside a
+        transaction.'''
+
+        idle = self.conn.get_transaction_status() == \
+            pgext.TRANSACTION_STATUS_IDLE
+        self.codecs = load_codecs(self.conn)
+        with self.conn.cursor() as c:
+            c.execute('SELECT DISTINCT ON (kind) kind, id FROM codecs ' +
+                      'WHERE name=%s AND kind IS NOT NULL ' +
+                      'ORDER BY kind, id DESC', (BLOB_CODEC, ))
+            current = dict(c.fetchall())
+        if idle:
+            self.conn.commit()
+        if BLOB_CODEC == 'zstd-dict' and zstandard is None:
+            current = {}
+        default = CODEC_NONE if BLOB_CODEC == 'none' else CODEC_ZLIB
+        self.current_codecs = dict(
+            (kind, self.codecs[current.get(kind, default)])
+            for kind in BLOB_TABLES)
+
+    def getCodecs(self):
+        'Returns a {id: Codec} dict of all codecs.'
+        return self.codecs
+
+    def reloadCodecs(self):
+        '''Reload the codecs, picking up the ones trained by other
+        processes since they were loaded.'''
+        self._loadCodecs()
+
+    def codec(self, kind):
+        '''Returns the Codec to compress new blobs of kind ('cases',
+        'outputs' or 'reduced') with.'''
+        return self.current_codecs[kind]
+
+    def decompress(self, codec_id, blob):
+        'Decompress a blob compressed with the codec codec_id.'
+        if not codec_id in self.codecs:
+            # trained by another process after we loaded them
+            self._loadCodecs()
+        return self.codecs[codec_id].decompress(blob)
+
+    def trainCodec(self, kind, name=BLOB_CODEC,
+                   num_samples=CODEC_TRAIN_SAMPLES):
+        '''Train a new codec for the blobs of kind on a random sample of
+        num_samples of them. New blobs are compressed with it if its name
+        is BLOB_CODEC; recompressBlobs() recompresses the old ones.
+        Returns the Codec, or None if there are no blobs to sample.'''
+
+        table, column = BLOB_TABLES[kind][:2]
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT codec, {} FROM {} '.format(column, table) +
+                          'ORDER BY random() LIMIT %s', (num_samples, ))
+                rows = c.fetchall()
+        if not rows:
+            return None
+        samples = [self.decompress(x[0], x[1]) for x in rows]
+        dictionary = train_dictionary(name, samples)
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('LOCK TABLE codecs IN EXCLUSIVE MODE')
+                c.execute('INSERT INTO codecs ' +
+                          '    (id, name, kind, dictionary, created) ' +
+                          'SELECT MAX(id)+1, %s, %s, %s, %s FROM codecs ' +
+                          'RETURNING id', (name, kind, dictionary,
+                                           int(time.time())))
+                codec_id = c.fetchone()[0]
+        self._loadCodecs()
+        return self.codecs[codec_id]
+
+    def recompressBlobs(self, kind, batch_size=RECOMPRESS_BATCH_SIZE,
+                        progress=False, start=None, deadline=None):
+        '''Recompress the blobs of kind which are not compressed with the
+        current codec, in transactions of batch_size blobs. The table is
+        walked in key order, starting from the key start if given, until
+        the end or until time.time() passes deadline. Each batch starts
+        from the last key seen, since the key of reduced_contents is not
+        unique. Returns (number of blobs, total size before, total size
+        after, last key), where the last key is None if the walk reached
+        the end.'''
+
+        table, column, key = BLOB_TABLES[kind]
+        codec = self.codec(kind)
+        num = before = after = 0
+        last = start
+        while deadline is None or time.time() < deadline:
+            with self.conn:
+                with self.conn.cursor() as c:
+                    c.execute(
+                        'SELECT {}, codec, {} FROM {} '.format(
+                            key, column, table) +
+                        'WHERE codec<>%s ' +
+                        ('' if last is None else
+                         'AND {}>=%s '.format(key)) +
+                        'ORDER BY {} LIMIT %s '.format(key) +
+                        'FOR UPDATE SKIP LOCKED',
+                        (codec.id, ) + (() if last is None else (last, )) +
+                        (batch_size, ))
+                    rows = c.fetchall()
+                    updates = []
+                    for last, codec_id, blob in rows:
+                        new = codec.compress(self.decompress(codec_id, blob))
+                        updates.append((codec.id, new, last))
+                        before += len(blob)
+                        after += len(new)
+                    c.executemany(
+                        'UPDATE {} SET codec=%s, {}=%s '.format(
+                            table, column) +
+                        'WHERE {}=%s'.format(key), updates)
+            if not rows:
+                last = None
+                break
+            num += len(rows)
+            if progress:
+                print('\r{}: {} blobs, {:.1f} MB -> {:.1f} MB'.format(
+                    kind, num, before/1e6, after/1e6),
+                      end='', file=sys.stderr)
+        if progress and num:
+            print(file=sys.stderr)
+        return num, before, after, last
 
     @staticmethod
     def createSchema():
@@ -98,22 +369,92 @@ class TriageDb(object):
 
     def addCase(self, sha, contents):
         'Add a case. It must not aldeary exist.'
-        self.addCases([(sha, contents)])
+        with self.conn:
+            with self.conn.cursor() as c:
+                codec = self.codec('cases')
+                c.execute('INSERT INTO case_view ' +
+                          '    (sha1, z_contents, size, codec) ' +
+                          'SELECT %s, %s, %s, %s ' +
+                          'WHERE NOT EXISTS (' +
+                          '    SELECT sha1 FROM case_view WHERE sha1=%s)',
+                          (sha, codec.compress(contents), len(contents),
+                           codec.id, sha))
+
+    def addCases(self, cases, batch_size=IMPORT_BATCH_SIZE, progress=False):
+        '''Add several cases, skipping those which already exist. The
+        cases are added in transactions of batch_size cases. Returns the
+        number of cases added.'''
+        codec = self.codec('cases')
+        cases = ((x[0], codec.id, codec.compress(x[1]), len(x[1]))
+                 for x in cases)
+        return self.addCompressedCases(cases, batch_size, progress)
+
+    def addCompressedCases(self, cases, batch_size=IMPORT_BATCH_SIZE,
+                           progress=False):
+        '''Add (sha1, codec id, compressed contents, size) tuples as
+        cases, skipping those which already exist. See addCases().'''
+
+        start = time.time()
+        num_seen = num_added = 0
+        while True:
+            batch = list(itertools.islice(cases, batch_size))
+            if not batch:
+                break
+            num_added += self.__addCaseBatch(batch)
+            num_seen += len(batch)
+            if progress:
+                print('\r{} cases, {} new ({:.0f} cases/s)'.format(
+                    num_seen, num_added,
+                    num_seen / max(time.time() - start, 1e-3)),
+                      end='', file=sys.stderr)
+        if progress:
+            print(file=sys.stderr)
+        return num_added
 
-    # FIXME this may be slow?
-    def addCases(self, cases):
-        'Add several cases.'
+    def __addCaseBatch(self, batch):
+        '''COPY a batch of compressed cases to case_staging and insert the
+        new ones from there. Returns the number of cases added.'''
+
+        data = io.BytesIO(b''.join(
+            copy_row([sha, codec, z_contents, size])
+            for sha, codec, z_contents, size in batch))
         with self.conn:
             with self.conn.cursor() as c:
-                c.executemany(
-                    'INSERT INTO case_view (sha1, z_contents, size) ' +
-                    'SELECT %s, %s, %s ' +
-                    'WHERE NOT EXISTS (' +
-                    '    SELECT sha1 FROM case_view WHERE sha1=%s)',
-                    ((x[0], zlib.compress(x[1]), len(x[1]), x[0])
-                     for x in cases))
-
-    def populateCases(self, cases_path, stop_after=None):
+                # Also serializes concurrent imports.
+                c.execute('TRUNCATE case_staging')
+                c.copy_expert('COPY case_staging ' +
+                              '    (sha1, codec, z_contents, size) ' +
+                              'FROM STDIN', data)
+                c.execute('SET CONSTRAINTS cases_id_forward_fkey, ' +
+                          '    case_contents_case_id_forward_fkey DEFERRED')
+                c.execute('CREATE TEMP TABLE new_cases ( ' +
+                          '    id BIGINT, sha1 TEXT) ON COMMIT DROP')
+                c.execute('WITH new AS (' +
+                          '    INSERT INTO cases (sha1) ' +
+                          '    SELECT DISTINCT sha1 FROM case_staging AS s ' +
+                          '    WHERE NOT EXISTS (' +
+                          '        SELECT 1 FROM cases ' +
+                          '        WHERE cases.sha1=s.sha1) ' +
+                          '    RETURNING id, sha1) ' +
+                          'INSERT INTO new_cases SELECT * FROM new')
+                c.execute('INSERT INTO case_sizes (case_id, size) ' +
+                          'SELECT DISTINCT ON (n.id) n.id, s.size ' +
+                          'FROM new_cases AS n ' +
+                          '    JOIN case_staging AS s ON s.sha1=n.sha1')
+                c.execute('INSERT INTO case_contents ' +
+                          '    (case_id, codec, z_contents) ' +
+                          'SELECT DISTINCT ON (n.id) ' +
+                          '    n.id, s.codec, s.z_contents ' +
+                          'FROM new_cases AS n ' +
+                          '    JOIN case_staging AS s ON s.sha1=n.sha1')
+                c.execute('SET CONSTRAINTS cases_id_forward_fkey, ' +
+                          '    case_contents_case_id_forward_fkey IMMEDIATE')
+                c.execute('SELECT COUNT(*) FROM new_cases')
+                num_added = c.fetchone()[0]
+                c.execute('TRUNCATE case_staging')
+        return num_added
+
+    def populateCases(self, cases_path, stop_after=None, progress=True):
         '''Add files from a directory, recursively, as cases. Filenames do not
         matter.'''
         case_files = all_files_recursive(cases_path)
@@ -127,24 +468,69 @@ class TriageDb(object):
                 sha = hashlib.sha1(contents).hexdigest()
                 yield (sha, contents)
 
-        self.addCases(cases_iter())
+        return self.addCases(cases_iter(), progress=progress)
 
-    def iterateCases(self):
-        'Iterate through (sha1, contents) pairs.'
+    def iterateCases(self, compressed=False, itersize=CASE_FETCH_SIZE):
+        '''Iterate through (sha1, contents) pairs, smallest first. If
+        compressed=True, iterate through (sha1, codec id, compressed
+        contents) instead. The cases are streamed from a server-side
+        cursor on a separate connection, itersize at a time, so this
+        connection can be used meanwhile.'''
+        conn = pg.connect(database=DB_NAME)
+        try:
+            with conn:
+                with conn.cursor('iterate_cases') as c:
+                    c.itersize = itersize
+                    c.execute('SELECT cc.sha1, cc.codec, cc.z_contents ' +
+                              'FROM case_view AS cc ' +
+                              'ORDER BY cc.size')
+                    for sha, codec, blob in c:
+                        if compressed:
+                            yield sha, codec, bytes(blob)
+                        else:
+                            yield sha, self.decompress(codec, blob)
+        finally:
+            conn.close()
+
+    def getCases(self, shas, batch_size=CASE_FETCH_SIZE):
+        '''Iterate through (sha1, contents) of the cases with the sha1s
+        in shas, fetching batch_size at a time.'''
+        shas = list(shas)
+        for i in range(0, len(shas), batch_size):
+            with self.conn:
+                with self.conn.cursor() as c:
+                    c.execute('SELECT sha1, codec, z_contents ' +
+                              'FROM case_view WHERE sha1=ANY(%s)',
+                              (shas[i:i+batch_size], ))
+                    rows = c.fetchall()
+            for sha, codec, blob in rows:
+                yield sha, self.decompress(codec, blob)
+
+    def getCaseRuntimes(self):
+        'Returns a {sha1: runtime in seconds} dict of the recorded runtimes.'
         with self.conn:
-            c = self.conn.cursor()
-            c.execute('SELECT cc.sha1, cc.z_contents ' +
-                      'FROM case_view AS cc, case_sizes ' +
-                      'WHERE case_sizes.case_id = cc.id ' +
-                      'ORDER BY case_sizes.size')
-            return ((x[0], zlib.decompress(x[1])) for x in c)
-
-    def iterateDistinctReduced(self):
-        'Iterate through distinct reduced cases.'
+            with self.conn.cursor() as c:
+                c.execute('SELECT sha1, runtime ' +
+                          'FROM cases, case_runtimes ' +
+                          'WHERE cases.id=case_runtimes.case_id')
+                return dict(c.fetchall())
+
+    def getReducedShas(self):
+        'Returns a list of the sha1s of the distinct reduced cases.'
         with self.conn:
-            c = self.conn.cursor()
-            c.execute('SELECT DISTINCT contents FROM reduced_contents')
-            return (x[0] for x in c)
+            with self.conn.cursor() as c:
+                c.execute('SELECT DISTINCT sha1 FROM reduced_contents')
+                return [x[0] for x in c]
+
+    def getReduced(self, shas):
+        'Returns a list of (sha1, contents) of the reduced cases shas.'
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT DISTINCT ON (sha1) sha1, codec, contents ' +
+                          'FROM reduced_contents WHERE sha1=ANY(%s)',
+                          (list(shas), ))
+                rows = c.fetchall()
+        return [(x[0], self.decompress(x[1], x[2])) for x in rows]
 
     def iterateDumbReduced(self):
         '''Iterate through distinct dumb-reduced cases. Returns a list
@@ -154,11 +540,14 @@ class TriageDb(object):
             # FIXME get the latest failures... and get rid of that
             # File not yet open hack.
             c.execute('''
-                SELECT DISTINCT ON (contents) z_contents, contents, str
+                SELECT DISTINCT ON (reduced_contents.sha1)
+                    case_contents.codec, z_contents, reduced_contents.codec,
+                    contents, str
                 FROM case_contents, reduced_contents, reduced_cases,
                     result_strings,
                     (SELECT DISTINCT case_id
-                     FROM reduced_cases AS rc, results, result_strings
+                     FROM reduced_cases AS rc, result_changes AS results,
+                         result_strings
                      WHERE rc.result='dumb' AND original=case_id
                          AND results.result=result_strings.id
                          AND result_strings.str<>'OK'
@@ -170,14 +559,26 @@ class TriageDb(object):
                     AND str<>'OK'
                     AND str NOT LIKE '%File not yet open%'
                     AND str<>'Stack dump found' ''')
-        return ((zlib.decompress(x[0]), x[1], x[2]) for x in c)
+        return ((self.decompress(x[0], x[1]), self.decompress(x[2], x[3]),
+                 x[4]) for x in c)
 
     def iterateOutputs(self):
-        'Iterate through compiler outputs.'
+        'Iterate through the distinct compiler outputs.'
+        return (x[1] for x in self.iterateOutputBlobs())
+
+    def iterateOutputBlobs(self):
+        'Iterate through (sha1, output) of the distinct compiler outputs.'
         with self.conn:
             c = self.conn.cursor()
-            c.execute('SELECT output FROM outputs')
-            return (zlib.decompress(x[0]) for x in c)
+            c.execute('SELECT sha1, codec, output FROM output_blobs')
+            return ((x[0], self.decompress(x[1], x[2])) for x in c)
+
+    def getCaseShas(self):
+        'Get the set of sha1s of all cases in the database.'
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT sha1 FROM cases')
+                return set(x[0] for x in c)
 
     def getNumberOfCases(self):
         'Get the number of cases in the database.'
@@ -186,9 +587,12 @@ class TriageDb(object):
                 c.execute('SELECT count(*) from case_contents')
                 return c.fetchone()[0]
 
-    def _addTestRun(self, versions, start_time, end_time, results):
-        '''results: [(sha, result_string, output)].
-        Output is ignored if result_string="OK".'''
+    def _beginTestRun(self, versions, start_time, digest=None):
+        '''Create a new in-progress test run or resume an unfinished one
+        with the same versions. If a finished run has the same clang
+        digest, its results are copied to the new run. Returns (run_id,
+        set of sha1s of cases which already have a result in the run,
+        id of the run results were copied from or None).'''
 
         assert 'clang' in versions, versions
         assert 'llvm' in versions, versions
@@ -196,49 +600,421 @@ class TriageDb(object):
         llvm_version = versions['llvm']
         with self.conn:
             with self.conn.cursor() as c:
-                c.execute(
-                    'INSERT INTO test_runs (id, start_time, end_time, '
-                    '    clang_version, llvm_version) '
-                    'SELECT MAX(id)+1, %s, %s, %s, %s FROM test_runs '
-                    '    RETURNING id',
-                    (start_time, end_time, clang_version, llvm_version))
-                run_id = c.fetchone()[0]
-                self._addResults(c, run_id, results)
+                # An unfinished run with other versions can never be
+                # resumed, since we only test the current checkout.
+                c.execute('SELECT id FROM test_runs ' +
+                          'WHERE in_progress AND NOT (' +
+                          '    clang_version=%s AND llvm_version=%s)',
+                          (clang_version, llvm_version))
+                abandoned = [x[0] for x in c.fetchall()]
+                for abandoned_id in abandoned:
+                    self._deleteTestRun(c, abandoned_id)
+                if abandoned:
+                    # Their unsymbolized outputs can no longer be
+                    # symbolized; the cases get new outputs in this run.
+                    c.execute('DELETE FROM outputs WHERE NOT symbolized')
+                c.execute('SELECT id FROM test_runs ' +
+                          'WHERE in_progress AND clang_version=%s ' +
+                          '    AND llvm_version=%s',
+                          (clang_version, llvm_version))
+                r = c.fetchone()
+                if r:
+                    run_id = r[0]
+                    c.execute('UPDATE test_runs SET clang_digest=%s ' +
+                              'WHERE id=%s', (digest, run_id))
+                else:
+                    c.execute(
+                        'INSERT INTO test_runs (id, start_time, end_time, '
+                        '    clang_version, llvm_version, in_progress, '
+                        '    clang_digest) '
+                        'SELECT COALESCE(MAX(id), 0)+1, %s, %s, %s, %s, '
+                        '    TRUE, %s '
+                        'FROM test_runs RETURNING id',
+                        (start_time, start_time, clang_version,
+                         llvm_version, digest))
+                    run_id = c.fetchone()[0]
+                copied_from = None
+                if digest:
+                    copied_from = self._copyResultsByDigest(
+                        c, run_id, digest)
+                if not r and copied_from is None:
+                    # Outputs left unsymbolized by an earlier run were
+                    # produced by another binary; the cases get new
+                    # outputs in this run.
+                    c.execute('DELETE FROM outputs WHERE NOT symbolized')
+                c.execute('SELECT sha1 FROM run_progress, cases ' +
+                          'WHERE cases.id=run_progress.case_id ' +
+                          '    AND test_run=%s', (run_id, ))
+                done = set(x[0] for x in c)
+        return run_id, done, copied_from
+
+    def _deleteTestRun(self, cursor, run_id):
+        '''Delete an in-progress test run, reverting the result changes
+        it recorded. It must be the latest run.'''
+
+        c = cursor
+        c.execute('DELETE FROM result_changes WHERE first_run=%s',
+                  (run_id, ))
+        c.execute('UPDATE result_changes SET end_run=NULL ' +
+                  'WHERE end_run=%s', (run_id, ))
+        c.execute('DELETE FROM test_runs WHERE id=%s', (run_id, ))
+
+    def _copyResultsByDigest(self, cursor, run_id, digest):
+        '''Copy results from the latest finished run with the same clang
+        digest to run_id for cases which do not have a result yet.
+        Returns the id of the run copied from or None.'''
+
+        c = cursor
+        c.execute('SELECT MAX(id) FROM test_runs ' +
+                  'WHERE clang_digest=%s AND NOT in_progress', (digest, ))
+        src_id = c.fetchone()[0]
+        if src_id is None:
+            return None
+        c.execute('CREATE TEMP TABLE copied_results ON COMMIT DROP AS ' +
+                  'SELECT case_id, result FROM results AS src ' +
+                  'WHERE src.test_run=%s AND NOT EXISTS (' +
+                  '    SELECT 1 FROM run_progress AS p ' +
+                  '    WHERE p.test_run=%s AND p.case_id=src.case_id)',
+                  (src_id, run_id))
+        self._recordResults(c, run_id, 'copied_results')
+        c.execute('DROP TABLE copied_results')
+        return src_id
+
+    def _recordResults(self, cursor, run_id, table):
+        '''Record the results of the in-progress test run run_id in
+        table, which has columns case_id and result. Only changes are
+        stored: the current row of a case in result_changes is ended and
+        a new one started if the result differs.'''
+
+        c = cursor
+        c.execute('INSERT INTO run_progress (test_run, case_id) ' +
+                  'SELECT %s, case_id FROM ' + table + ' ' +
+                  'WHERE case_id IS NOT NULL ON CONFLICT DO NOTHING',
+                  (run_id, ))
+        c.execute('UPDATE result_changes AS rc SET end_run=%s ' +
+                  'FROM ' + table + ' AS n ' +
+                  'WHERE rc.case_id=n.case_id AND rc.end_run IS NULL ' +
+                  '    AND rc.result<>n.result AND rc.first_run<%s',
+                  (run_id, run_id))
+        c.execute('INSERT INTO result_changes (case_id, first_run, result) ' +
+                  'SELECT n.case_id, %s, n.result ' +
+                  'FROM ' + table + ' AS n ' +
+                  'WHERE n.case_id IS NOT NULL AND NOT EXISTS (' +
+                  '    SELECT 1 FROM result_changes AS rc ' +
+                  '    WHERE rc.case_id=n.case_id AND rc.end_run IS NULL)',
+                  (run_id, ))
+
+    def _addTestRunResults(self, run_id, results):
+        '''Add a batch of results to an in-progress test run.
+        results: [(sha, result_string, output, runtime)].
+        Output is ignored if result_string="OK".'''
+
+        try:
+            with self.conn:
+                with self.conn.cursor() as c:
+                    self._addResults(c, run_id, results)
+                    c.execute('UPDATE test_runs SET end_time=%s ' +
+                              'WHERE id=%s', (int(time.time()), run_id))
+        except BaseException:
+            # The cache may have ids of rolled back result strings.
+            self._clearResultIds()
+            raise
+
+    def _finishTestRun(self, run_id, end_time):
+        'Mark an in-progress test run as finished.'
+
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('UPDATE test_runs ' +
+                          'SET end_time=%s, in_progress=FALSE ' +
+                          'WHERE id=%s', (end_time, run_id))
+                # All cases have now been tested in the run.
+                c.execute('DELETE FROM run_progress WHERE test_run=%s',
+                          (run_id, ))
+                # Outputs no case has any more
+                c.execute('DELETE FROM output_blobs AS b ' +
+                          'WHERE NOT EXISTS (SELECT 1 FROM outputs AS o ' +
+                          '                  WHERE o.output_sha1=b.sha1)')
                 # delete changed reduce results where new result != OK
                 c.execute("DELETE FROM reduced_cases WHERE original IN (" +
                           "    SELECT case_id FROM changed_results " +
                           "    WHERE new<>%s)",
                           (self.OK_ID, ))
+                self._updateReduceQueue(c)
+                self._updateBisectQueue(c)
+
+    def _updateBisectQueue(self, cursor):
+        '''Queue the failure reasons which some case changed to from OK in
+        the last test run for bisection, unless already bisected or
+        queued.'''
+
+        cursor.execute(
+            'INSERT INTO bisect_queue (result, old_run, new_run, case_id) '
+            'SELECT DISTINCT ON (ch.new) ch.new, '
+            '    (SELECT MIN(id) FROM last_2_runs_view), '
+            '    (SELECT MAX(id) FROM last_2_runs_view), ch.case_id '
+            'FROM changed_results AS ch, case_view AS cv '
+            'WHERE ch.old=%s AND cv.id=ch.case_id '
+            '    AND NOT EXISTS ('
+            '        SELECT 1 FROM bisections AS b '
+            '        WHERE b.result=ch.new) '
+            'ORDER BY ch.new, cv.size, cv.sha1 '
+            'ON CONFLICT (result) DO NOTHING', (self.OK_ID, ))
+
+    def _updateReduceQueue(self, cursor):
+        '''Bring the reduce queue up to date with the results of the last
+        test run.'''
+
+        c = cursor
+        # Cases which no longer fail the same way. If they fail in
+        # another way, they are queued again below.
+        c.execute('DELETE FROM reduce_queue AS q WHERE NOT EXISTS (' +
+                  '    SELECT 1 FROM last_run_results AS r ' +
+                  '    WHERE r.case_id=q.case_id AND r.result=q.result)')
+        # Hangs are not reduced, since a reducer could not tell a hang
+        # from a variant which is merely slow.
+        c.execute('INSERT INTO reduce_queue (case_id, result, ' +
+                  '    fingerprint, priority, size) ' +
+                  'SELECT r.case_id, r.result, f.fingerprint, 2, s.size ' +
+                  'FROM last_run_results AS r ' +
+                  '    JOIN case_sizes AS s ON s.case_id=r.case_id ' +
+                  '    LEFT JOIN case_fingerprints AS f ' +
+                  '        ON f.case_id=r.case_id ' +
+                  'WHERE r.result<>%s ' +
+                  '    AND r.result NOT IN (SELECT id FROM result_strings ' +
+                  '                         WHERE str=%s) ' +
+                  '    AND NOT EXISTS (SELECT 1 FROM reduced_cases AS rc ' +
+                  '                    WHERE rc.original=r.case_id) ' +
+                  '    AND NOT EXISTS (SELECT 1 FROM reduce_queue AS q ' +
+                  '                    WHERE q.case_id=r.case_id)',
+                  (self.OK_ID, HANG_REASON))
+        # Reasons and buckets of which nothing has been reduced yet go
+        # first.
+        c.execute('CREATE TEMP TABLE reduced_buckets ON COMMIT DROP AS ' +
+                  'SELECT DISTINCT r.result, f.fingerprint ' +
+                  'FROM reduced_cases AS rc ' +
+                  '    JOIN last_run_results AS r ON r.case_id=rc.original ' +
+                  '    LEFT JOIN case_fingerprints AS f ' +
+                  '        ON f.case_id=rc.original')
+        c.execute('UPDATE reduce_queue AS q SET priority=CASE ' +
+                  '    WHEN NOT EXISTS (' +
+                  '        SELECT 1 FROM reduced_buckets AS b ' +
+                  '        WHERE b.result=q.result) THEN 0 ' +
+                  '    WHEN q.fingerprint IS NULL OR NOT EXISTS (' +
+                  '        SELECT 1 FROM reduced_buckets AS b ' +
+                  '        WHERE b.result=q.result ' +
+                  '            AND b.fingerprint=q.fingerprint) THEN 1 ' +
+                  '    ELSE 2 END')
+
+    def getUnfinishedTestRunVersions(self):
+        '''Returns the versions of the latest interrupted test run, or None
+        if there is none.'''
+
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT clang_version, llvm_version ' +
+                          'FROM test_runs WHERE in_progress ' +
+                          'ORDER BY id DESC LIMIT 1')
+                r = c.fetchone()
+        if r is None:
+            return None
+        return {'clang': r[0], 'llvm': r[1]}
+
+    def testRun(self, versions, digest=None):
+        '''Get a context manager for test runs. digest identifies the
+        tested binary and parameters (see run_clang.clang_digest()).'''
+        return TriageDb.TestRunContext(self, versions, digest)
 
-    def testRun(self, versions):
-        'Get a context manager for test runs.'
-        return TriageDb.TestRunContext(self, versions)
+    def _resultIds(self, cursor, strings):
+        '''Get the ids of result strings, inserting those which do not
+        exist yet. Returns a {str: id} dict including at least strings.
+        The ids are cached; if the transaction is rolled back, the cache
+        must be cleared with _clearResultIds().'''
+
+        c = cursor
+        missing = [x for x in set(strings) if not x in self.result_ids]
+        if missing:
+            c.executemany('INSERT INTO result_strings (str) VALUES (%s) ' +
+                          'ON CONFLICT DO NOTHING',
+                          [(x, ) for x in missing])
+            c.execute('SELECT str, id FROM result_strings ' +
+                      'WHERE str=ANY(%s)', (missing, ))
+            self.result_ids.update(c.fetchall())
+        return self.result_ids
+
+    def _clearResultIds(self):
+        'Clear the cache of result string ids.'
+        self.result_ids = {'OK': self.OK_ID}
 
     def _addResults(self, cursor, run_id, results):
-        '''results: [(sha, result_string, output)].
-        Output is ignored if result_string="OK".'''
+        '''results: [(sha, result_string, output, runtime)].
+        Output is ignored if result_string="OK". runtime is the time in
+        seconds the test took, or None if unknown.'''
+
+        c = cursor
+        ids = self._resultIds(c, (x[1] for x in results))
+        # Only the sha1s of the outputs are sent at first.
+        # {sha1 of output: output}
+        blobs = {}
+        rows = []
+        for sha, reason, output, runtime in results:
+            output_sha = None
+            if reason != 'OK':
+                output_sha = hashlib.sha1(output).hexdigest()
+                blobs[output_sha] = output
+            # Hangs' runtimes would only tell the time limit, so they are
+            # not recorded.
+            rows.append(copy_row([sha, ids[reason], output_sha,
+                                  runtime if reason != HANG_REASON
+                                  else None]))
+        data = io.BytesIO(b''.join(rows))
+        c.execute('CREATE TEMP TABLE new_results ( ' +
+                  '    sha1 TEXT NOT NULL, ' +
+                  '    result BIGINT NOT NULL, ' +
+                  '    output_sha1 TEXT, ' +
+                  '    runtime REAL) ON COMMIT DROP')
+        c.copy_expert('COPY new_results FROM STDIN', data)
+        c.execute('ALTER TABLE new_results ADD COLUMN case_id BIGINT')
+        c.execute('UPDATE new_results AS n SET case_id=cases.id ' +
+                  'FROM cases WHERE cases.sha1=n.sha1')
+        c.execute('ANALYZE new_results')
+
+        self._recordResults(c, run_id, 'new_results')
+        # Replace outputs of cases whose result changed. Outputs of
+        # unchanged failures are kept, since they have already been
+        # symbolized. New outputs are symbolized by
+        # symbolize.symbolize_pending(), which also updates their
+        # fingerprints.
+        c.execute('DELETE FROM outputs USING new_results AS n ' +
+                  'WHERE outputs.case_id=n.case_id AND n.result<>%s ' +
+                  '    AND outputs.result IS DISTINCT FROM n.result',
+                  (self.OK_ID, ))
+        c.execute('INSERT INTO case_runtimes ' +
+                  'SELECT case_id, runtime FROM new_results ' +
+                  'WHERE runtime IS NOT NULL AND case_id IS NOT NULL ' +
+                  'ON CONFLICT (case_id) ' +
+                  '    DO UPDATE SET runtime=EXCLUDED.runtime')
+
+        # What remains are the cases needing an output.
+        c.execute('DELETE FROM new_results AS n ' +
+                  'WHERE n.result=%s OR n.case_id IS NULL OR EXISTS (' +
+                  '    SELECT 1 FROM outputs ' +
+                  '    WHERE outputs.case_id=n.case_id)', (self.OK_ID, ))
+        # Only send the outputs which are not stored yet.
+        c.execute('SELECT DISTINCT output_sha1 FROM new_results AS n ' +
+                  'WHERE NOT EXISTS (SELECT 1 FROM output_blobs AS b ' +
+                  '                  WHERE b.sha1=n.output_sha1)')
+        self._addOutputBlobs(c, [(x[0], blobs[x[0]]) for x in c.fetchall()])
+        c.execute('INSERT INTO outputs (case_id, output_sha1, result, ' +
+                  '    symbolized) ' +
+                  'SELECT case_id, output_sha1, result, FALSE ' +
+                  'FROM new_results')
+        c.execute('DROP TABLE new_results')
+
+    def _addOutputBlobs(self, cursor, blobs):
+        '''Store outputs which are not already stored. blobs: [(sha1 of
+        output, output)].'''
 
+        if not blobs:
+            return
         c = cursor
-        # insert result strings if they do not already exist
-        unique_results = set(x[1] for x in results)
-        c.executemany('INSERT INTO result_strings (str) SELECT %s ' +
-                      'WHERE NOT EXISTS ( ' +
-                      '    SELECT 1 from result_strings WHERE str=%s)',
-                      ((x, x) for x in unique_results))
-        c.executemany('INSERT INTO results (case_id, test_run, result) ' +
-                      '    (SELECT cases.id, %s, result_strings.id ' +
-                      '     FROM cases, result_strings ' +
-                      '     WHERE cases.sha1=%s AND str=%s)',
-                      [(run_id, x[0], x[1]) for x in results])
-        # insert/replace outputs
-        outputs = [(x[0], x[2]) for x in results if x[1] != 'OK']
-
-        c.executemany('DELETE FROM outputs ' +
-                      'WHERE case_id=(SELECT id FROM cases WHERE sha1=%s)',
-                      ((x[0],) for x in outputs))
-        c.executemany('INSERT INTO outputs ' +
-                      'SELECT id, %s FROM cases WHERE sha1=%s',
-                      [(zlib.compress(x[1]), x[0]) for x in outputs])
+        codec = self.codec('outputs')
+        data = io.BytesIO(b''.join(
+            copy_row([sha, codec.id, codec.compress(output), len(output)])
+            for sha, output in blobs))
+        c.execute('CREATE TEMP TABLE new_blobs ( ' +
+                  '    sha1 TEXT NOT NULL, ' +
+                  '    codec SMALLINT NOT NULL, ' +
+                  '    output BYTEA NOT NULL, ' +
+                  '    size INTEGER NOT NULL) ON COMMIT DROP')
+        c.copy_expert('COPY new_blobs FROM STDIN', data)
+        c.execute('INSERT INTO output_blobs (sha1, codec, output, size) ' +
+                  'SELECT sha1, codec, output, size FROM new_blobs ' +
+                  'ON CONFLICT (sha1) DO NOTHING')
+        c.execute('DROP TABLE new_blobs')
+
+    def getUnsymbolizedOutputs(self):
+        '''Returns a list of the sha1s of the distinct outputs some case
+        has not had symbolized yet.'''
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT DISTINCT output_sha1 FROM outputs ' +
+                          'WHERE NOT symbolized ORDER BY output_sha1')
+                return [x[0] for x in c]
+
+    def getOutputShas(self):
+        'Returns a list of the sha1s of the distinct outputs.'
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT sha1 FROM output_blobs')
+                return [x[0] for x in c]
+
+    def getOutputBlobs(self, shas):
+        'Returns a list of (sha1, output) for the output sha1s.'
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT sha1, codec, output FROM output_blobs ' +
+                          'WHERE sha1=ANY(%s)', (list(shas), ))
+                rows = c.fetchall()
+        return [(x[0], self.decompress(x[1], x[2])) for x in rows]
+
+    def setSymbolizedOutputs(self, outputs):
+        '''Point the unsymbolized outputs at their symbolized versions and
+        update the stack fingerprints of the cases. outputs: [(sha1 of
+        unsymbolized output, symbolized output)].'''
+        outputs = [(sha, hashlib.sha1(output).hexdigest(), output)
+                   for sha, output in outputs]
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT sha1 FROM output_blobs ' +
+                          'WHERE sha1=ANY(%s)', ([x[1] for x in outputs], ))
+                present = set(x[0] for x in c)
+                self._addOutputBlobs(c, list(dict(
+                    (x[1], x[2]) for x in outputs
+                    if not x[1] in present).items()))
+                fingerprints = []
+                for old_sha, new_sha, output in outputs:
+                    c.execute('UPDATE outputs ' +
+                              'SET output_sha1=%s, symbolized=TRUE ' +
+                              'WHERE output_sha1=%s AND NOT symbolized ' +
+                              'RETURNING case_id', (new_sha, old_sha))
+                    fingerprint = stack_fingerprint(output)
+                    fingerprints += [(x[0], fingerprint) for x in c]
+                c.executemany('DELETE FROM case_fingerprints ' +
+                              'WHERE case_id=%s',
+                              [(x[0], ) for x in fingerprints])
+                c.executemany('INSERT INTO case_fingerprints ' +
+                              'VALUES (%s, %s)',
+                              [x for x in fingerprints if x[1]])
+
+    def getSymbols(self, keys):
+        '''Look up symbolized frames. keys is an iterable of (build_id,
+        offset). Returns a {(build_id, offset): lines or None} dict of the
+        cached ones.'''
+        keys = list(keys)
+        if not keys:
+            return {}
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('SELECT s.build_id, s.module_offset, s.frames ' +
+                          'FROM symbol_cache AS s, ' +
+                          '    unnest(%s::TEXT[], %s::BIGINT[]) ' +
+                          '        AS k(build_id, module_offset) ' +
+                          'WHERE s.build_id=k.build_id ' +
+                          '    AND s.module_offset=k.module_offset',
+                          ([x[0] for x in keys], [x[1] for x in keys]))
+                return dict(((x[0], x[1]), x[2].split('\n') if x[2]
+                             else None) for x in c)
+
+    def addSymbols(self, symbols):
+        '''Add symbolized frames to the cache. symbols is a {(build_id,
+        offset): lines or None} dict.'''
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.executemany('INSERT INTO symbol_cache ' +
+                              'VALUES (%s, %s, %s) ON CONFLICT DO NOTHING',
+                              [(k[0], k[1], '\n'.join(v or []))
+                               for k, v in symbols.items()])
 
     def getLastRunTimeByVersions(self, versions):
         '''Returns (start_time, end_time) of the test run with these versions.
@@ -255,22 +1031,52 @@ class TriageDb(object):
                 c.execute('SELECT start_time, end_time ' +
                           'FROM test_runs ' +
                           'WHERE clang_version=%s AND llvm_version=%s ' +
+                          '    AND NOT in_progress ' +
                           'ORDER BY start_time ' +
                           'LIMIT 1', (clang_version, llvm_version))
                 return c.fetchone()
 
     def getReduceWork(self):
-        'Get a (sha, content) pair to run through reduce. None if none.'
+        '''Lease the next case in the reduce queue and return a (sha,
+        content) pair to run through reduce. None if none. The lease
+        expires after REDUCE_LEASE_TIME seconds, after which the case may
+        be handed out again unless it has been reduced.'''
 
+        now = int(time.time())
+        worker = '{}:{}'.format(socket.gethostname(), os.getpid())
         with self.conn:
             with self.conn.cursor() as c:
                 c.execute(
-                    'SELECT sha1, z_contents FROM unreduced_cases_view ' +
-                    'ORDER BY sha1 LIMIT 1')
+                    'SELECT case_id FROM reduce_queue ' +
+                    'WHERE lease_expires IS NULL OR lease_expires<%s ' +
+                    'ORDER BY priority, size, case_id LIMIT 1 ' +
+                    'FOR UPDATE SKIP LOCKED', (now, ))
                 r = c.fetchone()
-        if r is None:
-            return None
-        return (r[0], zlib.decompress(r[1]))
+                if r is None:
+                    return None
+                case_id = r[0]
+                c.execute('UPDATE reduce_queue ' +
+                          'SET leased_by=%s, lease_expires=%s ' +
+                          'WHERE case_id=%s',
+                          (worker, now + REDUCE_LEASE_TIME, case_id))
+                c.execute('SELECT sha1, codec, z_contents FROM case_view ' +
+                          'WHERE id=%s', (case_id, ))
+                r = c.fetchone()
+        return (r[0], self.decompress(r[1], r[2]))
+
+    def releaseReduceWork(self, shas):
+        '''Give up the leases this process holds on the cases with the
+        given sha1s, so that they may be handed out again at once.'''
+
+        worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('UPDATE reduce_queue ' +
+                          'SET leased_by=NULL, lease_expires=NULL ' +
+                          'FROM cases ' +
+                          'WHERE cases.id=reduce_queue.case_id ' +
+                          '    AND cases.sha1 IN %s AND leased_by=%s',
+                          (tuple(shas), worker))
 
     def addReduced(self, versions, sha, result, contents=None):
         'Add a reduced case.'
@@ -295,29 +1101,101 @@ class TriageDb(object):
                               result.name))
                 cr_id = c.fetchone()[0]
                 if not contents is None:
+                    codec = self.codec('reduced')
                     c.execute('INSERT INTO reduced_contents ' +
-                              '    (reduced_id, contents) ' +
-                              'VALUES (%s, %s)', (cr_id, contents))
+                              '    (reduced_id, codec, contents, sha1, ' +
+                              '     size) ' +
+                              'VALUES (%s, %s, %s, %s, %s)',
+                              (cr_id, codec.id, codec.compress(contents),
+                               hashlib.sha1(contents).hexdigest(),
+                               len(contents)))
+                # Dequeue, and defer other cases in the same bucket
+                c.execute('DELETE FROM reduce_queue WHERE case_id=%s ' +
+                          'RETURNING result, fingerprint', (case_id, ))
+                bucket = c.fetchone()
+                if bucket and result != ReduceResult.no_crash:
+                    c.execute('UPDATE reduce_queue SET priority=1 ' +
+                              'WHERE result=%s AND priority=0', bucket[:1])
+                    c.execute('UPDATE reduce_queue SET priority=2 ' +
+                              'WHERE result=%s AND fingerprint=%s', bucket)
+
+    def getBisectWork(self):
+        '''Get a list of BisectWork, one for each failure reason in the
+        bisect queue, oldest first.'''
+
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute(
+                    'SELECT q.result, rs.str, cv.sha1, cv.codec, '
+                    '    cv.z_contents, q.new_run, '
+                    '    old.clang_version, old.llvm_version, '
+                    '    new.clang_version, new.llvm_version '
+                    'FROM bisect_queue AS q, result_strings AS rs, '
+                    '    case_view AS cv, test_runs AS old, '
+                    '    test_runs AS new '
+                    'WHERE rs.id=q.result AND cv.id=q.case_id '
+                    '    AND old.id=q.old_run AND new.id=q.new_run '
+                    'ORDER BY q.new_run, q.result')
+                rows = c.fetchall()
+        return [BisectWork(x[0], x[1], x[2], self.decompress(x[3], x[4]),
+                           x[5], {'clang': x[6], 'llvm': x[7]},
+                           {'clang': x[8], 'llvm': x[9]})
+                for x in rows]
+
+    def addBisection(self, work, good_revision, bad_revision, bad_project,
+                     exact):
+        '''Record the result of bisecting a BisectWork and remove it from
+        the bisect queue.'''
+
+        with self.conn:
+            with self.conn.cursor() as c:
+                c.execute('INSERT INTO bisections (result, test_run, ' +
+                          '    case_id, good_revision, bad_revision, ' +
+                          '    bad_project, exact) ' +
+                          'SELECT %s, %s, id, %s, %s, %s, %s ' +
+                          'FROM cases WHERE sha1=%s',
+                          (work.result_id, work.run_id, good_revision,
+                           bad_revision, bad_project, exact, work.sha))
+                c.execute('DELETE FROM bisect_queue WHERE result=%s',
+                          (work.result_id, ))
 
     class TestRunContext(object):
-        'A context manager for test runs.'
+        '''A context manager for test runs. Results are written to the
+        database in batches as they are added, so an interrupted run can
+        be resumed by skipping the cases in done.'''
 
-        def __init__(self, db, versions):
+        def __init__(self, db, versions, digest=None,
+                     batch_size=TEST_RUN_BATCH_SIZE):
             self.db = db
             self.versions = versions
+            self.digest = digest
+            self.batch_size = batch_size
             self.results = []
 
         def __enter__(self):
             self.start_time = int(time.time())
+            self.run_id, self.done, self.copied_from = \
+                self.db._beginTestRun(self.versions, self.start_time,
+                                      self.digest)
             return self
 
         def __exit__(self, type, value, traceback):
-            # We actually don't want to commit on an exception
+            # The results we have are valid even if the run was
+            # interrupted, so save them to be able to resume. But we
+            # don't want to mark the run finished on an exception.
+            self.flush()
             if not value:
-                self.db._addTestRun(self.versions,
-                                    self.start_time, int(time.time()),
-                                    self.results)
+                self.db._finishTestRun(self.run_id, int(time.time()))
+
+        def flush(self):
+            'Write the pending results to the database.'
+            results, self.results = self.results, []
+            if results:
+                self.db._addTestRunResults(self.run_id, results)
 
-        def addResult(self, sha, result_string, output):
-            'Add a result. Output will be ignored if result_string="OK".'
-            self.results.append((sha, result_string, output))
+        def addResult(self, sha, result_string, output, runtime=None):
+            '''Add a result. Output will be ignored if result_string="OK".
+            runtime is the time in seconds the test took.'''
+            self.results.append((sha, result_string, output, runtime))
+            if len(self.results) >= self.batch_size:
+                self.flush()
@@ -7,8 +7,6 @@
 import psycopg2 as pg
 import pystache
 import time
-from hashlib import sha1
-import zlib
 import os
 import subprocess as subp
 
@@ -31,20 +29,23 @@ OUTPUTS_BZ2 = os.path.join(REPORT_DIR, 'all_outputs.tar.bz2')
 REDUCED_BZ2 = os.path.join(REPORT_DIR, 'all_reduced.tar.bz2')
 
 
-REDUCED_DICT = None
 REDUCED_SHA_DICT = None
+REDUCED_SIZE_DICT = None
 OUTPUT_SHA_DICT = None
+BISECTION_DICT = None
 
 
 def fetch_reduced_dict(db):
-    'Get a {case_sha1: reduced_sha1} dictionary of all reduced cases.'
+    '''Get {case_sha1: reduced_sha1} and {case_sha1: reduced_size}
+    dictionaries of all reduced cases.'''
 
-    global REDUCED_DICT, REDUCED_SHA_DICT
+    global REDUCED_SHA_DICT, REDUCED_SIZE_DICT
     with db.cursor() as c:
-        c.execute('SELECT sha1, contents FROM sha_reduced_view ')
-        REDUCED_DICT = dict(c.fetchall())
-    REDUCED_SHA_DICT = dict((k, sha1(v).hexdigest())
-                            for (k, v) in REDUCED_DICT.items())
+        c.execute('SELECT sha1, reduced_sha1, reduced_size ' +
+                  'FROM sha_reduced_view')
+        rows = c.fetchall()
+    REDUCED_SHA_DICT = dict((x[0], x[1]) for x in rows)
+    REDUCED_SIZE_DICT = dict((x[0], x[2]) for x in rows)
 
 
 def fetch_output_dict(db):
@@ -52,10 +53,27 @@ def fetch_output_dict(db):
 
     global OUTPUT_SHA_DICT
     with db.cursor() as c:
-        c.execute('SELECT sha1, output FROM sha_output_view')
-        OUTPUT_SHA_DICT = dict(
-            (x[0], sha1(zlib.decompress(x[1])).hexdigest())
-            for x in c.fetchall())
+        c.execute('SELECT sha1, output_sha1 FROM sha_output_view')
+        OUTPUT_SHA_DICT = dict(c.fetchall())
+
+
+def fetch_bisection_dict(db):
+    'Get a {reason: description_of_first_bad_revision} dictionary.'
+
+    global BISECTION_DICT
+    with db.cursor() as c:
+        c.execute('SELECT str, good_revision, bad_revision, bad_project, ' +
+                  '    exact ' +
+                  'FROM bisections, result_strings ' +
+                  'WHERE bisections.result=result_strings.id')
+        res = c.fetchall()
+    BISECTION_DICT = {}
+    for reason, good, bad, proj, exact in res:
+        if exact:
+            BISECTION_DICT[reason] = '{} r{}'.format(proj, bad)
+        else:
+            BISECTION_DICT[reason] = 'between r{} and r{}'.format(
+                good + 1, bad)
 
 
 def asctime(t=None):
@@ -78,8 +96,8 @@ def fetch_failures(db, run_id):
                   'WHERE test_run=%s', (run_id, ))
         results = c.fetchall()
     fails_dict = dict([(x[0], x[1]) for x in results])
-    reduced_sizes = dict([(x[0], len(REDUCED_DICT[x[0]]))
-                          for x in results if x[0] in REDUCED_DICT])
+    reduced_sizes = dict([(x[0], REDUCED_SIZE_DICT[x[0]])
+                          for x in results if x[0] in REDUCED_SIZE_DICT])
     return fails_dict, reduced_sizes
 
 
@@ -87,7 +105,7 @@ def get_reduce_queue_size(db):
     'Get the number of items in reduce queue.'
 
     with db.cursor() as c:
-        c.execute('SELECT COUNT(*) FROM unreduced_cases_view')
+        c.execute('SELECT COUNT(*) FROM reduce_queue')
         return c.fetchone()[0]
 
 
@@ -115,7 +133,7 @@ def get_num_distinct_reduced(db):
     'Get the number of reduced cases that are distinct.'
 
     with db.cursor() as c:
-        c.execute("SELECT COUNT(DISTINCT contents) " +
+        c.execute("SELECT COUNT(DISTINCT sha1) " +
                   "FROM reduced_contents")
         return c.fetchone()[0]
 
@@ -125,7 +143,8 @@ def get_num_runs_completed(db):
 
     with db.cursor() as c:
         c.execute("SELECT COUNT(*) " +
-                  "FROM test_runs")
+                  "FROM test_runs " +
+                  "WHERE NOT in_progress")
         return c.fetchone()[0]
 
 
@@ -158,7 +177,8 @@ def build_failure_context(reason, old_reason, cases):
         ds = ds[:MAX_SHOW_CASES]
         ellipsis = True
     d = {'reason': reason, 'oldReason': old_reason, 'cases': ds,
-         'numCases': num_cases, 'ellipsis': ellipsis}
+         'numCases': num_cases, 'ellipsis': ellipsis,
+         'firstBad': BISECTION_DICT.get(reason)}
     return d
 
 
@@ -180,7 +200,7 @@ def sort_cases(cases, reduced_sizes):
     '''Sort cases into presentation order: unique reduced + not_reduced +
     duplicate_reduced.'''
 
-    not_reduced, reduced = split_by(lambda x: x in REDUCED_DICT, cases)
+    not_reduced, reduced = split_by(lambda x: x in REDUCED_SHA_DICT, cases)
     not_reduced.sort()
 
     # sort reduced by size, sha
@@ -191,7 +211,7 @@ def sort_cases(cases, reduced_sizes):
     duplicate_reduced = []
     seen = set()
     for x in reduced:
-        red = REDUCED_DICT[x]
+        red = REDUCED_SHA_DICT[x]
         if red in seen:
             duplicate_reduced.append(x)
         else:
@@ -305,10 +325,12 @@ def generate_report_as_string():
     with db:
         fetch_reduced_dict(db)
         fetch_output_dict(db)
+        fetch_bisection_dict(db)
         with db.cursor() as c:
             c.execute('SELECT id, start_time, end_time, clang_version, ' +
                       '    llvm_version ' +
-                      'FROM test_runs ORDER BY start_time DESC LIMIT 60')
+                      'FROM test_runs WHERE NOT in_progress ' +
+                      'ORDER BY start_time DESC LIMIT 60')
             res = c.fetchall()[::-1]
         test_runs = []
 
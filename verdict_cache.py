@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import hashlib
+import pickle
+import time
+from collections import OrderedDict
+
+from config import VERDICT_CACHE_SIZE
+
+
+class VerdictCache(object):
+    '''A bounded LRU cache of test verdicts keyed by a digest of the
+    tested data and a context string identifying the clang binary and
+    parameters. If path is given, verdicts are also stored in an SQLite
+    database there and shared by all processes using the same path. Safe
+    to use from several threads.'''
+
+    def __init__(self, max_entries=VERDICT_CACHE_SIZE, path=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # hits not recorded in the persistent cache's stats
+        self.memory_hits = 0
+        # The persistent cache is trimmed to max_entries only every
+        # evict_interval puts, so it may hold up to that many more
+        # entries per process.
+        self.evict_interval = max(1, max_entries // 16)
+        self.puts_since_evict = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=10,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS verdicts ('
+                            '    key BLOB PRIMARY KEY, '
+                            '    verdict BLOB NOT NULL, '
+                            '    used REAL NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS verdicts_used '
+                            '    ON verdicts(used)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS stats ('
+                            '    name TEXT PRIMARY KEY, '
+                            '    value INTEGER NOT NULL)')
+            self.db.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0)")
+            self.db.execute("INSERT OR IGNORE INTO stats "
+                            "VALUES ('misses', 0)")
+
+    @staticmethod
+    def key(data, context):
+        'Compute the cache key of data tested in context.'
+
+        h = hashlib.sha1(context.encode('utf-8'))
+        h.update(b'\0')
+        h.update(data)
+        return h.digest()
+
+    def __db_get(self, key):
+        try:
+            row = self.db.execute('SELECT verdict FROM verdicts WHERE key=?',
+                                  (key, )).fetchone()
+            if row:
+                self.db.execute('UPDATE verdicts SET used=? WHERE key=?',
+                                (time.time(), key))
+            self.db.execute('UPDATE stats SET value=value+1 WHERE name=?',
+                            ('hits' if row else 'misses', ))
+        except sqlite3.OperationalError:
+            # The persistent cache is best effort; the database may be
+            # locked by another process for too long.
+            return None
+        return row
+
+    def __db_put(self, key, verdict):
+        try:
+            self.db.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)',
+                            (key, pickle.dumps(verdict), time.time()))
+            self.puts_since_evict += 1
+            if self.puts_since_evict >= self.evict_interval:
+                self.db.execute('DELETE FROM verdicts WHERE key IN ('
+                                '    SELECT key FROM verdicts '
+                                '    ORDER BY used DESC '
+                                '    LIMIT -1 OFFSET ?)', (self.max_entries, ))
+                self.puts_since_evict = 0
+        except sqlite3.OperationalError:
+            pass
+
+    def get(self, key):
+        'Returns (found, verdict).'
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return True, self.entries[key]
+            row = self.db and self.__db_get(key)
+            if row:
+                self.hits += 1
+                verdict = pickle.loads(row[0])
+                self.__put_memory(key, verdict)
+                return True, verdict
+            self.misses += 1
+            return False, None
+
+    def __put_memory(self, key, verdict):
+        self.entries[key] = verdict
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, key, verdict):
+        'Store a verdict.'
+
+        with self.lock:
+            self.__put_memory(key, verdict)
+            if self.db:
+                self.__db_put(key, verdict)
+
+    def lookup(self, data, context, test):
+        '''Return the verdict for data in context, calling test(data) to
+        compute it if it is not cached.'''
+
+        key = self.key(data, context)
+        found, verdict = self.get(key)
+        if not found:
+            verdict = test(data)
+            self.put(key, verdict)
+        return verdict
+
+    def stats(self):
+        '''Returns (hits, lookups). For a persistent cache, these include
+        the lookups of all processes sharing it.'''
+
+        with self.lock:
+            if self.db:
+                try:
+                    stats = dict(self.db.execute(
+                        'SELECT name, value FROM stats').fetchall())
+                    hits = stats['hits'] + self.memory_hits
+                    return hits, hits + stats['misses']
+                except sqlite3.OperationalError:
+                    pass
+            return self.hits, self.hits + self.misses
+
+    def local_stats(self):
+        'Returns (hits, lookups) of this process.'
+
+        with self.lock:
+            return self.hits, self.hits + self.misses
+
+    def stats_str(self, since=None):
+        '''Describe the hit rate for humans. If since is a result of
+        local_stats(), only the lookups of this process after it are
+        counted.'''
+
+        if since is None:
+            hits, lookups = self.stats()
+        else:
+            hits, lookups = self.local_stats()
+            hits, lookups = hits - since[0], lookups - since[1]
+        return '{} of {} lookups hit the verdict cache ({:.0%})'.format(
+            hits, lookups, hits / lookups if lookups else 0)